@@ -1,8 +1,10 @@
-from . import complete_json, paralel_intend_and_extract, paralel_json_complete, models
+from . import clients, complete_json, paralel_intend_and_extract, paralel_json_complete, models, result_cache
 
 __all__ = [
+    "clients",
     "complete_json",
     "paralel_intend_and_extract",
     "paralel_json_complete",
-    "models"
+    "models",
+    "result_cache"
 ]
\ No newline at end of file
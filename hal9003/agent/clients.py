@@ -0,0 +1,149 @@
+import asyncio
+import weakref
+import importlib.util
+import httpx
+import openai
+from dataclasses import dataclass
+from agent import models
+from bot import config as bc
+
+# httpx only speaks http/2 with the optional `h2` package
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# httpcore trace event of a newly opened connection, every other request reused a pooled one
+NEW_CONNECTION_EVENT = "connection.connect_tcp.complete"
+
+@dataclass
+class BackendStats:
+    clients: int = 0
+    requests: int = 0
+    connections: int = 0
+
+    def to_dict(self):
+        return {
+            "clients": self.clients,
+            "requests": self.requests,
+            "connections": self.connections,
+            "reused": max(self.requests - self.connections, 0)
+        }
+
+def backend_key(backend: models.BackendConfig):
+    return (backend.name, backend.base_url, backend.api_key)
+
+class ClientRegistry:
+    """
+    Process wide long-lived LLM clients, one sync and one async (per event loop) client per backend.
+    The clients share pooled keep-alive connections instead of paying a handshake per call.
+    A given `http_client` / `async_http_client` (e.g.: with a custom transport) is used by every backend instead.
+    """
+
+    def __init__(
+            self,
+            max_connections: int = None,
+            max_keepalive: int = None,
+            keepalive_expiry: float = None,
+            http2: bool = None,
+            http_client=None,
+            async_http_client=None
+        ):
+        self.max_connections = max_connections or bc.LLM_MAX_CONNECTIONS
+        self.max_keepalive = max_keepalive or bc.LLM_MAX_KEEPALIVE
+        self.keepalive_expiry = bc.LLM_KEEPALIVE_EXPIRY if keepalive_expiry is None else keepalive_expiry
+        self.http2 = (bc.LLM_HTTP2 if http2 is None else http2) and HTTP2_AVAILABLE
+        self.http_client = http_client
+        self.async_http_client = async_http_client
+        self.sync_clients: dict = {}
+        # async connection pools are bound to the loop they were opened in
+        self.async_clients = weakref.WeakKeyDictionary()
+        self.loopless_clients: dict = {}
+        self.stats: dict[str, BackendStats] = {}
+
+    def limits(self):
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry
+        )
+
+    def backend_stats(self, backend: models.BackendConfig) -> BackendStats:
+        return self.stats.setdefault(backend.name, BackendStats())
+
+    def http_client_for(self, shared, default_factory, on_request):
+        if shared is None:
+            return default_factory(limits=self.limits(), http2=self.http2, event_hooks={"request": [on_request]})
+        hooks = shared.event_hooks
+        shared.event_hooks = {**hooks, "request": [*hooks.get("request", []), on_request]}
+        return shared
+
+    def get_client(self, backend: models.BackendConfig) -> openai.OpenAI:
+        key = backend_key(backend)
+        client = self.sync_clients.get(key)
+        if client is None:
+            stats = self.backend_stats(backend)
+
+            def _trace(event, info):
+                if event == NEW_CONNECTION_EVENT:
+                    stats.connections += 1
+
+            def _on_request(request):
+                # a shared http client also sends the requests of other backends
+                if str(request.url).startswith(str(client.base_url)):
+                    stats.requests += 1
+                    request.extensions["trace"] = _trace
+
+            client = openai.OpenAI(
+                api_key=backend.api_key,
+                base_url=backend.base_url,
+                # retried by `agent.limits` which knows about the other requests
+                max_retries=0,
+                http_client=self.http_client_for(self.http_client, openai.DefaultHttpxClient, _on_request)
+            )
+            stats.clients += 1
+            self.sync_clients[key] = client
+        return client
+
+    def get_async_client(self, backend: models.BackendConfig) -> openai.AsyncOpenAI:
+        try:
+            clients = self.async_clients.setdefault(asyncio.get_running_loop(), {})
+        except RuntimeError:
+            # created before the loop runs e.g.: in a constructor
+            clients = self.loopless_clients
+        key = backend_key(backend)
+        client = clients.get(key)
+        if client is None:
+            stats = self.backend_stats(backend)
+
+            async def _trace(event, info):
+                if event == NEW_CONNECTION_EVENT:
+                    stats.connections += 1
+
+            async def _on_request(request):
+                if str(request.url).startswith(str(client.base_url)):
+                    stats.requests += 1
+                    request.extensions["trace"] = _trace
+
+            client = openai.AsyncOpenAI(
+                api_key=backend.api_key,
+                base_url=backend.base_url,
+                max_retries=0,
+                http_client=self.http_client_for(self.async_http_client, openai.DefaultAsyncHttpxClient, _on_request)
+            )
+            stats.clients += 1
+            clients[key] = client
+        return client
+
+    def to_dict(self):
+        return {
+            "http2": self.http2,
+            "max_connections": self.max_connections,
+            "max_keepalive": self.max_keepalive,
+            "backends": {name: stats.to_dict() for name, stats in self.stats.items()}
+        }
+
+REGISTRY = ClientRegistry()
+
+def get_client(backend: models.BackendConfig) -> openai.OpenAI:
+    return REGISTRY.get_client(backend)
+
+def get_async_client(backend: models.BackendConfig) -> openai.AsyncOpenAI:
+    return REGISTRY.get_async_client(backend)
@@ -1,5 +1,4 @@
-import openai
-from agent import models
+from agent import models, clients, limits
 
 
 def debug_log(message, model=None):
@@ -16,20 +15,28 @@ def get_client_for_model(
 def create_client(
     backend: models.BackendConfig
 ):
-    client = openai.OpenAI(
-        api_key=backend.api_key,
-        base_url=backend.base_url
-    )
-    return client
+    # shared per backend, see `agent.clients`
+    return clients.get_client(backend)
+
+def create_async_client(
+    backend: models.BackendConfig
+):
+    return clients.get_async_client(backend)
 
 import json
-from jsonschema import validate
+import time
+from agent.validation import validation_errors
 from enum import Enum
 from tabulate import tabulate
 import concurrent.futures
-from typing import Optional
+from typing import Callable, Optional
 from dataclasses import dataclass
 from dataclasses import field
+from agent.result_cache import RESULT_CACHE, CacheMode
+from bot.response_cache import ResponseCache
+
+# deterministic (temperature 0) completions are reused in-process, also without the result cache
+RESPONSE_CACHE = ResponseCache()
 
 
 REFINEMENT_SCHEMA_PROMPT = """
@@ -70,6 +77,10 @@ class TaskResult:
     parsed: dict
     temperature: Optional[float]
     task_id: str
+    # schema violations of `parsed`
+    errors: list[str] = field(default_factory=list)
+    # the model that answered, differs from the task's if a hedge won
+    model: Optional[str] = None
     
     def to_dict(self):
         return {
@@ -79,20 +90,20 @@ class TaskResult:
             "valid": self.valid,
             "parsed": self.parsed,
             "temperature": self.temperature,
-            "task_id": self.task_id
+            "task_id": self.task_id,
+            "errors": self.errors,
+            "model": self.model
         }
 
 
-def complete_json(
+def prepare_completion(
     task: BaseTaskDescription
-) -> TaskResult:
+) -> tuple[models.ModelBackend, str, dict]:
     """
-    Complete a prompt according to a JSON schema and validate it.
+    Resolve the model and build the system message and completion parameters of a task.
     """
-    
     debug_log("SELECTED MODEL:",task.model)
     model = models.get_model(task.model)
-    client = create_client(model.client_config)
     
     assert task.schema_description or task.refinement_schema_prompt, "Either schema_description or refinement_schema_prompt must be provided."
 
@@ -114,35 +125,42 @@ def complete_json(
         "messages": messages,
     }
     
-    if task.temperature:
+    if task.temperature is not None:
         completion_params["temperature"] = task.temperature
     
     if model.supports_json:
         completion_params["response_format"] = {
             "type": "json_object"
         }
+    return model, system_message, completion_params
 
-    response = client.chat.completions.create(
-        **completion_params
-    )
-    
+def parse_task_result(
+    task: BaseTaskDescription,
+    model: models.ModelBackend,
+    system_message: str,
+    res: str
+) -> TaskResult:
+    """
+    Parse the completion and validate it against the task schema.
+    """
     parsable = False
     parsed = None
     try:
-        parsed = json.loads(response.choices[0].message.content)
+        parsed = json.loads(res)
         parsable = True
     except Exception as e:
         debug_log("ERROR:" + str(e), model.model)
         
     valid = False
+    errors = []
     if parsable:
         try:
-            validate(parsed, task.schema)
-            valid = True
+            errors = validation_errors(parsed, task.schema)
+            valid = not errors
         except Exception as e:
-            debug_log("ERROR:" + str(e), model.model)
-    
-    res = response.choices[0].message.content
+            errors = [str(e)]
+        for error in errors:
+            debug_log("ERROR:" + error, model.model)
     
     return TaskResult(
         system_message=system_message,
@@ -151,5 +169,90 @@ def complete_json(
         valid=valid,
         parsed=parsed,
         temperature=task.temperature,
-        task_id=task.task_id or model.model
-    )
\ No newline at end of file
+        task_id=task.task_id or model.model,
+        errors=errors,
+        model=model.model
+    )
+
+def timed_request(model_name: str, request: Callable, on_request: Optional[Callable] = None):
+    """
+    Sends the request once the limiter admitted it, only the request itself counts as the model's latency.
+    `on_request()` is called right before, e.g.: to start the hedge timer.
+    """
+    # `agent.latency` wraps `complete_json`, imported here to avoid the cycle
+    from agent import latency
+    if on_request:
+        on_request()
+    then = time.time()
+    response = request()
+    latency.TRACKER.record(model_name, time.time() - then)
+    return response
+
+async def timed_request_async(model_name: str, request: Callable, on_request: Optional[Callable] = None):
+    from agent import latency
+    if on_request:
+        on_request()
+    then = time.time()
+    response = await request()
+    latency.TRACKER.record(model_name, time.time() - then)
+    return response
+
+def response_cacheable(task: BaseTaskDescription) -> bool:
+    # recording always asks the model
+    return RESULT_CACHE.mode != CacheMode.RECORD and RESPONSE_CACHE.cacheable(task.temperature)
+
+def complete_json(
+    task: BaseTaskDescription,
+    on_request: Optional[Callable] = None
+) -> TaskResult:
+    """
+    Complete a prompt according to a JSON schema and validate it.
+    `on_request()` is called when the request is sent, not for cached results.
+    """
+    cached = RESULT_CACHE.get(task)
+    if cached is not None:
+        return TaskResult(**{**cached, "task_id": task.task_id or cached["task_id"]})
+    model, system_message, completion_params = prepare_completion(task)
+    cacheable = response_cacheable(task)
+    res = RESPONSE_CACHE.getLocal(model.model, completion_params["messages"], task.temperature) if cacheable else None
+    if res is None:
+        client = create_client(model.client_config)
+        response = limits.LIMITER.call(
+            model.client_config,
+            lambda: timed_request(task.model, lambda: client.chat.completions.create(**completion_params), on_request),
+            tokens=limits.estimate_tokens(completion_params["messages"])
+        )
+        res = response.choices[0].message.content
+        if cacheable:
+            RESPONSE_CACHE.setLocal(model.model, completion_params["messages"], task.temperature, res)
+    result = parse_task_result(task, model, system_message, res)
+    RESULT_CACHE.put(task, result.to_dict())
+    return result
+
+async def complete_json_async(
+    task: BaseTaskDescription,
+    on_request: Optional[Callable] = None
+) -> TaskResult:
+    """
+    Async version of `complete_json`, doesn't block the event loop while waiting for the model.
+    """
+    # the sqlite lookups are local and short, not worth a thread hop
+    cached = RESULT_CACHE.get(task)
+    if cached is not None:
+        return TaskResult(**{**cached, "task_id": task.task_id or cached["task_id"]})
+    model, system_message, completion_params = prepare_completion(task)
+    cacheable = response_cacheable(task)
+    res = RESPONSE_CACHE.getLocal(model.model, completion_params["messages"], task.temperature) if cacheable else None
+    if res is None:
+        client = create_async_client(model.client_config)
+        response = await limits.LIMITER.call_async(
+            model.client_config,
+            lambda: timed_request_async(task.model, lambda: client.chat.completions.create(**completion_params), on_request),
+            tokens=limits.estimate_tokens(completion_params["messages"])
+        )
+        res = response.choices[0].message.content
+        if cacheable:
+            RESPONSE_CACHE.setLocal(model.model, completion_params["messages"], task.temperature, res)
+    result = parse_task_result(task, model, system_message, res)
+    RESULT_CACHE.put(task, result.to_dict())
+    return result
\ No newline at end of file
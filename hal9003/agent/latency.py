@@ -0,0 +1,182 @@
+import math
+import asyncio
+import dataclasses
+import threading
+import concurrent.futures
+from collections import deque
+from typing import Callable, Optional
+from agent import models
+from agent.complete_json import BaseTaskDescription, TaskResult, complete_json, complete_json_async
+from bot import config as bc
+
+def latency_key(model_name: str) -> str:
+    model = models.REGISTRY.find(model_name)
+    return f"{model.client_config.name}/{model.model}" if model else model_name
+
+def percentile(samples: list[float], q: float) -> Optional[float]:
+    """Nearest rank percentile, `q` between 0 and 100"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+class LatencyTracker:
+    """
+    Rolling completion latencies per backend & model, the last `window` samples of each.
+    Thread safe, fed by `complete_json` with the duration of the requests themselves.
+    """
+
+    def __init__(self, window: int = None):
+        self.window = window or bc.LATENCY_WINDOW
+        self.samples: dict[str, deque] = {}
+        self.lock = threading.Lock()
+
+    def record(self, model_name: str, elapsed: float):
+        key = latency_key(model_name)
+        with self.lock:
+            self.samples.setdefault(key, deque(maxlen=self.window)).append(elapsed)
+
+    def percentile(self, model_name: str, q: float, min_samples: int = 1) -> Optional[float]:
+        with self.lock:
+            samples = list(self.samples.get(latency_key(model_name), ()))
+        if len(samples) < min_samples:
+            return None
+        return percentile(samples, q)
+
+    def to_dict(self):
+        with self.lock:
+            samples = {key: list(values) for key, values in self.samples.items()}
+        return {
+            key: {
+                "samples": len(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99)
+            } for key, values in samples.items()
+        }
+
+TRACKER = LatencyTracker()
+
+class HedgePolicy:
+    """
+    Sends a duplicate of a task to an equivalent model (`ModelBackend.equivalents`) once the
+    primary model exceeded its p95, the first result wins. At most `budget` hedges per request.
+    """
+
+    def __init__(self, tracker: LatencyTracker = None, budget: float = None, min_samples: int = None, enabled: bool = None):
+        self.tracker = tracker or TRACKER
+        self.budget = bc.HEDGE_BUDGET if budget is None else budget
+        self.min_samples = min_samples or bc.HEDGE_MIN_SAMPLES
+        self.enabled = bc.HEDGE_ENABLED if enabled is None else enabled
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def plan(self, task: BaseTaskDescription) -> tuple[Optional[float], Optional[BaseTaskDescription]]:
+        """How long to wait for the primary and the hedge task, (None, None) if the task isn't hedged"""
+        with self.lock:
+            self.requests += 1
+        model = models.REGISTRY.find(task.model)
+        if not self.enabled or model is None or not model.equivalents:
+            return None, None
+        delay = self.tracker.percentile(task.model, 95, self.min_samples)
+        if delay is None:
+            return None, None
+        return delay, dataclasses.replace(task, model=model.equivalents[0])
+
+    def take_budget(self) -> bool:
+        with self.lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def won(self):
+        with self.lock:
+            self.hedge_wins += 1
+
+    def to_dict(self):
+        return {
+            "enabled": self.enabled,
+            "budget": self.budget,
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "win_rate": self.hedge_wins / self.hedges if self.hedges else None
+        }
+
+HEDGING = HedgePolicy()
+
+def pick_winner(policy: HedgePolicy, finished: set, pending: set, hedge):
+    """The first successful request, a failed one only wins if both failed"""
+    winner = next((future for future in finished if future.exception() is None), None)
+    if winner is None and not pending:
+        winner = next(iter(finished))
+    if winner is hedge and winner.exception() is None:
+        policy.won()
+    return winner
+
+# hedges run outside the fan-out's own pool, a hedge never waits for a free worker
+HEDGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=bc.LLM_MAX_CONNECTIONS, thread_name_prefix="hedge")
+
+def complete_json_hedged(
+    task: BaseTaskDescription,
+    policy: HedgePolicy = None,
+    complete: Callable = complete_json
+) -> TaskResult:
+    """
+    `complete_json` that hedges slow requests, see `HedgePolicy`. The hedge timer starts once the
+    primary request was sent, cache hits and waiting for the limiter don't count.
+    A losing request can't be aborted from a thread, its result is dropped.
+    """
+    policy = policy or HEDGING
+    delay, hedge = policy.plan(task)
+    if hedge is None:
+        return complete(task)
+    sent = threading.Event()
+    primary = HEDGE_EXECUTOR.submit(complete, task, on_request=sent.set)
+    primary.add_done_callback(lambda _: sent.set())
+    sent.wait()
+    try:
+        return primary.result(timeout=delay)
+    except concurrent.futures.TimeoutError:
+        if not policy.take_budget():
+            return primary.result()
+    second = HEDGE_EXECUTOR.submit(complete, hedge)
+    pending = {primary, second}
+    while True:
+        finished, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        winner = pick_winner(policy, finished, pending, second)
+        if winner is not None:
+            return winner.result()
+
+async def complete_json_hedged_async(
+    task: BaseTaskDescription,
+    policy: HedgePolicy = None,
+    complete: Callable = complete_json_async
+) -> TaskResult:
+    """Async version of `complete_json_hedged`, the losing request is cancelled"""
+    policy = policy or HEDGING
+    delay, hedge = policy.plan(task)
+    if hedge is None:
+        return await complete(task)
+    sent = asyncio.Event()
+    primary = asyncio.ensure_future(complete(task, on_request=sent.set))
+    primary.add_done_callback(lambda _: sent.set())
+    pending = {primary}
+    try:
+        await sent.wait()
+        finished, _ = await asyncio.wait(pending, timeout=delay)
+        if finished or not policy.take_budget():
+            return await primary
+        second = asyncio.ensure_future(complete(hedge))
+        pending = {primary, second}
+        while True:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = pick_winner(policy, finished, pending, second)
+            if winner is not None:
+                return winner.result()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,219 @@
+import time
+import random
+import asyncio
+import threading
+import email.utils
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional
+import openai
+# backends are annotated as strings, `agent.models` may still be initializing when `bot` imports this
+from agent import models
+from bot import config as bc
+
+# rough, the buckets only need the order of magnitude
+CHARS_PER_TOKEN = 4
+
+def estimate_tokens(messages: list[dict], max_tokens: Optional[int] = None) -> int:
+    prompt = sum(len(msg.get("content") or "") for msg in messages) // CHARS_PER_TOKEN
+    return prompt + (max_tokens or bc.LLM_EXPECTED_COMPLETION_TOKENS)
+
+def retry_after(ex: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, from `retry-after-ms` or `retry-after` (seconds or a http date)"""
+    response = getattr(ex, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def retryable(ex: Exception) -> bool:
+    if isinstance(ex, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(ex, openai.APIStatusError) and ex.status_code >= 500
+
+class TokenBucket:
+    """Refills `per_minute` units a minute up to a minute's worth, 0 means unlimited"""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Takes `amount` (the balance may go negative), returns how long to wait until it is covered"""
+        if not self.per_minute:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.level = min(self.level + (now - self.updated) * self.per_minute / 60, self.per_minute)
+            self.updated = now
+            # a single request larger than the bucket only waits for a full bucket
+            self.level -= min(amount, self.per_minute)
+            return max(-self.level * 60 / self.per_minute, 0)
+
+class InFlightLimit:
+    """
+    A counting semaphore shared by threads and event loops, a released slot is handed to the
+    oldest waiter whether it is a thread or a coroutine.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.lock = threading.Lock()
+        self.waiters: deque = deque()
+
+    def _try_acquire(self, waiter) -> bool:
+        with self.lock:
+            if self.active < self.limit and not self.waiters:
+                self.active += 1
+                return True
+            self.waiters.append(waiter)
+            return False
+
+    def acquire(self):
+        event = threading.Event()
+        if not self._try_acquire(event):
+            event.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        if self._try_acquire(waiter):
+            return
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.lock:
+                handed = waiter not in self.waiters
+                if not handed:
+                    self.waiters.remove(waiter)
+            if handed:
+                # the slot was handed over while we were cancelled
+                self.release()
+            raise
+
+    def release(self):
+        with self.lock:
+            if not self.waiters:
+                self.active -= 1
+                return
+            waiter = self.waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+@dataclass
+class LimitStats:
+    requests: int = 0
+    retries: int = 0
+    failed: int = 0
+    # seconds spent waiting for the rate limit buckets
+    throttled: float = 0
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "failed": self.failed,
+            "throttled": round(self.throttled, 3)
+        }
+
+class RateLimiter:
+    """
+    Shared by the agent code and the bot: a global limit of requests in flight, request & token
+    buckets per backend (`BackendConfig.requests_per_minute` & `tokens_per_minute`) and retries of
+    429 / 5xx responses with jittered exponential backoff that respects `Retry-After` up to `max_backoff`.
+    """
+
+    def __init__(self, max_in_flight: int = None, max_retries: int = None, backoff: float = None, max_backoff: float = None):
+        self.in_flight = InFlightLimit(max_in_flight or bc.LLM_MAX_IN_FLIGHT)
+        self.max_retries = bc.LLM_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = backoff or bc.LLM_RETRY_BACKOFF
+        self.max_backoff = max_backoff or bc.LLM_RETRY_MAX_BACKOFF
+        self.buckets: dict[str, tuple[TokenBucket, TokenBucket]] = {}
+        self.stats: dict[str, LimitStats] = {}
+        self.lock = threading.Lock()
+
+    def backend_buckets(self, backend: "models.BackendConfig") -> tuple[TokenBucket, TokenBucket]:
+        with self.lock:
+            if backend.name not in self.buckets:
+                self.buckets[backend.name] = (TokenBucket(backend.requests_per_minute), TokenBucket(backend.tokens_per_minute))
+                self.stats[backend.name] = LimitStats()
+            return self.buckets[backend.name]
+
+    def throttle(self, backend: "models.BackendConfig", tokens: int) -> float:
+        requests, token_bucket = self.backend_buckets(backend)
+        wait = max(requests.reserve(1), token_bucket.reserve(tokens))
+        stats = self.stats[backend.name]
+        stats.requests += 1
+        stats.throttled += wait
+        return wait
+
+    def delay(self, ex: Exception, attempt: int) -> float:
+        # full jitter, but never earlier than the server asked for
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        return max(delay, retry_after(ex) or 0)
+
+    def should_retry(self, backend: "models.BackendConfig", ex: Exception, attempt: int) -> bool:
+        # a server asking for more than `max_backoff` fails fast instead of blocking the caller
+        if retryable(ex) and attempt < self.max_retries and (retry_after(ex) or 0) <= self.max_backoff:
+            self.stats[backend.name].retries += 1
+            return True
+        self.stats[backend.name].failed += 1
+        return False
+
+    def call(self, backend: "models.BackendConfig", fn: Callable, tokens: int = 0):
+        """Runs `fn()` within the limits, retrying failed requests. Waits don't hold an in-flight slot."""
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self.throttle(backend, tokens))
+            self.in_flight.acquire()
+            try:
+                return fn()
+            except Exception as ex:
+                if not self.should_retry(backend, ex, attempt):
+                    raise
+                delay = self.delay(ex, attempt)
+            finally:
+                self.in_flight.release()
+            time.sleep(delay)
+
+    async def call_async(self, backend: "models.BackendConfig", fn: Callable[[], Awaitable], tokens: int = 0):
+        """Async version of `call`, `fn()` returns the awaitable to retry"""
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(self.throttle(backend, tokens))
+            await self.in_flight.acquire_async()
+            try:
+                return await fn()
+            except Exception as ex:
+                if not self.should_retry(backend, ex, attempt):
+                    raise
+                delay = self.delay(ex, attempt)
+            finally:
+                self.in_flight.release()
+            await asyncio.sleep(delay)
+
+    def to_dict(self):
+        return {
+            "max_in_flight": self.in_flight.limit,
+            "in_flight": self.in_flight.active,
+            "waiting": len(self.in_flight.waiters),
+            "backends": {name: stats.to_dict() for name, stats in self.stats.items()}
+        }
+
+LIMITER = RateLimiter()
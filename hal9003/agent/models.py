@@ -1,4 +1,7 @@
-from dataclasses import dataclass
+import json
+import pathlib
+from dataclasses import dataclass, field
+from typing import Optional
 from bot import config as bc
 
 @dataclass
@@ -11,6 +14,9 @@ class BackendConfig:
     api_key: str
     name: str
     base_url: str = None
+    # 0 means unlimited, see `agent.limits`
+    requests_per_minute: int = 0
+    tokens_per_minute: int = 0
 
 @dataclass
 class ModelBackend:
@@ -19,74 +25,235 @@ class ModelBackend:
     supports_tools: bool
     supports_functions: bool
     client_config: BackendConfig
+    aliases: list[str] = field(default_factory=list)
+    context_window: int = 8192
+    tokens_per_second: Optional[float] = None
+    # USD per 1M tokens
+    input_price: Optional[float] = None
+    output_price: Optional[float] = None
+    # models on other backends that answer about as well, used to hedge slow requests
+    equivalents: list[str] = field(default_factory=list)
+
+    CAPABILITIES = ("supports_json", "supports_tools", "supports_functions")
+
+    def capabilities(self) -> list[str]:
+        return [capability for capability in self.CAPABILITIES if getattr(self, capability)]
+
+    def estimate_cost(self, input_tokens: int, output_tokens: int = 0) -> Optional[float]:
+        if self.input_price is None or self.output_price is None:
+            return None
+        return (input_tokens * self.input_price + output_tokens * self.output_price) / 1_000_000
+
+    def to_dict(self):
+        return {
+            "model": self.model,
+            "backend": self.client_config.name,
+            "aliases": self.aliases,
+            "supports_json": self.supports_json,
+            "supports_tools": self.supports_tools,
+            "supports_functions": self.supports_functions,
+            "context_window": self.context_window,
+            "tokens_per_second": self.tokens_per_second,
+            "input_price": self.input_price,
+            "output_price": self.output_price,
+            "equivalents": self.equivalents
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, backends: dict[str, BackendConfig]):
+        data = dict(data)
+        backend = data.pop("backend")
+        if backend not in backends:
+            raise ValueError(f"Unknown backend `{backend}` for model `{data.get('model')}`")
+        return cls(
+            supports_json=data.pop("supports_json", False),
+            supports_tools=data.pop("supports_tools", False),
+            supports_functions=data.pop("supports_functions", False),
+            client_config=backends[backend],
+            **data
+        )
+
+class UnknownModelError(KeyError):
+    pass
     
 BACKENDS = {
     Backends.OPENAI: BackendConfig(
         name=Backends.OPENAI,
         api_key=bc.OPENAI_API_KEY,
-        base_url=None
+        base_url=None,
+        requests_per_minute=bc.OPENAI_REQUESTS_PER_MINUTE,
+        tokens_per_minute=bc.OPENAI_TOKENS_PER_MINUTE
     ),
     Backends.DEEPINFRA: BackendConfig(
         name=Backends.DEEPINFRA,
         api_key=bc.DEEPINFRA_API_KEY,
-        base_url="https://api.deepinfra.com/v1/openai"
+        base_url="https://api.deepinfra.com/v1/openai",
+        requests_per_minute=bc.DEEPINFRA_REQUESTS_PER_MINUTE,
+        tokens_per_minute=bc.DEEPINFRA_TOKENS_PER_MINUTE
     )
 }
 
-MODELS = [
+DEFAULT_MODELS = [
     ModelBackend(
         model="meta-llama/Meta-Llama-3-70B-Instruct",
         supports_json=False,
         supports_tools=False,
         supports_functions=False,
-        client_config=BACKENDS[Backends.DEEPINFRA]
+        client_config=BACKENDS[Backends.DEEPINFRA],
+        aliases=["llama3-70b"],
+        context_window=8192,
+        input_price=0.59,
+        output_price=0.79,
+        equivalents=["gpt-3.5-turbo"]
     ),
     ModelBackend(
         model="meta-llama/Meta-Llama-3-8B-Instruct",
         supports_json=False,
         supports_tools=False,
         supports_functions=False,
-        client_config=BACKENDS[Backends.DEEPINFRA]
+        client_config=BACKENDS[Backends.DEEPINFRA],
+        aliases=["llama3-8b"],
+        context_window=8192,
+        input_price=0.08,
+        output_price=0.08,
+        equivalents=["gpt-3.5-turbo"]
     ),
     ModelBackend(
         model="databricks/dbrx-instruct",
         supports_json=False,
         supports_tools=False,
         supports_functions=False,
-        client_config=BACKENDS[Backends.DEEPINFRA]
+        client_config=BACKENDS[Backends.DEEPINFRA],
+        aliases=["dbrx"],
+        context_window=32768,
+        input_price=0.6,
+        output_price=0.6
     ),
     ModelBackend(
         model="cognitivecomputations/dolphin-2.6-mixtral-8x7b",
         supports_json=False,
         supports_tools=False,
         supports_functions=False,
-        client_config=BACKENDS[Backends.DEEPINFRA]
+        client_config=BACKENDS[Backends.DEEPINFRA],
+        aliases=["dolphin-mixtral"],
+        context_window=32768,
+        input_price=0.24,
+        output_price=0.24
     ),
     ModelBackend(
         model="gpt-3.5-turbo",
         supports_json=False,
         supports_tools=True,
         supports_functions=True,
-        client_config=BACKENDS[Backends.OPENAI]
+        client_config=BACKENDS[Backends.OPENAI],
+        context_window=16385,
+        input_price=0.5,
+        output_price=1.5
     ),
     ModelBackend(
         model="gpt-4-turbo",
         supports_json=False,
         supports_tools=True,
         supports_functions=True,
-        client_config=BACKENDS[Backends.OPENAI]
+        client_config=BACKENDS[Backends.OPENAI],
+        context_window=128000,
+        input_price=10.0,
+        output_price=30.0
     ),
     ModelBackend(
         model="gpt-4o",
         supports_json=False,
         supports_tools=True,
         supports_functions=True,
-        client_config=BACKENDS[Backends.OPENAI]
+        client_config=BACKENDS[Backends.OPENAI],
+        context_window=128000,
+        input_price=5.0,
+        output_price=15.0
     )
 ]
 
-def get_model(model_name):
-    for model in MODELS:
-        if model.model == model_name:
-            return model
-    return None
\ No newline at end of file
+class ModelRegistry:
+    """
+    Models indexed by name, alias, backend and capability
+    """
+
+    def __init__(self, models: list[ModelBackend] = None):
+        self.models: list[ModelBackend] = []
+        self.by_name: dict[str, ModelBackend] = {}
+        self.by_backend: dict[str, list[ModelBackend]] = {}
+        self.by_capability: dict[str, list[ModelBackend]] = {capability: [] for capability in ModelBackend.CAPABILITIES}
+        for model in models or []:
+            self.register(model)
+
+    def register(self, model: ModelBackend):
+        if model.model in self.by_name:
+            self.unregister(model.model)
+        self.models.append(model)
+        for name in [model.model, *model.aliases]:
+            self.by_name[name] = model
+        self.by_backend.setdefault(model.client_config.name, []).append(model)
+        for capability in model.capabilities():
+            self.by_capability[capability].append(model)
+
+    def unregister(self, model_name: str):
+        model = self.get(model_name)
+        self.models.remove(model)
+        self.by_name = {name: entry for name, entry in self.by_name.items() if entry is not model}
+        self.by_backend[model.client_config.name].remove(model)
+        for capability in model.capabilities():
+            self.by_capability[capability].remove(model)
+
+    def get(self, model_name: str) -> ModelBackend:
+        try:
+            return self.by_name[model_name]
+        except KeyError:
+            raise UnknownModelError(f"Unknown model `{model_name}`, known models: {', '.join(self.names())}") from None
+
+    def find(self, model_name: str) -> Optional[ModelBackend]:
+        return self.by_name.get(model_name)
+
+    def names(self) -> list[str]:
+        return [model.model for model in self.models]
+
+    def for_backend(self, backend: str) -> list[ModelBackend]:
+        return list(self.by_backend.get(backend, []))
+
+    def with_capability(self, *capabilities: str) -> list[ModelBackend]:
+        """Models that support all of the given capabilities e.g.: `with_capability("supports_json")`"""
+        if not capabilities:
+            return list(self.models)
+        first, *rest = capabilities
+        return [model for model in self.by_capability[first] if all(getattr(model, capability) for capability in rest)]
+
+    def __contains__(self, model_name: str):
+        return model_name in self.by_name
+
+    def __iter__(self):
+        return iter(self.models)
+
+    def __len__(self):
+        return len(self.models)
+
+def load_models(path: Optional[str] = None) -> list[ModelBackend]:
+    """
+    Load the models from a JSON or YAML file (`MODELS_CONFIG`), a list of `ModelBackend.to_dict` like entries.
+    Without a config file the default models are used.
+    """
+    path = path or bc.MODELS_CONFIG
+    if not path:
+        return list(DEFAULT_MODELS)
+    text = pathlib.Path(path).read_text()
+    if path.endswith((".yaml", ".yml")):
+        import yaml
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+    if isinstance(data, dict):
+        data = data["models"]
+    return [ModelBackend.from_dict(entry, BACKENDS) for entry in data]
+
+REGISTRY = ModelRegistry(load_models())
+MODELS = REGISTRY.models
+
+def get_model(model_name) -> ModelBackend:
+    return REGISTRY.get(model_name)
@@ -1,13 +1,12 @@
 from agent import complete_json
 import concurrent.futures
-from agent.paralel_json_complete import json_complete_paralel
-import json
-import yaml
-import pathlib
+from agent.paralel_json_complete import Quorum, json_complete_paralel, json_complete_paralel_async
+from agent.prompt_registry import PROMPTS
+from bot import config as bc
+from typing import Callable, Optional
 
-
-cur_path = pathlib.Path(__file__).parent.resolve()
-print("Current path:", cur_path)
+INTEND_PROMPT = "user_intend_v0.3"
+TOOLS_PROMPT = "tools_v0.2"
 
 
 def get_intend_task(
@@ -15,12 +14,8 @@ def get_intend_task(
     model: str,
     task_id: str
 ) -> complete_json.BaseTaskDescription:
-
-    with open(f"{cur_path}/prompts/user_intend_v0.3.yaml") as f:
-        data = yaml.safe_load(f)
-    
     return complete_json.BaseTaskDescription(**{
-        **data,
+        **PROMPTS.get(INTEND_PROMPT),
         'model': model,
         "prompt": prompt,
         "task_id": task_id
@@ -31,27 +26,19 @@ def get_tools(
     model: str,
     task_id: str
 ) -> list[complete_json.BaseTaskDescription]:
-    with open(f"{cur_path}/prompts/tools_v0.2.yaml") as f:
-        data = yaml.safe_load(f)
-        
-    tool_tasks = []
-    for tool in data["tools"]:
-        task_desc = complete_json.BaseTaskDescription(
+    # the tool prompts are rendered once by the registry
+    tool_tasks = [
+        complete_json.BaseTaskDescription(
             prompt=prompt,
-            schema=tool["schema"],
-            task_id=task_id + f"/{tool['name']}",
+            schema=tool.schema,
+            task_id=task_id + f"/{tool.name}",
             model=model,
-            refinement_schema_prompt=data["base_prompt"].format(
-                tool_name=tool["name"],
-                schema=json.dumps(tool["schema"], indent=4),
-                schema_example=tool["schema_example"]
-            )
-        )
-        tool_tasks.append(task_desc)
-    
-    return data, tool_tasks
+            refinement_schema_prompt=tool.refinement_schema_prompt
+        ) for tool in PROMPTS.tools(TOOLS_PROMPT)
+    ]
+    return PROMPTS.get(TOOLS_PROMPT), tool_tasks
 
-def intend_extract_paralel_json(
+def build_intend_extract_tasks(
     prompt: str,
     models: list[str],
     batch_size: int = 3
@@ -65,19 +52,45 @@ def intend_extract_paralel_json(
             tool_data, tools = get_tools(prompt, model, f"{model}/extract")
             extraction_tasks.extend(tools)
             
-    tasks = intend_tasks + extraction_tasks
-    out = json_complete_paralel(tasks)
-    
+    return tool_data, intend_tasks + extraction_tasks
+
+def intend_extract_quorum(
+    tool_data: dict,
+    tasks: list[complete_json.BaseTaskDescription],
+    k: Optional[int] = None
+) -> Optional[list[Quorum]]:
+    """
+    `k` agreeing intend votes (default a majority) and one valid extraction for the tool they picked,
+    the extractions of the other tools aren't waited for. None if early exit is disabled.
+    """
+    if not bc.AGENT_QUORUM_ENABLED:
+        return None
+    intend_votes = sum(1 for task in tasks if task.task_id.endswith("/intend"))
+    k = k or bc.INTEND_QUORUM or intend_votes // 2 + 1
+    tool_names = {tool["name"] for tool in tool_data["tools"]}
+    intend = Quorum("/intend", k, vote=lambda parsed: parsed.get("intend") if parsed.get("intend") in tool_names else None)
+    return [intend, Quorum("/extract/{winner}", 1, after=intend)]
+
+def pick_intend_extraction(
+    out: dict,
+    tool_data: dict
+):
     intends = []
     tool_winners = []
     tool_pick_counts = {tool["name"]: 0 for tool in tool_data["tools"]}
+    # intends that aren't one of the tools don't vote
+    unknown_intends = 0
     for task_id in out["winners"]:
         if "/intend" in task_id:
             intends.append({
                 "task_id": task_id,
                 "parsed": out["results"][task_id]["parsed"]
             })
-            tool_pick_counts[out["results"][task_id]["parsed"]["intend"]] += 1
+            intend = (out["results"][task_id]["parsed"] or {}).get("intend")
+            if intend in tool_pick_counts:
+                tool_pick_counts[intend] += 1
+            else:
+                unknown_intends += 1
         elif "/extract" in task_id:
             tool_winners.append({
                 "task_id": task_id,
@@ -86,7 +99,9 @@ def intend_extract_paralel_json(
             })
             
     print("Intends:", intends)
-    most_picked_tool = max(tool_pick_counts, key=tool_pick_counts.get)
+    # the quorum's pick if the fan-out stopped early, a later result may have tied it
+    quorum_pick = out.get("quorum", {}).get("/intend")
+    most_picked_tool = quorum_pick if quorum_pick in tool_pick_counts else max(tool_pick_counts, key=tool_pick_counts.get)
     print("Most picked tool:", most_picked_tool)
     extraction_for_tool = None
     for tool_winner in tool_winners:
@@ -96,8 +111,39 @@ def intend_extract_paralel_json(
     print("Extraction for tool:", extraction_for_tool)
     out["tool_pick"] = most_picked_tool
     out["extraction_pick"] = extraction_for_tool
+    out["unknown_intends"] = unknown_intends
     return out
 
+def intend_extract_paralel_json(
+    prompt: str,
+    models: list[str],
+    batch_size: int = 3,
+    quorum: Optional[int] = None
+):
+    tool_data, tasks = build_intend_extract_tasks(prompt, models, batch_size)
+    out = json_complete_paralel(tasks, quorum=intend_extract_quorum(tool_data, tasks, quorum))
+    return pick_intend_extraction(out, tool_data)
+
+async def intend_extract_paralel_json_async(
+    prompt: str,
+    models: list[str],
+    batch_size: int = 3,
+    max_concurrency: Optional[int] = None,
+    on_progress: Optional[Callable] = None,
+    quorum: Optional[int] = None
+):
+    """
+    Async version of `intend_extract_paralel_json`, see `json_complete_paralel_async`
+    """
+    tool_data, tasks = build_intend_extract_tasks(prompt, models, batch_size)
+    out = await json_complete_paralel_async(
+        tasks,
+        max_concurrency=max_concurrency,
+        on_progress=on_progress,
+        quorum=intend_extract_quorum(tool_data, tasks, quorum)
+    )
+    return pick_intend_extraction(out, tool_data)
+
 
 def intend_extract_respond_paralel_json(
     prompt: str,
@@ -116,33 +162,4 @@ def intend_extract_respond_paralel_json(
             
     tasks = intend_tasks + extraction_tasks
     out = json_complete_paralel(tasks)
-    
-    intends = []
-    tool_winners = []
-    tool_pick_counts = {tool["name"]: 0 for tool in tool_data["tools"]}
-    for task_id in out["winners"]:
-        if "/intend" in task_id:
-            intends.append({
-                "task_id": task_id,
-                "parsed": out["results"][task_id]["parsed"]
-            })
-            tool_pick_counts[out["results"][task_id]["parsed"]["intend"]] += 1
-        elif "/extract" in task_id:
-            tool_winners.append({
-                "task_id": task_id,
-                "tool": task_id.split("/")[-1],
-                "parsed": out["results"][task_id]["parsed"]
-            })
-            
-    print("Intends:", intends)
-    most_picked_tool = max(tool_pick_counts, key=tool_pick_counts.get)
-    print("Most picked tool:", most_picked_tool)
-    extraction_for_tool = None
-    for tool_winner in tool_winners:
-        if tool_winner["tool"] == most_picked_tool:
-            extraction_for_tool = tool_winner
-            break
-    print("Extraction for tool:", extraction_for_tool)
-    out["tool_pick"] = most_picked_tool
-    out["extraction_pick"] = extraction_for_tool
-    return out
\ No newline at end of file
+    return pick_intend_extraction(out, tool_data)
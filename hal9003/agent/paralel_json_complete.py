@@ -1,7 +1,14 @@
 import time
+import json
+import asyncio
+import inspect
 import concurrent.futures
-from agent.complete_json import BaseTaskDescription, complete_json
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+from agent.complete_json import BaseTaskDescription, complete_json, complete_json_async
+from agent.latency import complete_json_hedged, complete_json_hedged_async
 from tabulate import tabulate
+from bot import config as bc
 
 def timed(func):
     def _w(*a, **k):
@@ -11,25 +18,73 @@ def timed(func):
         return elapsed, res
     return _w
 
-def json_complete_paralel(
-    task_descriptions: list[BaseTaskDescription],
-    task_id: str = "paralel-try-0"
+def timed_async(func):
+    async def _w(*a, **k):
+        then = time.time()
+        res = await func(*a, **k)
+        elapsed = time.time() - then
+        return elapsed, res
+    return _w
+
+def canonical_vote(parsed: dict) -> str:
+    return json.dumps(parsed, sort_keys=True)
+
+@dataclass
+class Quorum:
+    """
+    `k` valid results of a task group agreeing on the same `vote(parsed)`, a None vote doesn't count.
+    The group are the tasks whose (prepared) task id ends with `group`.
+    With `after` the group depends on the winner of that quorum, `{winner}` in `group` is replaced by it
+    e.g.: `Quorum("/extract/{winner}", 1, after=intend_quorum)` waits for the picked tool only.
+    """
+    group: str
+    k: int
+    vote: Callable[[dict], Any] = canonical_vote
+    after: Optional["Quorum"] = None
+
+    def winner(self, results: list) -> Optional[Any]:
+        group = self.group
+        if self.after is not None:
+            after = self.after.winner(results)
+            if after is None:
+                return None
+            group = group.format(winner=after)
+        votes = {}
+        for _, result in results:
+            if result.task_id.endswith(group) and result.parsable and result.valid:
+                vote = self.vote(result.parsed)
+                # e.g.: an intend that isn't one of the tools
+                if vote is None:
+                    continue
+                votes[vote] = votes.get(vote, 0) + 1
+                if votes[vote] >= self.k:
+                    return vote
+        return None
+
+def quorum_reached(quorum: Optional[list[Quorum]], results: list) -> bool:
+    return bool(quorum) and all(q.winner(results) is not None for q in quorum)
+
+def prepare_tasks(
+    task_descriptions: list[BaseTaskDescription]
 ):
     task_by_id = {}
     for i, task_description in enumerate(task_descriptions):
         task_description.task_id = f"task-{i}/" + (task_description.task_id or task_description.model)
         task_by_id[task_description.task_id] = task_description.to_dict()
+    return task_by_id
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(task_descriptions)) as executor:
-        futures = [executor.submit(timed(complete_json), task) for task in task_descriptions]
-
-        results = [future.result() for future in futures]
-        models_res = {}
-        for elapsed, result in results:
-            models_res[result.task_id] = {
-                **(result.to_dict()),
-                "elapsed": elapsed
-            }
+def summarize_results(
+    task_by_id: dict,
+    results: list,
+    task_id: str,
+    quorum: Optional[list[Quorum]] = None
+):
+    models_res = {}
+    for elapsed, result in results:
+        models_res[result.task_id] = {
+            **(result.to_dict()),
+            "elapsed": elapsed
+        }
 
     table = []
     winners = []
@@ -37,13 +92,86 @@ def json_complete_paralel(
         res = models_res[task]
         if res["valid"] and res["parsable"]:
             winners.append(task)
-        row = [task, len(res["response"]), res["parsable"], res["valid"], res["elapsed"], res["temperature"]]
+        # a hedge answers in place of the task's model
+        row = [task, res["model"], len(res["response"]), res["parsable"], res["valid"], res["elapsed"], res["temperature"]]
         table.append(row)
-    print(tabulate(table, headers=["Model", "Response length", "Parsable", "Valid json", "Time elapsed", "Temp"]))
-        
+    print(tabulate(table, headers=["Model", "Answered by", "Response length", "Parsable", "Valid json", "Time elapsed", "Temp"]))
+
     return {
         "task_descriptions": task_by_id,
         "results": models_res,
         "winners": winners,
-        "task_id": task_id
-    }
\ No newline at end of file
+        "task_id": task_id,
+        "quorum": {q.group: q.winner(results) for q in quorum or []},
+        # tasks dropped because the quorum was reached before they finished
+        "cancelled": [task for task in task_by_id if task not in models_res]
+    }
+
+def json_complete_paralel(
+    task_descriptions: list[BaseTaskDescription],
+    task_id: str = "paralel-try-0",
+    quorum: Optional[list[Quorum]] = None
+):
+    """
+    Completes all tasks in threads, with a `quorum` it returns as soon as every quorum is reached.
+    Requests that already run can't be aborted from here, they finish in the background and their
+    results are dropped, so this only saves time. `json_complete_paralel_async` also saves their tokens.
+    """
+    task_by_id = prepare_tasks(task_descriptions)
+
+    # more workers than pooled connections would only queue in the limiter
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(min(len(task_descriptions), bc.LLM_MAX_CONNECTIONS), 1))
+    try:
+        futures = [executor.submit(timed(complete_json_hedged), task, complete=complete_json) for task in task_descriptions]
+
+        results = []
+        for future in concurrent.futures.as_completed(futures):
+            results.append(future.result())
+            if quorum_reached(quorum, results):
+                break
+    finally:
+        # don't wait for the stragglers
+        executor.shutdown(wait=not quorum, cancel_futures=True)
+
+    return summarize_results(task_by_id, results, task_id, quorum)
+
+async def json_complete_paralel_async(
+    task_descriptions: list[BaseTaskDescription],
+    task_id: str = "paralel-try-0",
+    max_concurrency: Optional[int] = None,
+    on_progress: Optional[Callable] = None,
+    quorum: Optional[list[Quorum]] = None
+):
+    """
+    Async version of `json_complete_paralel`, at most `max_concurrency` completions run at the same time.
+    `on_progress(done, total, result)` is called (or awaited) after every finished task.
+    Once the `quorum` is reached the remaining completions are cancelled, queued ones never start.
+    """
+    task_by_id = prepare_tasks(task_descriptions)
+    semaphore = asyncio.Semaphore(max_concurrency or bc.AGENT_MAX_CONCURRENCY)
+    total = len(task_descriptions)
+    done = 0
+
+    async def _complete(task):
+        nonlocal done
+        async with semaphore:
+            elapsed, result = await timed_async(complete_json_hedged_async)(task, complete=complete_json_async)
+        done += 1
+        if on_progress:
+            progress = on_progress(done, total, result)
+            if inspect.isawaitable(progress):
+                await progress
+        return elapsed, result
+
+    pending = {asyncio.ensure_future(_complete(task)) for task in task_descriptions}
+    results = []
+    try:
+        while pending and not quorum_reached(quorum, results):
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            results.extend(future.result() for future in finished)
+    finally:
+        for future in pending:
+            future.cancel()
+        if pending:
+            await asyncio.wait(pending)
+    return summarize_results(task_by_id, results, task_id, quorum)
@@ -0,0 +1,154 @@
+import copy
+import json
+import time
+import pathlib
+import threading
+from dataclasses import dataclass, field, replace
+from typing import Optional
+import yaml
+import jsonschema
+from agent.validation import VALIDATORS
+from bot import config as bc
+
+PROMPTS_DIR = pathlib.Path(__file__).parent.resolve() / "prompts"
+
+class PromptError(ValueError):
+    pass
+
+@dataclass
+class ToolTemplate:
+    name: str
+    schema: dict
+    # `base_prompt` rendered for this tool, only the user prompt differs between tasks
+    refinement_schema_prompt: str
+
+@dataclass
+class PromptFile:
+    name: str
+    path: pathlib.Path
+    mtime: float
+    data: dict
+    tools: list[ToolTemplate] = field(default_factory=list)
+
+def check_schema(schema: dict, where: str):
+    """Checks the schema against its metaschema, its validator is compiled once and kept by `VALIDATORS`"""
+    try:
+        VALIDATORS.get(schema)
+    except jsonschema.SchemaError as ex:
+        raise PromptError(f"Invalid schema in {where}: {ex.message}") from None
+
+def load_prompt_file(path: pathlib.Path) -> PromptFile:
+    """
+    Parses a prompt file, either a task (`refinement_schema_prompt` or `schema_description` & `schema`)
+    or a tool list (`base_prompt` & `tools`)
+    """
+    mtime = path.stat().st_mtime
+    try:
+        data = yaml.safe_load(path.read_text())
+    except yaml.YAMLError as ex:
+        raise PromptError(f"Can't parse {path.name}: {ex}") from None
+    if not isinstance(data, dict):
+        raise PromptError(f"{path.name} must contain a mapping")
+    prompt = PromptFile(name=path.stem, path=path, mtime=mtime, data=data)
+    if "tools" in data:
+        if "base_prompt" not in data:
+            raise PromptError(f"{path.name} has tools but no `base_prompt`")
+        for tool in data["tools"]:
+            missing = [key for key in ("name", "schema", "schema_example") if key not in tool]
+            if missing:
+                raise PromptError(f"Tool `{tool.get('name')}` in {path.name} misses {', '.join(missing)}")
+            try:
+                rendered = data["base_prompt"].format(
+                    tool_name=tool["name"],
+                    schema=json.dumps(tool["schema"], indent=4),
+                    schema_example=tool["schema_example"]
+                )
+            except (KeyError, IndexError) as ex:
+                raise PromptError(f"Unknown placeholder {ex} in the `base_prompt` of {path.name}") from None
+            prompt.tools.append(ToolTemplate(
+                name=tool["name"],
+                schema=tool["schema"],
+                refinement_schema_prompt=rendered
+            ))
+            check_schema(tool["schema"], f"{path.name}/{tool['name']}")
+    else:
+        if not (data.get("refinement_schema_prompt") or data.get("schema_description")):
+            raise PromptError(f"{path.name} needs a `refinement_schema_prompt` or `schema_description`")
+        check_schema(data.get("schema", {}), path.name)
+    return prompt
+
+class PromptRegistry:
+    """
+    The YAML prompts under `agent/prompts/` parsed, checked and rendered once.
+    A changed file is reloaded on its next use (checked at most every `reload_interval` seconds),
+    if the new version is broken the previous one stays in use.
+    """
+
+    def __init__(self, directory: Optional[pathlib.Path] = None, reload_interval: float = None):
+        self.directory = pathlib.Path(directory or PROMPTS_DIR)
+        self.reload_interval = bc.PROMPTS_RELOAD_INTERVAL if reload_interval is None else reload_interval
+        self.files: dict[str, PromptFile] = {}
+        self.checked: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+        self.loaded = False
+        self.reloads = 0
+        self.lock = threading.Lock()
+
+    def load_all(self):
+        with self.lock:
+            for path in sorted(self.directory.glob("*.yaml")):
+                self.load(path)
+            self.loaded = True
+
+    def load(self, path: pathlib.Path) -> Optional[PromptFile]:
+        try:
+            prompt = load_prompt_file(path)
+        except (OSError, PromptError) as ex:
+            # broken files don't block the others, they fail when they are used
+            self.errors[path.stem] = str(ex)
+            print("Prompt not loaded:", ex)
+            return None
+        self.errors.pop(path.stem, None)
+        self.files[prompt.name] = prompt
+        self.checked[prompt.name] = time.monotonic()
+        return prompt
+
+    def file(self, name: str) -> PromptFile:
+        if not self.loaded:
+            self.load_all()
+        prompt = self.files.get(name)
+        if prompt is not None and self.reload_interval >= 0 and time.monotonic() - self.checked[name] > self.reload_interval:
+            with self.lock:
+                self.checked[name] = time.monotonic()
+                try:
+                    changed = prompt.path.stat().st_mtime != prompt.mtime
+                except OSError:
+                    changed = False
+                if changed and self.load(prompt.path) is not None:
+                    self.reloads += 1
+                prompt = self.files[name]
+        if prompt is None:
+            path = self.directory / f"{name}.yaml"
+            with self.lock:
+                prompt = self.load(path) if path.exists() else None
+            if prompt is None:
+                raise PromptError(self.errors.get(name) or f"Unknown prompt `{name}` in {self.directory}")
+        return prompt
+
+    def get(self, name: str) -> dict:
+        """A copy of the parsed prompt file, the loaded one is shared by every task"""
+        return copy.deepcopy(self.file(name).data)
+
+    def tools(self, name: str) -> list[ToolTemplate]:
+        """The rendered tools, with a copy of their schema"""
+        return [replace(tool, schema=copy.deepcopy(tool.schema)) for tool in self.file(name).tools]
+
+    def to_dict(self):
+        return {
+            "directory": str(self.directory),
+            "prompts": sorted(self.files),
+            "reloads": self.reloads,
+            "errors": self.errors
+        }
+
+PROMPTS = PromptRegistry()
@@ -0,0 +1,124 @@
+import json
+import time
+import sqlite3
+import hashlib
+import pathlib
+import threading
+from typing import Optional
+from bot.cache import LRUCache
+from bot import config as bc
+
+class CacheMode:
+    OFF = "off"
+    # read cached results, store new ones, only deterministic (temperature 0) tasks use the cache
+    ON = "on"
+    # always call the model and store every result, also sampled ones
+    RECORD = "record"
+    # only serve stored results, a miss raises `ResultCacheMiss`, for offline runs
+    REPLAY = "replay"
+
+class ResultCacheMiss(KeyError):
+    pass
+
+def task_key(task) -> str:
+    """Content address of a task, the `task_id` is only a label and not part of it"""
+    data = {
+        "model": task.model,
+        "prompt": task.prompt,
+        "schema": task.schema,
+        "schema_description": task.schema_description,
+        "refinement_schema_prompt": task.refinement_schema_prompt,
+        "temperature": task.temperature
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """
+    `TaskResult`s of `complete_json` by task content, a SQLite file with an in-memory LRU in front.
+    Safe to use from the worker threads of `json_complete_paralel`.
+    """
+
+    def __init__(self, path: Optional[str] = None, mode: Optional[str] = None, memory_size: int = None):
+        self.path = bc.AGENT_RESULT_CACHE_PATH if path is None else path
+        self.mode = mode or bc.AGENT_RESULT_CACHE_MODE
+        self.memory = LRUCache(maxsize=memory_size or bc.AGENT_RESULT_CACHE_MEMORY, ttl=0)
+        self.lock = threading.Lock()
+        self.connection = None
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.bypassed = 0
+
+    def db(self) -> Optional[sqlite3.Connection]:
+        if self.connection is None and self.path:
+            pathlib.Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, model TEXT, result TEXT, created REAL)"
+            )
+            self.connection.commit()
+        return self.connection
+
+    def enabled_for(self, task) -> bool:
+        if self.mode == CacheMode.OFF:
+            return False
+        # a sampled answer (temperature unset or > 0) should be sampled again, e.g.: the copies of a k-of-n vote
+        return self.mode != CacheMode.ON or task.temperature == 0 or bc.AGENT_RESULT_CACHE_SAMPLED
+
+    def get(self, task) -> Optional[dict]:
+        """The cached `TaskResult.to_dict` of the task, None if it must be completed"""
+        if self.mode == CacheMode.RECORD or not self.enabled_for(task):
+            self.bypassed += 1
+            return None
+        key = task_key(task)
+        with self.lock:
+            result = self.memory.get(key)
+            if result is not None:
+                self.memory_hits += 1
+            elif self.db() is not None:
+                row = self.db().execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+                if row:
+                    result = json.loads(row[0])
+                    self.memory.set(key, result)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if result is None and self.mode == CacheMode.REPLAY:
+            raise ResultCacheMiss(f"No recorded result for task `{task.task_id}` ({task.model})")
+        return result
+
+    def put(self, task, result: dict):
+        if self.mode == CacheMode.REPLAY or not self.enabled_for(task):
+            return
+        key = task_key(task)
+        with self.lock:
+            self.memory.set(key, result)
+            if self.db() is not None:
+                self.db().execute(
+                    "INSERT OR REPLACE INTO results (key, model, result, created) VALUES (?, ?, ?, ?)",
+                    (key, task.model, json.dumps(result), time.time())
+                )
+                self.db().commit()
+            self.stores += 1
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db() is not None:
+                self.db().execute("DELETE FROM results")
+                self.db().commit()
+
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "path": self.path,
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "bypassed": self.bypassed
+        }
+
+RESULT_CACHE = ResultCache()
@@ -0,0 +1,48 @@
+import asyncio
+import inspect
+import importlib
+import openai
+from agent.clients import ClientRegistry
+from agent.models import BackendConfig
+
+# the http library the installed openai client is built on, httpx or a fork of it
+http = importlib.import_module(inspect.getmodule(openai.DefaultHttpxClient.__bases__[0]).__name__.split(".")[0])
+BACKEND = BackendConfig(api_key="key", name="test", base_url="http://llm.test/v1")
+
+
+def list_models(request):
+    return http.Response(200, json={"object": "list", "data": []})
+
+def test_one_client_per_backend():
+    registry = ClientRegistry()
+    client = registry.get_client(BACKEND)
+
+    assert registry.get_client(BackendConfig(api_key="key", name="test", base_url="http://llm.test/v1")) is client
+    assert registry.get_client(BackendConfig(api_key="other", name="test", base_url="http://llm.test/v1")) is not client
+    assert registry.to_dict()["backends"]["test"]["clients"] == 2
+
+def test_one_async_client_per_event_loop():
+    registry = ClientRegistry()
+
+    async def _clients():
+        return registry.get_async_client(BACKEND), registry.get_async_client(BACKEND)
+
+    first, same = asyncio.run(_clients())
+    other, _ = asyncio.run(_clients())
+    assert first is same
+    # the pool of a finished loop can't be reused
+    assert other is not first
+    assert registry.stats["test"].clients == 2
+
+def test_requests_counted_per_backend():
+    http_client = openai.DefaultHttpxClient(transport=http.MockTransport(list_models))
+    registry = ClientRegistry(http_client=http_client)
+    client = registry.get_client(BACKEND)
+    other = registry.get_client(BackendConfig(api_key="key", name="other", base_url="http://other.test/v1"))
+    for _ in range(3):
+        client.models.list()
+    other.models.list()
+
+    # the mock transport opens no connections, every request counts as reused
+    assert registry.to_dict()["backends"]["test"] == {"clients": 1, "requests": 3, "connections": 0, "reused": 3}
+    assert registry.stats["other"].requests == 1
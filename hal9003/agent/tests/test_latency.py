@@ -0,0 +1,76 @@
+import time
+import asyncio
+from agent import latency
+from agent.complete_json import BaseTaskDescription, timed_request
+from agent.latency import HedgePolicy, LatencyTracker, complete_json_hedged_async, percentile
+
+LLAMA = "meta-llama/Meta-Llama-3-70B-Instruct"
+
+
+def test_percentiles():
+    samples = [float(i) for i in range(1, 101)]
+    assert (percentile(samples, 50), percentile(samples, 95), percentile(samples, 99)) == (50, 95, 99)
+    assert percentile([], 95) is None
+
+def test_slow_request_is_hedged_within_budget():
+    tracker = LatencyTracker()
+    for _ in range(20):
+        tracker.record(LLAMA, 0.01)
+    policy = HedgePolicy(tracker, budget=1.0, min_samples=10, enabled=True)
+    cancelled = []
+
+    async def _complete(task, on_request=None):
+        if on_request:
+            on_request()
+        try:
+            await asyncio.sleep(5 if task.model == LLAMA else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(task.model)
+            raise
+        return task.model
+
+    async def _run():
+        task = BaseTaskDescription(model=LLAMA, schema_description="{}")
+        return [await complete_json_hedged_async(task, policy, _complete) for _ in range(2)]
+
+    assert asyncio.run(_run()) == ["gpt-3.5-turbo", "gpt-3.5-turbo"]
+    assert cancelled == [LLAMA, LLAMA]
+    assert policy.to_dict()["hedge_wins"] == 2
+
+def test_hedge_timer_starts_when_the_request_is_sent():
+    tracker = LatencyTracker()
+    for _ in range(20):
+        tracker.record(LLAMA, 0.05)
+    policy = HedgePolicy(tracker, budget=1.0, min_samples=10, enabled=True)
+    completed = []
+
+    async def _complete(task, on_request=None):
+        # queued by the limiter for longer than the p95, the request itself is fast
+        await asyncio.sleep(0.2)
+        on_request()
+        await asyncio.sleep(0.01)
+        completed.append(task.model)
+        return task.model
+
+    task = BaseTaskDescription(model=LLAMA, schema_description="{}")
+    assert asyncio.run(complete_json_hedged_async(task, policy, _complete)) == LLAMA
+    assert completed == [LLAMA] and policy.hedges == 0
+
+def test_latency_recorded_around_the_request_only(monkeypatch):
+    tracker = LatencyTracker()
+    monkeypatch.setattr(latency, "TRACKER", tracker)
+    sent = []
+
+    def _request():
+        time.sleep(0.05)
+        return "response"
+
+    assert timed_request(LLAMA, _request, on_request=lambda: sent.append(True)) == "response"
+    assert sent == [True]
+    samples = tracker.samples[latency.latency_key(LLAMA)]
+    assert len(samples) == 1 and 0.05 <= samples[0] < 0.5
+
+def test_hedge_budget_is_a_share_of_requests():
+    policy = HedgePolicy(LatencyTracker(), budget=0.25, enabled=True)
+    policy.requests = 8
+    assert [policy.take_budget() for _ in range(3)] == [True, True, False]
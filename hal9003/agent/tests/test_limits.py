@@ -0,0 +1,112 @@
+import time
+import asyncio
+import threading
+import httpx
+import openai
+import pytest
+from agent.models import BackendConfig
+from agent.limits import RateLimiter, TokenBucket, retry_after
+
+BACKEND = BackendConfig(api_key="", name="test")
+
+
+def rate_limited(headers):
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "http://llm/v1/chat/completions"))
+    return openai.RateLimitError("Too many requests", response=response, body=None)
+
+def test_retry_after_headers():
+    assert retry_after(rate_limited({"retry-after": "2"})) == 2
+    assert retry_after(rate_limited({"retry-after-ms": "150"})) == 0.15
+    assert retry_after(rate_limited({})) is None
+
+def test_token_bucket_waits_once_empty():
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.reserve(60) == 0
+    assert 0.9 < bucket.reserve(1) <= 1
+
+def test_rate_limited_requests_are_retried_after_the_server_delay():
+    limiter = RateLimiter(max_in_flight=2, max_retries=2, backoff=0.001)
+    attempts = []
+
+    def _create():
+        attempts.append(time.monotonic())
+        if len(attempts) < 2:
+            raise rate_limited({"retry-after": "0.1"})
+        return "ok"
+
+    assert limiter.call(BACKEND, _create) == "ok"
+    assert attempts[1] - attempts[0] >= 0.1
+    assert limiter.to_dict()["backends"]["test"]["retries"] == 1
+
+def test_in_flight_limit_is_shared_by_threads_and_coroutines():
+    limiter = RateLimiter(max_in_flight=2)
+    active, peak = 0, 0
+    lock = threading.Lock()
+
+    def _enter():
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+
+    def _leave():
+        nonlocal active
+        with lock:
+            active -= 1
+
+    def _sync():
+        _enter()
+        time.sleep(0.02)
+        _leave()
+
+    async def _async():
+        _enter()
+        await asyncio.sleep(0.02)
+        _leave()
+
+    async def _run():
+        threads = [threading.Thread(target=limiter.call, args=(BACKEND, _sync)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        await asyncio.gather(*[limiter.call_async(BACKEND, _async) for _ in range(4)])
+        for thread in threads:
+            await asyncio.to_thread(thread.join)
+
+    asyncio.run(_run())
+    assert peak == 2 and limiter.in_flight.active == 0
+
+def test_slot_released_while_backing_off():
+    limiter = RateLimiter(max_in_flight=1, max_retries=1, backoff=0.001)
+    attempts = []
+
+    def _create():
+        attempts.append("retried")
+        if len(attempts) == 1:
+            raise rate_limited({"retry-after": "0.2"})
+        return "ok"
+
+    def _other():
+        attempts.append("other")
+        return "ok"
+
+    thread = threading.Thread(target=limiter.call, args=(BACKEND, _create))
+    thread.start()
+    time.sleep(0.05)
+    # the only slot is free while the first request waits for its retry
+    then = time.monotonic()
+    assert limiter.call(BACKEND, _other) == "ok"
+    assert time.monotonic() - then < 0.1
+    thread.join()
+    assert attempts == ["retried", "other", "retried"]
+
+def test_long_retry_after_fails_fast():
+    limiter = RateLimiter(max_retries=3, max_backoff=1)
+
+    def _create():
+        raise rate_limited({"retry-after": "60"})
+
+    then = time.monotonic()
+    with pytest.raises(openai.RateLimitError):
+        limiter.call(BACKEND, _create)
+    assert time.monotonic() - then < 0.5
+    assert limiter.to_dict()["backends"]["test"] == {"requests": 1, "retries": 0, "failed": 1, "throttled": 0}
@@ -0,0 +1,60 @@
+import json
+import pytest
+from agent.models import BACKENDS, Backends, ModelBackend, ModelRegistry, UnknownModelError, load_models
+
+
+def make_model(name, backend=Backends.OPENAI, aliases=(), **capabilities):
+    return ModelBackend(
+        model=name,
+        supports_json=capabilities.get("supports_json", False),
+        supports_tools=capabilities.get("supports_tools", False),
+        supports_functions=capabilities.get("supports_functions", False),
+        client_config=BACKENDS[backend],
+        aliases=list(aliases)
+    )
+
+def make_registry():
+    return ModelRegistry([
+        make_model("gpt", supports_tools=True, supports_json=True),
+        make_model("llama", Backends.DEEPINFRA, aliases=["llama-70b"], supports_json=True),
+        make_model("dbrx", Backends.DEEPINFRA)
+    ])
+
+def test_lookup_by_name_and_alias():
+    registry = make_registry()
+
+    assert registry.get("llama-70b") is registry.get("llama")
+    assert "llama-70b" in registry and registry.find("mistral") is None
+    with pytest.raises(UnknownModelError, match="known models: gpt, llama, dbrx"):
+        registry.get("mistral")
+
+def test_lookup_by_backend_and_capability():
+    registry = make_registry()
+
+    assert [model.model for model in registry.for_backend(Backends.DEEPINFRA)] == ["llama", "dbrx"]
+    assert [model.model for model in registry.with_capability("supports_json")] == ["gpt", "llama"]
+    assert [model.model for model in registry.with_capability("supports_json", "supports_tools")] == ["gpt"]
+
+def test_register_replaces_model_and_its_aliases():
+    registry = make_registry()
+    registry.register(make_model("llama", Backends.OPENAI))
+
+    assert "llama-70b" not in registry
+    assert [model.model for model in registry.for_backend(Backends.DEEPINFRA)] == ["dbrx"]
+    assert [model.model for model in registry.with_capability("supports_json")] == ["gpt"]
+    assert len(registry) == 3
+
+def test_models_config_loaded(tmp_path):
+    path = tmp_path / "models.json"
+    path.write_text(json.dumps({"models": [
+        {"model": "llama", "backend": Backends.DEEPINFRA, "aliases": ["l"], "supports_json": True, "input_price": 1, "output_price": 2}
+    ]}))
+    model, = load_models(str(path))
+
+    assert model.client_config is BACKENDS[Backends.DEEPINFRA]
+    assert model.capabilities() == ["supports_json"]
+    assert model.estimate_cost(1_000_000, 500_000) == 2
+
+    path.write_text(json.dumps([{"model": "llama", "backend": "unknown"}]))
+    with pytest.raises(ValueError, match="Unknown backend `unknown`"):
+        load_models(str(path))
@@ -0,0 +1,30 @@
+import asyncio
+from agent import paralel_json_complete
+from agent.complete_json import BaseTaskDescription, TaskResult
+from agent.paralel_json_complete import json_complete_paralel_async
+
+
+def test_async_concurrency_bounded_and_progress_reported(monkeypatch):
+    running = 0
+    peak = 0
+    progress = []
+
+    async def _complete(task):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return TaskResult("", "{}", True, True, {}, None, task.task_id)
+
+    async def _on_progress(done, total, result):
+        progress.append((done, total, result.task_id))
+
+    monkeypatch.setattr(paralel_json_complete, "complete_json_async", _complete)
+    tasks = [BaseTaskDescription(model=f"model-{i}", schema_description="{}") for i in range(7)]
+    out = asyncio.run(json_complete_paralel_async(tasks, max_concurrency=3, on_progress=_on_progress))
+
+    assert peak == 3
+    assert [(done, total) for done, total, _ in progress] == [(i, 7) for i in range(1, 8)]
+    assert sorted(task_id for _, _, task_id in progress) == sorted(out["results"])
+    assert len(out["winners"]) == 7 and out["cancelled"] == []
@@ -0,0 +1,55 @@
+import os
+import pytest
+from agent.prompt_registry import PromptError, PromptRegistry
+from agent.validation import VALIDATORS, validation_errors
+
+TOOLS = """base_prompt: |
+  Extract the parameters of "{tool_name}": {schema}
+  Example: {schema_example}
+tools:
+  - name: search_web
+    schema:
+      type: object
+      properties:
+        query:
+          type: string
+    schema_example: '{"query": "..."}'
+"""
+
+
+def test_tools_are_rendered_once_and_reloaded_when_changed(tmp_path):
+    path = tmp_path / "tools.yaml"
+    path.write_text(TOOLS)
+    registry = PromptRegistry(tmp_path, reload_interval=0)
+
+    tool, = registry.tools("tools")
+    assert 'Extract the parameters of "search_web": {\n    "type": "object"' in tool.refinement_schema_prompt
+    assert registry.tools("tools")[0].refinement_schema_prompt is tool.refinement_schema_prompt
+    # compiled when the file was loaded
+    assert VALIDATORS.get(tool.schema) is VALIDATORS.get(tool.schema)
+
+    path.write_text(TOOLS.replace("search_web", "search_news"))
+    os.utime(path, (path.stat().st_atime, path.stat().st_mtime + 1))
+    assert registry.tools("tools")[0].name == "search_news"
+
+    # a broken edit keeps the last good version
+    path.write_text(TOOLS.replace("{tool_name}", "{tool}"))
+    os.utime(path, (path.stat().st_atime, path.stat().st_mtime + 2))
+    assert registry.tools("tools")[0].name == "search_news"
+    assert "tools" in registry.to_dict()["errors"]
+
+def test_invalid_schema_is_reported(tmp_path):
+    (tmp_path / "intend.yaml").write_text("refinement_schema_prompt: Pick one\nschema:\n  type: 12\n")
+    with pytest.raises(PromptError, match="Invalid schema"):
+        PromptRegistry(tmp_path).get("intend")
+
+def test_prompt_data_is_copied(tmp_path):
+    (tmp_path / "intend.yaml").write_text("refinement_schema_prompt: Pick one\nschema:\n  type: object\n  required: [intend]\n")
+    registry = PromptRegistry(tmp_path)
+    data = registry.get("intend")
+
+    data["schema"]["required"].append("tool")
+    assert validation_errors({"intend": "casual"}, data["schema"]) == ["<root>: 'tool' is a required property"]
+    # the loaded prompt and its cached validator are unchanged
+    assert registry.get("intend")["schema"]["required"] == ["intend"]
+    assert validation_errors({"intend": "casual"}, registry.get("intend")["schema"]) == []
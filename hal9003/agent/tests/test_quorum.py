@@ -0,0 +1,89 @@
+import time
+import asyncio
+from agent import paralel_json_complete, paralel_intend_and_extract
+from agent.complete_json import BaseTaskDescription, TaskResult
+from agent.paralel_json_complete import Quorum, json_complete_paralel, json_complete_paralel_async
+
+# seconds each fake completion takes and the intend it votes for
+ANSWERS = {"a": (0.01, "casual"), "b": (0.02, "casual"), "c": (0.03, "knowledge"), "d": (5, "knowledge")}
+
+
+def make_tasks():
+    return [BaseTaskDescription(model=name, schema_description="{}", task_id=f"{name}/intend") for name in ANSWERS]
+
+def fake_result(task):
+    delay, intend = ANSWERS[task.model]
+    return delay, TaskResult("", f"{{\"intend\": \"{intend}\"}}", True, True, {"intend": intend}, None, task.task_id)
+
+def test_async_quorum_cancels_stragglers(monkeypatch):
+    cancelled = []
+
+    async def _complete(task):
+        delay, result = fake_result(task)
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            cancelled.append(task.model)
+            raise
+        return result
+
+    monkeypatch.setattr(paralel_json_complete, "complete_json_async", _complete)
+    then = time.time()
+    out = asyncio.run(json_complete_paralel_async(make_tasks(), quorum=[Quorum("/intend", 2, vote=lambda parsed: parsed["intend"])]))
+
+    assert time.time() - then < 1
+    assert out["quorum"] == {"/intend": "casual"}
+    assert out["cancelled"] == ["task-2/c/intend", "task-3/d/intend"] and sorted(cancelled) == ["c", "d"]
+
+def test_sync_quorum_returns_without_waiting(monkeypatch):
+    def _complete(task):
+        delay, result = fake_result(task)
+        time.sleep(min(delay, 1))
+        return result
+
+    monkeypatch.setattr(paralel_json_complete, "complete_json", _complete)
+    then = time.time()
+    out = json_complete_paralel(make_tasks(), quorum=[Quorum("/intend", 2, vote=lambda parsed: parsed["intend"])])
+
+    assert time.time() - then < 0.5
+    assert out["winners"] == ["task-0/a/intend", "task-1/b/intend"]
+
+def test_extraction_quorum_follows_the_intend_winner(monkeypatch):
+    monkeypatch.setattr(paralel_intend_and_extract.bc, "AGENT_QUORUM_ENABLED", True)
+    # the extraction of the tool nobody picked never finishes
+    delays = {"a/extract/casual": 0.05, "a/extract/knowledge": 5}
+
+    async def _complete(task):
+        if task.task_id.endswith("/intend"):
+            delay, result = fake_result(task)
+        else:
+            delay = delays[task.task_id.split("/", 1)[1]]
+            result = TaskResult("", "{}", True, True, {}, None, task.task_id)
+        await asyncio.sleep(delay)
+        return result
+
+    monkeypatch.setattr(paralel_json_complete, "complete_json_async", _complete)
+    tasks = make_tasks() + [BaseTaskDescription(model="a", schema_description="{}", task_id=f"a/extract/{tool}") for tool in ("casual", "knowledge")]
+    quorum = paralel_intend_and_extract.intend_extract_quorum({"tools": [{"name": "casual"}, {"name": "knowledge"}]}, tasks, k=2)
+    then = time.time()
+    out = asyncio.run(json_complete_paralel_async(tasks, quorum=quorum))
+
+    assert time.time() - then < 1
+    assert out["quorum"] == {"/intend": "casual", "/extract/{winner}": "{}"}
+    assert "task-5/a/extract/knowledge" in out["cancelled"]
+
+def test_unknown_intends_do_not_vote(monkeypatch):
+    monkeypatch.setattr(paralel_intend_and_extract.bc, "AGENT_QUORUM_ENABLED", True)
+    tool_data = {"tools": [{"name": "casual"}, {"name": "knowledge"}]}
+    results = {
+        "a/intend": {"parsed": {"intend": "weather"}},
+        "b/intend": {"parsed": {"intend": "weather"}},
+        "c/intend": {"parsed": {"intend": "knowledge"}},
+        "c/extract/knowledge": {"parsed": {"query": "?"}}
+    }
+    out = paralel_intend_and_extract.pick_intend_extraction({"winners": list(results), "results": results, "quorum": {"/intend": "weather"}}, tool_data)
+
+    assert out["tool_pick"] == "knowledge" and out["unknown_intends"] == 2
+    assert out["extraction_pick"]["task_id"] == "c/extract/knowledge"
+    votes = [(0, TaskResult("", "", True, True, {"intend": intend}, None, f"{name}/intend")) for name, intend in [("a", "weather"), ("b", "weather"), ("c", "casual")]]
+    assert paralel_intend_and_extract.intend_extract_quorum(tool_data, make_tasks(), k=2)[0].winner(votes) is None
@@ -0,0 +1,30 @@
+import pytest
+from agent.complete_json import BaseTaskDescription
+from agent.result_cache import ResultCache, ResultCacheMiss, CacheMode
+
+
+def make_task(temperature=0, task_id=None):
+    return BaseTaskDescription(model="gpt-4o", prompt="Name a color", schema_description="{\"color\": string}", temperature=temperature, task_id=task_id)
+
+def test_results_are_stored_by_content_and_replayed_from_disk(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    cache = ResultCache(path, CacheMode.RECORD)
+    assert cache.get(make_task()) is None
+    cache.put(make_task(task_id="first"), {"response": "{\"color\": \"red\"}", "task_id": "first"})
+
+    # a fresh process only shares the file, the task_id is a label only
+    replay = ResultCache(path, CacheMode.REPLAY)
+    assert replay.get(make_task(task_id="second"))["response"] == "{\"color\": \"red\"}"
+    with pytest.raises(ResultCacheMiss):
+        replay.get(make_task(temperature=0.5))
+
+def test_sampled_tasks_bypass_the_cache():
+    cache = ResultCache("", CacheMode.ON)
+    # no temperature means the model's default, sampled as well
+    for temperature in (0.7, None):
+        cache.put(make_task(temperature=temperature), {"response": "{}"})
+        assert cache.get(make_task(temperature=temperature)) is None
+    assert cache.to_dict()["bypassed"] == 2 and cache.stores == 0
+
+    cache.put(make_task(temperature=0), {"response": "{}"})
+    assert cache.get(make_task(temperature=0)) == {"response": "{}"}
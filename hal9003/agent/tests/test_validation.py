@@ -0,0 +1,40 @@
+import pytest
+import jsonschema
+from agent.validation import ValidatorCache, VALIDATORS, validate, validation_errors
+
+SCHEMA = {
+    "type": "object",
+    "properties": {"query": {"type": "string"}, "limit": {"type": "integer"}},
+    "required": ["query"]
+}
+
+
+def test_validators_are_compiled_once_per_schema_content():
+    cache = ValidatorCache()
+    validator = cache.get(SCHEMA)
+    assert cache.get(dict(SCHEMA)) is validator
+    assert cache.get({"$schema": "http://json-schema.org/draft-04/schema#", **SCHEMA}) is not validator
+    assert isinstance(validator, jsonschema.Draft202012Validator) and cache.compiled == 2
+    with pytest.raises(jsonschema.SchemaError):
+        cache.get({"type": 12})
+
+def test_schema_changed_in_place_gets_its_own_validator():
+    cache = ValidatorCache()
+    schema = {"type": "object", "required": ["query"]}
+    assert cache.get(schema).is_valid({"query": "hal"})
+
+    schema["required"].append("limit")
+    assert not cache.get(schema).is_valid({"query": "hal"})
+    assert cache.compiled == 2
+
+def test_errors_are_collected_in_one_pass():
+    instance = {"limit": "ten"}
+    assert validation_errors(instance, SCHEMA, all_errors=True) == [
+        "limit: 'ten' is not of type 'integer'",
+        "<root>: 'query' is a required property"
+    ]
+    assert len(validation_errors(instance, SCHEMA, all_errors=False)) == 1
+    assert validation_errors({"query": "hal"}, SCHEMA) == []
+    with pytest.raises(jsonschema.ValidationError):
+        validate(instance, SCHEMA)
+    assert VALIDATORS.to_dict()["compiled"] >= 1
@@ -5,9 +5,11 @@ import time
 # default factory field
 from dataclasses import field
 from dataclasses import dataclass
-from jsonschema import validate
-from agent.complete_json import get_client_for_model
+from agent.validation import validate
+from agent.complete_json import get_client_for_model, timed_request
 from agent.models import get_model
+from agent.limits import LIMITER, estimate_tokens
+from bot import config as bc
 import argparse
 from typing import List
 
@@ -114,7 +116,7 @@ class RagGraph:
     
     def run_nodes(self, nodes, context):
         node_res = {}
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(nodes)) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(len(nodes), bc.LLM_MAX_CONNECTIONS), 1)) as executor:
             futures = [executor.submit(timed(node.run), context) for node in nodes]
 
             results = [future.result() for future in futures]
@@ -248,9 +250,12 @@ Based on the field descriptions of the schema analyze the user input and generat
             "temperature": 0.0,
         }
 
-        client = get_client_for_model(self.model.model) # TODO effienctly lookup
-        response = client.chat.completions.create(
-            **completion_params
+        client = get_client_for_model(self.model.model)
+        response = LIMITER.call(
+            self.model.client_config,
+            # only the request itself counts as the model's latency, not the limiter wait or the validation
+            lambda: timed_request(self.model.model, lambda: client.chat.completions.create(**completion_params)),
+            tokens=estimate_tokens(messages, completion_params["max_tokens"])
         )
 
         parsable = False
@@ -317,9 +322,11 @@ class CasualResponseNode(RagNode):
             "temperature": 0.0,
         }
 
-        client = get_client_for_model(self.model.model) # TODO effienctly lookup
-        response = client.chat.completions.create(
-            **completion_params
+        client = get_client_for_model(self.model.model)
+        response = LIMITER.call(
+            self.model.client_config,
+            lambda: timed_request(self.model.model, lambda: client.chat.completions.create(**completion_params)),
+            tokens=estimate_tokens(messages, completion_params["max_tokens"])
         )
         print("Running CasualResponseNode")
         
@@ -0,0 +1,63 @@
+import json
+import hashlib
+import threading
+from typing import Optional
+import jsonschema
+from bot.cache import LRUCache
+from bot import config as bc
+
+def schema_fingerprint(schema: dict) -> str:
+    return hashlib.sha256(json.dumps(schema, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def format_error(error: jsonschema.ValidationError) -> str:
+    path = "/".join(str(part) for part in error.absolute_path)
+    return f"{path or '<root>'}: {error.message}"
+
+class ValidatorCache:
+    """
+    Compiled validators of the schema's draft by schema fingerprint, the metaschema check runs once per schema.
+    A schema changed in place gets a new fingerprint and its own validator.
+    """
+
+    def __init__(self, maxsize: int = None):
+        self.validators = LRUCache(maxsize=maxsize or bc.VALIDATOR_CACHE_SIZE, ttl=0)
+        self.lock = threading.Lock()
+        self.compiled = 0
+
+    def get(self, schema: dict):
+        """The validator of `schema`, raises `jsonschema.SchemaError` for an invalid schema"""
+        fingerprint = schema_fingerprint(schema)
+        with self.lock:
+            validator = self.validators.get(fingerprint)
+            if validator is None:
+                validator_cls = jsonschema.validators.validator_for(schema)
+                validator_cls.check_schema(schema)
+                validator = validator_cls(schema)
+                self.validators.set(fingerprint, validator)
+                self.compiled += 1
+            return validator
+
+    def to_dict(self):
+        return {
+            "compiled": self.compiled,
+            "validators": self.validators.to_dict()
+        }
+
+VALIDATORS = ValidatorCache()
+
+def validate(instance, schema: dict):
+    """Like `jsonschema.validate` with a cached validator"""
+    error = jsonschema.exceptions.best_match(VALIDATORS.get(schema).iter_errors(instance))
+    if error is not None:
+        raise error
+
+def validation_errors(instance, schema: dict, all_errors: Optional[bool] = None) -> list[str]:
+    """
+    The errors of `instance`, empty if it is valid. Collects every error in one pass with `all_errors`
+    (default `VALIDATION_ALL_ERRORS`), otherwise stops at the first.
+    """
+    errors = VALIDATORS.get(schema).iter_errors(instance)
+    if not (bc.VALIDATION_ALL_ERRORS if all_errors is None else all_errors):
+        error = next(errors, None)
+        return [format_error(error)] if error is not None else []
+    return [format_error(error) for error in errors]
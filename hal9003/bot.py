@@ -27,6 +27,8 @@ def login_bot():
     hal9003.GLOBAL_API_CLIENT = auth_client
     hal9003.GLOBAL_REDIS_URL = GLOBAL_REDIS_URL
     res2: UserSelf = user_self_retrieve.sync(client=auth_client)
+    # resolved once per login, the bot reads it from memory for every message
+    hal9003.GLOBAL_BOT_USER = res2
     return {
         'user': res2,
         'csrftoken': csrftoken,
@@ -0,0 +1,96 @@
+import time
+import asyncio
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+class LRUCache:
+    """
+    Bounded in-process cache, evicts the least recently used entry and expires entries after `ttl` seconds
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expires, value = entry
+        if self.ttl and expires < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __contains__(self, key: Hashable):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def to_dict(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None
+        }
+
+
+class SingleFlight:
+    """
+    Concurrent calls for the same key share one in-flight future instead of each running the coroutine again
+    """
+
+    def __init__(self):
+        self.inflight: dict = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.calls += 1
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self.inflight[key] = future
+
+            def _done(done_future):
+                if self.inflight.get(key) is done_future:
+                    del self.inflight[key]
+            future.add_done_callback(_done)
+        else:
+            self.shared += 1
+        # a cancelled caller must not cancel the call the others are waiting for
+        return await asyncio.shield(future)
+
+    def to_dict(self):
+        return {
+            "inflight": len(self.inflight),
+            "calls": self.calls,
+            "shared": self.shared
+        }
@@ -1,11 +1,13 @@
 from bot.fmt import Formatter
 from bot.manager import Manager, MessageContext
 from bot.db import DB
+from bot.stream import StreamCoalescer
 import argparse
 import json
 import traceback
 import asyncio
 from bot import config as bc
+from agent import clients, limits, prompt_registry, result_cache, validation
 
 class CommandProcessor:
     
@@ -84,6 +86,46 @@ class CommandProcessor:
         
         return parser, _run_command
 
+    async def command_stats(self, mc: MessageContext):
+        """
+        Shows runtime counters of the bot e.g.: debug sink, chat queues and streaming stats
+        """
+        async def _run_command(args):
+            # imports the agent pipeline, not needed before the first `/stats`
+            from agent import latency
+            stats = {
+                "stream": StreamCoalescer.totals.to_dict(),
+                "settings_cache": self.db.settings_cache.to_dict(),
+                "single_flight": self.db.flights.to_dict(),
+                "llm_clients": clients.REGISTRY.to_dict(),
+                "agent_results": result_cache.RESULT_CACHE.to_dict(),
+                "prompts": prompt_registry.PROMPTS.to_dict(),
+                "validators": validation.VALIDATORS.to_dict(),
+                "llm_limits": limits.LIMITER.to_dict(),
+                "latency": latency.TRACKER.to_dict(),
+                "hedging": latency.HEDGING.to_dict(),
+                "tokens": self.fmd.tokens.to_dict(),
+                "render_cache": {"hits": self.db.render_hits, "misses": self.db.render_misses},
+            }
+            sink = self.mng.debugSink()
+            if sink:
+                stats["debug_sink"] = sink.to_dict()
+            response_cache = getattr(self.mng.bot, 'response_cache', None)
+            if response_cache:
+                stats["response_cache"] = response_cache.to_dict()
+            summarizer = getattr(self.mng.bot, 'summarizer', None)
+            if summarizer:
+                stats["summarizer"] = summarizer.to_dict()
+            scheduler = self.mng.scheduler()
+            if scheduler:
+                stats["scheduler"] = scheduler.to_dict()
+                stats["chat_queue"] = scheduler.to_dict(mc.chat.uuid)
+            pretty_stats_json = await self.fmd.pretty_json(stats)
+            await self.mng.sendChatMessage(mc, f"Bot stats\n{pretty_stats_json}")
+
+        parser = argparse.ArgumentParser(prog='Stats command')
+        return parser, _run_command
+
     async def command_intend(self, mc: MessageContext):
         """
         Intend 
@@ -93,13 +135,18 @@ class CommandProcessor:
             intend_model = "meta-llama/Meta-Llama-3-70B-Instruct"
             await self.mng.sendPartialMessage(mc, f"Checking Intend ...")
             await self.mng.debugSend(f"Running intend command with subcommand: {args}", mc)
-            from agent.paralel_intend_and_extract import intend_extract_paralel_json
-            res = intend_extract_paralel_json(
+            from agent.paralel_intend_and_extract import intend_extract_paralel_json_async
+
+            async def _progress(done, total, result):
+                await self.mng.sendPartialMessage(mc, f"Checking Intend ... {done}/{total}")
+
+            res = await intend_extract_paralel_json_async(
                 prompt=args.query,
                 models=[intend_model],
-                batch_size=2
+                batch_size=2,
+                on_progress=_progress
             )
-            await self.mng.debugSend(f"Intend results: {res}", mc)
+            await self.mng.debugSend("Intend results: {res}", mc, res=res)
             tool_pick = res["tool_pick"]
             extraction_pick = res["extraction_pick"]
             pretty_res = await self.fmd.wrap_code(json.dumps(extraction_pick['parsed'], indent=4))
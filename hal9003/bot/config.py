@@ -10,6 +10,13 @@ if ENV_FROM_B64_DICT:
     os.environ.update(json.loads(base64.b64decode(ENV_FROM_B64_DICT).decode()))
 
 DEBUG = os.environ.get('DEBUG', 'true').lower() in ('true', '1', 't')
+# debug messages with a higher `verbose` level are never rendered: 1 = errors only ... 3 = everything
+DEBUG_VERBOSITY = int(os.environ.get('DEBUG_VERBOSITY', '3'))
+# debug messages are queued and sent in batches to the debug chat
+DEBUG_SINK_QUEUE_SIZE = int(os.environ.get('DEBUG_SINK_QUEUE_SIZE', '200'))
+DEBUG_SINK_BATCH_SIZE = int(os.environ.get('DEBUG_SINK_BATCH_SIZE', '10'))
+DEBUG_SINK_BATCH_BYTES = int(os.environ.get('DEBUG_SINK_BATCH_BYTES', '16000'))
+DEBUG_SINK_INTERVAL = float(os.environ.get('DEBUG_SINK_INTERVAL', '0.5'))
 
 USE_REDIS = os.environ.get('USE_REDIS', 'false').lower() in ('true', '1', 't')
 REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
@@ -60,5 +67,109 @@ DEFAULT_MODEL = os.environ.get('DEFAULT_MODEL', 'gpt-3.5-turbo')
 MODEL_BACKEND = os.environ.get('MODEL_BACKEND', 'openai')
 OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY', '')
 DEEPINFRA_API_KEY = os.environ.get('DEEPINFRA_API_KEY', '')
+# JSON or YAML list of models (name, backend, capabilities, context window, prices), defaults to the built-in list
+MODELS_CONFIG = os.environ.get('MODELS_CONFIG', None)
+# completions the async agent pipelines run at the same time
+AGENT_MAX_CONCURRENCY = int(os.environ.get('AGENT_MAX_CONCURRENCY', '8'))
+# stop parallel votes (e.g.: `/intend`) once enough valid results agree, INTEND_QUORUM=0 means a majority
+AGENT_QUORUM_ENABLED = os.environ.get('AGENT_QUORUM_ENABLED', 'true').lower() in ('true', '1', 't')
+INTEND_QUORUM = int(os.environ.get('INTEND_QUORUM', '0'))
+# rolling completion latencies kept per model, with hedging a duplicate request goes to an equivalent
+# model once the p95 is exceeded, at most HEDGE_BUDGET hedges per request.
+# Opt-in, a hedge sends the prompt to the equivalent's backend
+LATENCY_WINDOW = int(os.environ.get('LATENCY_WINDOW', '256'))
+HEDGE_ENABLED = os.environ.get('HEDGE_ENABLED', 'false').lower() in ('true', '1', 't')
+HEDGE_BUDGET = float(os.environ.get('HEDGE_BUDGET', '0.1'))
+HEDGE_MIN_SAMPLES = int(os.environ.get('HEDGE_MIN_SAMPLES', '20'))
+# the yaml prompts of the agent are reloaded when changed, checked at most every interval (-1 disables)
+PROMPTS_RELOAD_INTERVAL = float(os.environ.get('PROMPTS_RELOAD_INTERVAL', '1'))
+# compiled jsonschema validators kept by schema, VALIDATION_ALL_ERRORS reports every violation instead of the first
+VALIDATOR_CACHE_SIZE = int(os.environ.get('VALIDATOR_CACHE_SIZE', '256'))
+VALIDATION_ALL_ERRORS = os.environ.get('VALIDATION_ALL_ERRORS', 'false').lower() in ('true', '1', 't')
+# `complete_json` results by task content in a sqlite file without expiry, opt-in:
+# off | on | record | replay (offline, a miss is an error)
+AGENT_RESULT_CACHE_MODE = os.environ.get('AGENT_RESULT_CACHE_MODE', 'off')
+AGENT_RESULT_CACHE_PATH = os.environ.get('AGENT_RESULT_CACHE_PATH', os.path.expanduser('~/.cache/hal9003/agent_results.sqlite'))
+AGENT_RESULT_CACHE_MEMORY = int(os.environ.get('AGENT_RESULT_CACHE_MEMORY', '1024'))
+# in mode `on` tasks without temperature 0 bypass the cache unless this is set
+AGENT_RESULT_CACHE_SAMPLED = os.environ.get('AGENT_RESULT_CACHE_SAMPLED', 'false').lower() in ('true', '1', 't')
+# connection pool of the shared LLM clients, http2 needs the `h2` package
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', '100'))
+LLM_MAX_KEEPALIVE = int(os.environ.get('LLM_MAX_KEEPALIVE', '20'))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get('LLM_KEEPALIVE_EXPIRY', '30'))
+LLM_HTTP2 = os.environ.get('LLM_HTTP2', 'false').lower() in ('true', '1', 't')
+# requests in flight over all backends, rate limits per backend (0 = unlimited)
+# and retries of 429 / 5xx responses with jittered exponential backoff
+LLM_MAX_IN_FLIGHT = int(os.environ.get('LLM_MAX_IN_FLIGHT', '16'))
+OPENAI_REQUESTS_PER_MINUTE = int(os.environ.get('OPENAI_REQUESTS_PER_MINUTE', '0'))
+OPENAI_TOKENS_PER_MINUTE = int(os.environ.get('OPENAI_TOKENS_PER_MINUTE', '0'))
+DEEPINFRA_REQUESTS_PER_MINUTE = int(os.environ.get('DEEPINFRA_REQUESTS_PER_MINUTE', '0'))
+DEEPINFRA_TOKENS_PER_MINUTE = int(os.environ.get('DEEPINFRA_TOKENS_PER_MINUTE', '0'))
+# completion tokens assumed for the token buckets if a request sets no `max_tokens`
+LLM_EXPECTED_COMPLETION_TOKENS = int(os.environ.get('LLM_EXPECTED_COMPLETION_TOKENS', '256'))
+# a `Retry-After` longer than LLM_RETRY_MAX_BACKOFF isn't waited for, the request fails
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '4'))
+LLM_RETRY_BACKOFF = float(os.environ.get('LLM_RETRY_BACKOFF', '0.5'))
+LLM_RETRY_MAX_BACKOFF = float(os.environ.get('LLM_RETRY_MAX_BACKOFF', '30'))
+
+# partial messages are coalesced until one of the budgets is used up
+STREAM_FLUSH_INTERVAL = float(os.environ.get('STREAM_FLUSH_INTERVAL', '0.25'))
+STREAM_FLUSH_BYTES = int(os.environ.get('STREAM_FLUSH_BYTES', '512'))
+# 'full' or 'delta', the server can switch it per connection via the `partial_encoding` action
+PARTIAL_MESSAGE_ENCODING = os.environ.get('PARTIAL_MESSAGE_ENCODING', 'full')
+PARTIAL_RESYNC_FRAMES = int(os.environ.get('PARTIAL_RESYNC_FRAMES', '20'))
+
+# upper bound of message pages fetched per turn to catch up with the chat history
+HISTORY_SYNC_MAX_PAGES = int(os.environ.get('HISTORY_SYNC_MAX_PAGES', '10'))
+# messages kept per chat in redis, older ones are trimmed in segments and archived compressed
+HISTORY_MAX_LENGTH = int(os.environ.get('HISTORY_MAX_LENGTH', '200'))
+HISTORY_TRIM_SEGMENT = int(os.environ.get('HISTORY_TRIM_SEGMENT', '50'))
+HISTORY_ARCHIVE = os.environ.get('HISTORY_ARCHIVE', 'true').lower() in ('true', '1', 't')
+# archive segments kept per chat, the oldest are dropped beyond that. 0 keeps all of them
+HISTORY_ARCHIVE_MAX_SEGMENTS = int(os.environ.get('HISTORY_ARCHIVE_MAX_SEGMENTS', '0'))
+
+# parsed chat settings are cached in-process, pubsub invalidates them in other bot processes
+SETTINGS_CACHE_SIZE = int(os.environ.get('SETTINGS_CACHE_SIZE', '1024'))
+SETTINGS_CACHE_TTL = float(os.environ.get('SETTINGS_CACHE_TTL', '300'))
+SETTINGS_CACHE_PUBSUB = os.environ.get('SETTINGS_CACHE_PUBSUB', 'false').lower() in ('true', '1', 't')
+
+# the chat history sent to the model is packed newest first into a token budget,
+# derived from the model's context window minus the reserved reply tokens unless the chat sets `tokenBudget`
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '4096'))
+CONTEXT_RESERVED_TOKENS = int(os.environ.get('CONTEXT_RESERVED_TOKENS', '1024'))
+# upper bound for the chat's `context`, the messages read from the history per turn
+CONTEXT_MAX_MESSAGES = int(os.environ.get('CONTEXT_MAX_MESSAGES', '50'))
+CONTEXT_TRUNCATE_MESSAGES = os.environ.get('CONTEXT_TRUNCATE_MESSAGES', 'true').lower() in ('true', '1', 't')
+CONTEXT_MIN_TRUNCATE_TOKENS = int(os.environ.get('CONTEXT_MIN_TRUNCATE_TOKENS', '64'))
+# local tiktoken encoding, token counts are estimated if it can't be loaded
+TOKENIZER_ENCODING = os.environ.get('TOKENIZER_ENCODING', 'cl100k_base')
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', '10000'))
+
+# older messages are compressed into a running summary per chat in the background,
+# a segment of at least `SUMMARY_SEGMENT` messages before the `SUMMARY_KEEP_RECENT` newest ones
+SUMMARY_ENABLED = os.environ.get('SUMMARY_ENABLED', 'false').lower() in ('true', '1', 't')
+SUMMARY_SEGMENT = int(os.environ.get('SUMMARY_SEGMENT', '20'))
+SUMMARY_KEEP_RECENT = int(os.environ.get('SUMMARY_KEEP_RECENT', '20'))
+SUMMARY_CONCURRENCY = int(os.environ.get('SUMMARY_CONCURRENCY', '2'))
+SUMMARY_MAX_TOKENS = int(os.environ.get('SUMMARY_MAX_TOKENS', '400'))
+# defaults to the chat's model
+SUMMARY_MODEL = os.environ.get('SUMMARY_MODEL', '')
+
+# completions are reused for identical requests (model, prompts, history, temperature),
+# only deterministic ones (temperature 0) unless `RESPONSE_CACHE_ANY_TEMPERATURE` is set
+RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() in ('true', '1', 't')
+RESPONSE_CACHE_ANY_TEMPERATURE = os.environ.get('RESPONSE_CACHE_ANY_TEMPERATURE', 'false').lower() in ('true', '1', 't')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1024'))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '3600'))
+# semantic tier, the last user message may be a rephrasing with an embedding similarity above the threshold
+RESPONSE_CACHE_SEMANTIC = os.environ.get('RESPONSE_CACHE_SEMANTIC', 'false').lower() in ('true', '1', 't')
+RESPONSE_CACHE_THRESHOLD = float(os.environ.get('RESPONSE_CACHE_THRESHOLD', '0.9'))
+RESPONSE_CACHE_SEMANTIC_CANDIDATES = int(os.environ.get('RESPONSE_CACHE_SEMANTIC_CANDIDATES', '32'))
+
+# incoming messages are queued per chat and worked off by a fixed number of workers
+MAX_CONCURRENT_COMPLETIONS = int(os.environ.get('MAX_CONCURRENT_COMPLETIONS', '4'))
+CHAT_QUEUE_SIZE = int(os.environ.get('CHAT_QUEUE_SIZE', '10'))
+# a newer message cancels the reply still streaming in the same chat, commands are never superseded
+SUPERSEDE_COMPLETIONS = os.environ.get('SUPERSEDE_COMPLETIONS', 'false').lower() in ('true', '1', 't')
     
 print("FULL_SERVER_URL:", FULL_SERVER_URL)
\ No newline at end of file
@@ -3,56 +3,185 @@ from open_chat_api_client.api.user import user_self_retrieve
 from open_chat_api_client.api.chats import chats_settings_retrieve, chats_settings_create
 from bot.manager import Manager, MessageContext, ChatConfig
 from bot.fmt import Formatter, JSONDecoder, JSONEncoder
+from bot.cache import LRUCache, SingleFlight
+from bot.tokens import TOKENS_PER_MESSAGE
 from open_chat_api_client.models import ChatResult, ChatSettings, SetChatTitleRequest, Message, UserSelf
 import json
+import uuid
+import weakref
+import asyncio
+import hashlib
+import base64
+import zlib
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
 from typing import Optional
 from bot import config as bc
 import redis.asyncio as redis
 
+def decode(value) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
 class RedisEmulatedClient:
 
     def __init__(self):
         self.data = {}
+        self.expires = {}
 
     async def get(self, key):
+        if key in self.expires and self.expires[key] < time.monotonic():
+            self.data.pop(key, None)
+            del self.expires[key]
         return self.data.get(key)
 
-    async def set(self, key, value):
+    async def set(self, key, value, ex=None):
         self.data[key] = value
+        if ex:
+            self.expires[key] = time.monotonic() + ex
+        else:
+            self.expires.pop(key, None)
 
     async def rpush(self, key, value):
         if key not in self.data:
             self.data[key] = []
         self.data[key].append(value)
+        return len(self.data[key])
+
+    async def llen(self, key):
+        return len(self.data.get(key, []))
 
     async def lrange(self, key, start, end):
         if key not in self.data:
             return []
-        return self.data[key][start:end]
+        # redis ranges are inclusive and allow negative indexes
+        length = len(self.data[key])
+        start = max(length + start, 0) if start < 0 else start
+        end = length + end if end < 0 else end
+        return self.data[key][start:end + 1]
 
     async def lset(self, key, index, value):
         if key not in self.data:
             return
         self.data[key][index] = value
 
+    async def ltrim(self, key, start, end):
+        if key not in self.data:
+            return True
+        self.data[key] = await self.lrange(key, start, end)
+        return True
+
+    async def incrby(self, key, amount=1):
+        self.data[key] = str(int(self.data.get(key) or 0) + amount)
+        return int(self.data[key])
+
+    async def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    async def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    async def hmget(self, key, fields):
+        values = self.data.get(key, {})
+        return [values.get(field) for field in fields]
+
+    async def hset(self, key, field, value):
+        if key not in self.data:
+            self.data[key] = {}
+        created = field not in self.data[key]
+        self.data[key][field] = str(value)
+        return int(created)
+
+    async def hdel(self, key, *fields):
+        values = self.data.get(key, {})
+        return sum(values.pop(field, None) is not None for field in fields)
+
     async def flushdb(self):
         self.data = {}
+        self.expires = {}
+
+    async def publish(self, channel, message):
+        # single process, there is no one else to notify
+        return 0
+
+    def pipeline(self, transaction=True):
+        return RedisEmulatedPipeline(self)
+
+class RedisEmulatedPipeline:
+    """
+    Queues commands like a redis pipeline and applies them in order on `execute`
+    """
+
+    def __init__(self, client: RedisEmulatedClient):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+        def _queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return _queue
+
+    async def execute(self):
+        commands, self.commands = self.commands, []
+        return [await command(*args, **kwargs) for command, args, kwargs in commands]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.commands = []
 
 class DB:
     bot = None
     mng: Manager = None
     fmt = Formatter()
+    # how far back in the history `tmp-` messages are matched against fetched messages
+    TMP_MATCH_WINDOW = 50
+    SETTINGS_INVALIDATION_CHANNEL = "chat:settings:invalidate"
 
-    def __init__(self, bot=None, redis_url=None, client=None):
+    def __init__(self, bot=None, redis_url=None, client=None, bot_user: Optional[UserSelf] = None):
         self.url = redis_url
         self.client = client
         self.db_client = None
         self.bot = bot
         self.mng = Manager(bot, db=self)
+        self.debug = None
+        # the bot identity never changes during a connection, only `refreshBotUser` replaces it
+        self.bot_user = bot_user
+        # parsed (ChatSettings, ChatConfig) by chat uuid
+        self.settings_cache = LRUCache(maxsize=bc.SETTINGS_CACHE_SIZE, ttl=bc.SETTINGS_CACHE_TTL)
+        self.instance_id = str(uuid.uuid4())
+        # concurrent remote fetches for the same key share one request
+        self.flights = SingleFlight()
+        self.chat_locks = weakref.WeakValueDictionary()
+        self.invalidation_task = None
+        self.render_hits = 0
+        self.render_misses = 0
+        
+    @asynccontextmanager
+    async def pipeline(self, pipe=None, transaction=True):
+        """
+        Collects commands into one pipeline that is executed when the block exits.
+        If `pipe` is passed the commands are added to that pipeline instead.
+        """
+        if pipe is not None:
+            yield pipe
+            return
+        db = await self.get_or_create_client()
+        async with db.pipeline(transaction=transaction) as pipe:
+            yield pipe
+            await pipe.execute()
         
     async def flush(self):
         db = await self.get_or_create_client()
         await db.flushdb()
+        self.debug = None
+        self.settings_cache.clear()
+        # the render cache was flushed with the rest
+        self.render_hits = 0
+        self.render_misses = 0
         
     async def get_or_create_client(self, emulated_client=(not bc.USE_REDIS)):
         if self.db_client is None:
@@ -84,15 +213,77 @@ class DB:
         return settings, config
     
     async def shouldDebug(self):
-        db = await self.get_or_create_client()
-        debug = await db.get("debug")
-        return (debug == "true") or bc.DEBUG
+        if bc.DEBUG:
+            return True
+        if self.debug is None:
+            # cached in-process, `setDebug` and `flush` invalidate it
+            db = await self.get_or_create_client()
+            self.debug = (await db.get("debug")) == "true"
+        return self.debug
     
     async def setDebug(self, debug):
         db = await self.get_or_create_client()
         await db.set("debug", "true" if debug else "false")
+        self.debug = bool(debug)
+
+    async def cacheChatSettings(self, chat_uuid, settings: ChatSettings, config: Optional[ChatConfig] = None, pipe=None):
+        """
+        Write-through of updated settings: in-process cache, redis and ( optionally ) other bot processes
+        """
+        if config is None:
+            try:
+                config = ChatConfig(**settings.config)
+            except Exception:
+                config = None
+        if config is None:
+            self.settings_cache.invalidate(chat_uuid)
+        else:
+            self.settings_cache.set(chat_uuid, (settings, config))
+        async with self.pipeline(pipe) as p:
+            p.set(f"chat:{chat_uuid}:settings", json.dumps(settings.to_dict()))
+            if bc.SETTINGS_CACHE_PUBSUB:
+                p.publish(self.SETTINGS_INVALIDATION_CHANNEL, json.dumps({
+                    "chat_uuid": chat_uuid,
+                    "origin": self.instance_id
+                }))
+    
+    def startSettingsInvalidationListener(self):
+        if bc.SETTINGS_CACHE_PUBSUB and bc.USE_REDIS and (self.invalidation_task is None or self.invalidation_task.done()):
+            self.invalidation_task = asyncio.ensure_future(self.listenForSettingsInvalidation())
+    
+    def stopSettingsInvalidationListener(self):
+        if self.invalidation_task is not None:
+            self.invalidation_task.cancel()
+            self.invalidation_task = None
+    
+    async def listenForSettingsInvalidation(self):
+        db = await self.get_or_create_client()
+        pubsub = db.pubsub()
+        await pubsub.subscribe(self.SETTINGS_INVALIDATION_CHANNEL)
+        try:
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                data = json.loads(message["data"])
+                if data.get("origin") != self.instance_id:
+                    self.settings_cache.invalidate(data.get("chat_uuid"))
+        finally:
+            await pubsub.unsubscribe(self.SETTINGS_INVALIDATION_CHANNEL)
+
+    def chatLock(self, chat_uuid) -> asyncio.Lock:
+        lock = self.chat_locks.get(chat_uuid)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.chat_locks[chat_uuid] = lock
+        return lock
 
     async def getOrCreateChatSettings(self, chat_uuid, mc: Optional[MessageContext] = None, debug=False) -> tuple[ChatSettings, ChatConfig]:
+        cached = self.settings_cache.get(chat_uuid)
+        if cached:
+            return cached
+        return await self.flights.do(f"settings:{chat_uuid}", lambda: self.loadChatSettings(chat_uuid, mc=mc, debug=debug))
+    
+    async def loadChatSettings(self, chat_uuid, mc: Optional[MessageContext] = None, debug=False) -> tuple[ChatSettings, ChatConfig]:
         db = await self.get_or_create_client()
         settings = await db.get(f"chat:{chat_uuid}:settings")
         if not settings:
@@ -101,7 +292,7 @@ class DB:
             try:
                 req = await chats_settings_retrieve.asyncio_detailed(chat_uuid=chat_uuid, client=self.client)
                 if debug:
-                    await self.mng.debugSend(f"## Chat settings fetched from server\n - in chat {chat_uuid}\n{req.parsed}", None, verbose=2)
+                    await self.mng.debugSend("## Chat settings fetched from server\n - in chat {chat_uuid}\n{settings}", None, verbose=2, chat_uuid=chat_uuid, settings=req.parsed)
                 settings = req.parsed
             except Exception as ex:
                 if debug:
@@ -114,39 +305,35 @@ class DB:
                         model=bc.DEFAULT_MODEL,
                     ).to_dict()
                 ), client=self.client)
-                pretty_settings_json = await self.fmt.pretty_json(settings.to_dict())
                 if debug:
-                    await self.mng.debugSend(f"## Chat settings not found in db, created\n - in chat {chat_uuid}\n{pretty_settings_json}", None, verbose=2)
+                    await self.mng.debugSend("## Chat settings not found in db, created\n - in chat {chat_uuid}\n{settings}", None, verbose=2, chat_uuid=chat_uuid, settings=lambda: self.fmt.pretty_json(settings.to_dict()))
             await db.set(f"chat:{chat_uuid}:settings", json.dumps(settings.to_dict()))
         else:
             settings = ChatSettings.from_dict(json.loads(settings))
-            pretty_settings_json = await self.fmt.pretty_json(settings.to_dict())
             if debug:
-                await self.mng.debugSend(f"## Chat settings found in db\n - in chat {chat_uuid}\n{pretty_settings_json}", None, verbose=3)
+                await self.mng.debugSend("## Chat settings found in db\n - in chat {chat_uuid}\n{settings}", None, verbose=3, chat_uuid=chat_uuid, settings=lambda: self.fmt.pretty_json(settings.to_dict()))
             
         settings, config = await self.validateConfigOrReset(chat_uuid, settings, mc=mc)
+        self.settings_cache.set(chat_uuid, (settings, config))
         return settings, config
     
     async def updateChatSettingsConfigKey(self, chat_uuid, key, value, mc: Optional[MessageContext] = None) -> tuple[ChatSettings, ChatConfig]:
-        db = await self.get_or_create_client()
         _, cur_chat_config = (await self.getOrCreateChatSettings(chat_uuid))
         updated_settings = await chats_settings_create.asyncio(chat_uuid=chat_uuid, body=SetChatTitleRequest.from_dict(
             {"config" :{**cur_chat_config.to_dict(), **{key: value}}}
         ), client=self.client)
-        await db.set(f"chat:{chat_uuid}:settings", json.dumps(updated_settings.to_dict()))
-        pretty_settings_json = await self.fmt.wrap_code(json.dumps(updated_settings.to_dict(), indent=4))
-        await self.mng.debugSend(f"## Chat settings updated in db\n - in chat {chat_uuid}\n{pretty_settings_json}", None, verbose=3)
+        await self.cacheChatSettings(chat_uuid, updated_settings)
+        await self.mng.debugSend("## Chat settings updated in db\n - in chat {chat_uuid}\n{settings}", None, verbose=3, chat_uuid=chat_uuid, settings=lambda: self.fmt.pretty_json(updated_settings.to_dict()))
         settings, config = await self.validateConfigOrReset(chat_uuid, updated_settings, mc=mc)
+        self.settings_cache.set(chat_uuid, (settings, config))
         return settings, config
     
     async def updateChatSettings(self, chat_uuid, settings: ChatSettings):
-        db = await self.get_or_create_client()
         updated_settings = await chats_settings_create.asyncio(chat_uuid=chat_uuid, body=SetChatTitleRequest.from_dict(
             settings.to_dict()
         ), client=self.client)
-        await db.set(f"chat:{chat_uuid}:settings", json.dumps(updated_settings.to_dict()))
-        pretty_settings_json = await self.fmt.wrap_code(json.dumps(updated_settings.to_dict(), indent=4))
-        await self.mng.debugSend(f"## Chat settings updated in db\n - in chat {chat_uuid}\n{pretty_settings_json}", None, verbose=3)
+        await self.cacheChatSettings(chat_uuid, updated_settings)
+        await self.mng.debugSend("## Chat settings updated in db\n - in chat {chat_uuid}\n{settings}", None, verbose=3, chat_uuid=chat_uuid, settings=lambda: self.fmt.pretty_json(updated_settings.to_dict()))
         return updated_settings
     
     async def getChatDefaultModel(self, chat_uuid):
@@ -157,82 +344,319 @@ class DB:
         db = await self.get_or_create_client()
         await db.set(f"chat:{chat_uuid}:model", model)
     
-    async def addChatMessage(self, chat_uuid, message: Message):
+    async def addChatMessage(self, chat_uuid, message: Message, pipe=None):
+        messages_key = f"chat:{chat_uuid}:messages"
+        if not message.uuid.startswith('tmp-'):
+            async with self.pipeline(pipe) as p:
+                p.rpush(messages_key, json.dumps(message.to_dict()))
+            return
+        # bot replies are stored as `tmp-` messages until their server version is fetched, their position
+        # is kept in `chat:{uuid}:tmp` by text hash so `upsertChatMessages` can replace them.
+        # The position is read before the write, so they can't be queued in another pipeline
+        if pipe is not None:
+            raise ValueError("`tmp-` messages are written right away, they can't be added to a pipeline")
         db = await self.get_or_create_client()
-        await db.rpush(f"chat:{chat_uuid}:messages", json.dumps(message.to_dict()))
+        async with self.chatLock(chat_uuid):
+            async with db.pipeline(transaction=False) as read:
+                read.llen(messages_key)
+                read.get(f"chat:{chat_uuid}:offset")
+                list_length, offset = await read.execute()
+            async with self.pipeline() as p:
+                p.rpush(messages_key, json.dumps(message.to_dict()))
+                p.hset(f"chat:{chat_uuid}:tmp", self.messageSha(message), f"{int(offset or 0) + list_length}:{message.uuid}")
         
     async def getOrFetchBotUser(self) -> UserSelf:
+        if self.bot_user is not None:
+            return self.bot_user
+        return await self.flights.do("bot:user", self.loadBotUser)
+    
+    async def refreshBotUser(self, user: Optional[UserSelf] = None) -> UserSelf:
+        """
+        Replaces the in-memory bot user e.g.: after a re-login, fetches it from the server if not passed.
+        Redis is only written so other processes can share the identity.
+        """
+        if user is None:
+            user = await user_self_retrieve.asyncio(client=self.client)
+        self.bot_user = user
+        db = await self.get_or_create_client()
+        await db.set("bot:user", json.dumps(user.to_dict()))
+        await self.mng.debugSend("## Bot user refreshed\n - self user {uuid}", None, verbose=2, uuid=user.uuid)
+        return user
+    
+    async def loadBotUser(self) -> UserSelf:
         db = await self.get_or_create_client()
         user = await db.get("bot:user")
         if not user:
             user = await user_self_retrieve.asyncio(client=self.client)
             await db.set("bot:user", json.dumps(user.to_dict()))
-            pretty_user_json = await self.fmt.wrap_code(json.dumps(user.to_dict(), indent=4))
-            await self.mng.debugSend(f"## Bot user not found in db, created\n - self user {user.uuid}\n{pretty_user_json}", None, verbose=2)
+            await self.mng.debugSend("## Bot user not found in db, created\n - self user {uuid}\n{user}", None, verbose=2, uuid=user.uuid, user=lambda: self.fmt.pretty_json(user.to_dict()))
         else:
             user = UserSelf.from_dict(json.loads(user))
-            pretty_user_json = await self.fmt.wrap_code(json.dumps(user.to_dict(), indent=4))
-            await self.mng.debugSend(f"## Bot user found in db\n - self user {user.uuid}\n{pretty_user_json}", None, verbose=3)
+            await self.mng.debugSend("## Bot user found in db\n - self user {uuid}\n{user}", None, verbose=3, uuid=user.uuid, user=lambda: self.fmt.pretty_json(user.to_dict()))
+        self.bot_user = user
         return user
     
+    def messageSha(self, message: Message):
+        return hashlib.sha256(message.text.encode('utf-8')).hexdigest()
+    
+    async def getChatSyncState(self, chat_uuid) -> Optional[dict]:
+        db = await self.get_or_create_client()
+        sync = await db.get(f"chat:{chat_uuid}:sync")
+        return json.loads(sync) if sync else None
+    
+    async def setChatSyncState(self, chat_uuid, message: Message, pipe=None):
+        async with self.pipeline(pipe) as p:
+            p.set(f"chat:{chat_uuid}:sync", json.dumps({
+                "uuid": message.uuid,
+                "created": message.created.isoformat()
+            }))
+    
+    def isSyncedMessage(self, message: Message, sync: dict):
+        if message.uuid == sync["uuid"]:
+            return True
+        try:
+            # same timestamp might still be a different message, re-upserting is harmless
+            return message.created < datetime.fromisoformat(sync["created"])
+        except (TypeError, ValueError):
+            return False
+    
+    async def fetchNewChatMessages(self, chat_uuid, page_size: int = 5) -> list[Message]:
+        """
+        Fetches only the messages newer than the high-water mark of the chat, oldest first.
+        Without a high-water mark only the newest page is fetched.
+        """
+        sync = await self.getChatSyncState(chat_uuid)
+        new_messages = []
+        page = 1
+        while True:
+            messages = await messages_list.asyncio(
+                chat_uuid=chat_uuid,
+                client=self.client,
+                page=page,
+                page_size=page_size
+            )
+            results = (messages.results or []) if messages else []
+            reached_synced = False
+            # results are newest first
+            for msg in results:
+                if sync and self.isSyncedMessage(msg, sync):
+                    reached_synced = True
+                    break
+                new_messages.append(msg)
+            if (not sync) or reached_synced or (not messages) or (not messages.next_page) or page >= bc.HISTORY_SYNC_MAX_PAGES:
+                break
+            page += 1
+        new_messages.reverse()
+        return new_messages
+    
+    async def upsertChatMessages(self, chat_uuid, messages: list[Message], pipe=None) -> int:
+        """
+        Replaces messages already in the history ( by uuid or matching `tmp-` message ) and appends all others.
+        The lookups are one read pipeline, the writes are queued in `pipe` or one transaction.
+        Returns the length of the history list after the writes.
+        """
+        db = await self.get_or_create_client()
+        messages_key = f"chat:{chat_uuid}:messages"
+        index_key = f"chat:{chat_uuid}:index"
+        tmp_key = f"chat:{chat_uuid}:tmp"
+
+        async with db.pipeline(transaction=False) as read:
+            read.llen(messages_key)
+            read.get(f"chat:{chat_uuid}:offset")
+            read.hmget(index_key, [msg.uuid for msg in messages] or ["-"])
+            read.hgetall(tmp_key)
+            read.get(f"chat:{chat_uuid}:sync")
+            list_length, offset, indexes, tmp_entries, sync = await read.execute()
+        # indexes are absolute positions, `offset` messages were already trimmed & archived
+        offset = int(offset or 0)
+        length = offset + list_length
+        indexes = dict(zip([msg.uuid for msg in messages], indexes))
+        # trimmed messages leave the index, a re-fetched archived one is older than the high-water mark
+        sync = json.loads(sync) if sync else None
+
+        # `tmp-` bot replies by text hash, see `addChatMessage`
+        tmp_indexes = {}
+        for sha, entry in (tmp_entries or {}).items():
+            index, tmp_uuid = decode(entry).split(":", 1)
+            tmp_indexes[decode(sha)] = (int(index), tmp_uuid)
+
+        async with self.pipeline(pipe) as p:
+            for msg in messages:
+                index = indexes.get(msg.uuid)
+                replaced_uuid = msg.uuid
+                if index is None and tmp_indexes:
+                    sha = self.messageSha(msg)
+                    index, replaced_uuid = tmp_indexes.pop(sha, (None, None))
+                    if index is not None:
+                        p.hdel(tmp_key, sha)
+                if index is None and sync and self.isSyncedMessage(msg, sync):
+                    continue
+                if index is not None:
+                    if int(index) < offset:
+                        # already archived
+                        continue
+                    p.lset(messages_key, int(index) - offset, json.dumps(msg.to_dict()))
+                    p.hdel(f"chat:{chat_uuid}:render", replaced_uuid)
+                else:
+                    index = length
+                    length += 1
+                    p.rpush(messages_key, json.dumps(msg.to_dict()))
+                indexes[msg.uuid] = index
+                p.hset(index_key, msg.uuid, index)
+            # replies that were never fetched from the server are not matched forever
+            stale = [sha for sha, (index, _) in tmp_indexes.items() if index < length - self.TMP_MATCH_WINDOW]
+            if stale:
+                p.hdel(tmp_key, *stale)
+        return length - offset
+    
+    async def trimChatMessages(self, chat_uuid, max_length: int, length: Optional[int] = None):
+        """
+        Keeps at most `max_length` messages in the history list, older messages are moved into
+        compressed archive segments. Trimming only happens once `HISTORY_TRIM_SEGMENT` messages piled up.
+        A known `length` skips the lookups while there is nothing to trim.
+        """
+        if length is not None and length <= max_length + bc.HISTORY_TRIM_SEGMENT:
+            return
+        db = await self.get_or_create_client()
+        messages_key = f"chat:{chat_uuid}:messages"
+        archive_key = f"chat:{chat_uuid}:archive"
+        # the reads & the writes must not interleave with an upsert of the same chat
+        async with self.chatLock(chat_uuid):
+            async with db.pipeline(transaction=False) as read:
+                read.llen(messages_key)
+                read.get(f"chat:{chat_uuid}:offset")
+                length, offset = await read.execute()
+            if length <= max_length + bc.HISTORY_TRIM_SEGMENT:
+                return
+            offset = int(offset or 0)
+            trimmed = await db.lrange(messages_key, 0, length - max_length - 1)
+            trimmed_uuids = [json.loads(raw)["uuid"] for raw in trimmed]
+
+            async with db.pipeline(transaction=True) as p:
+                if bc.HISTORY_ARCHIVE:
+                    p.rpush(archive_key, self.compressSegment(offset, trimmed))
+                    if bc.HISTORY_ARCHIVE_MAX_SEGMENTS:
+                        p.ltrim(archive_key, -bc.HISTORY_ARCHIVE_MAX_SEGMENTS, -1)
+                p.ltrim(messages_key, len(trimmed), -1)
+                p.incrby(f"chat:{chat_uuid}:offset", len(trimmed))
+                if trimmed_uuids:
+                    p.hdel(f"chat:{chat_uuid}:render", *trimmed_uuids)
+                    p.hdel(f"chat:{chat_uuid}:index", *trimmed_uuids)
+                results = await p.execute()
+        await self.mng.debugSend("## Archived {count} messages\n - in chat {chat_uuid}", None, verbose=3, count=len(trimmed), chat_uuid=chat_uuid)
+        segments = results[0] if bc.HISTORY_ARCHIVE else 0
+        if bc.HISTORY_ARCHIVE_MAX_SEGMENTS and segments > bc.HISTORY_ARCHIVE_MAX_SEGMENTS:
+            await self.mng.debugSend(
+                "## Dropped {count} archive segments\n - in chat {chat_uuid}, `HISTORY_ARCHIVE_MAX_SEGMENTS` is {max_segments}", None, verbose=2,
+                count=segments - bc.HISTORY_ARCHIVE_MAX_SEGMENTS, chat_uuid=chat_uuid, max_segments=bc.HISTORY_ARCHIVE_MAX_SEGMENTS
+            )
+    
+    async def renderChatMessages(self, chat_uuid, messages: list[Message], bot_uuid: str, model: Optional[str] = None) -> list[dict]:
+        """
+        Rendered openai message dicts with their token counts, cached per message uuid and content hash
+        in `chat:{uuid}:render` next to the history. Only new or changed messages are rendered & tokenized.
+        """
+        if not messages:
+            return []
+        db = await self.get_or_create_client()
+        render_key = f"chat:{chat_uuid}:render"
+        cached = await db.hmget(render_key, [msg.uuid for msg in messages])
+        rendered, updates = [], {}
+        for msg, raw in zip(messages, cached):
+            sha = self.messageSha(msg)
+            entry = json.loads(raw) if raw else None
+            if not entry or entry["sha"] != sha or entry["bot"] != bot_uuid:
+                entry = {"sha": sha, "bot": bot_uuid, "message": self.fmt.render_message(msg, bot_uuid), "tokens": {}}
+            # counts depend on the model's tokenizer
+            if (model or "") not in entry["tokens"]:
+                entry["tokens"][model or ""] = self.fmt.tokens.count(msg.text, model) + TOKENS_PER_MESSAGE
+                updates[msg.uuid] = json.dumps(entry)
+                self.render_misses += 1
+            else:
+                self.render_hits += 1
+            rendered.append({"message": entry["message"], "tokens": entry["tokens"][model or ""]})
+        if updates:
+            async with self.pipeline() as p:
+                for message_uuid, entry in updates.items():
+                    p.hset(render_key, message_uuid, entry)
+        return rendered
+    
+    def compressSegment(self, start: int, raw_messages: list[str]) -> str:
+        data = json.dumps({"start": start, "messages": raw_messages})
+        return base64.b64encode(zlib.compress(data.encode('utf-8'))).decode('ascii')
+    
+    def decompressSegment(self, segment: str) -> dict:
+        return json.loads(zlib.decompress(base64.b64decode(segment)).decode('utf-8'))
+    
+    async def getArchivedChatMessages(self, chat_uuid) -> list[Message]:
+        db = await self.get_or_create_client()
+        segments = await db.lrange(f"chat:{chat_uuid}:archive", 0, -1) or []
+        messages = []
+        for segment in segments:
+            messages.extend(Message.from_dict(json.loads(raw)) for raw in self.decompressSegment(segment)["messages"])
+        return messages
+    
+    async def getChatMessagesTail(self, chat_uuid, count: int) -> list[Message]:
+        db = await self.get_or_create_client()
+        tail = await db.lrange(f"chat:{chat_uuid}:messages", -count, -1) or []
+        return [Message.from_dict(json.loads(msg)) for msg in tail]
+
+    async def getChatHistoryBounds(self, chat_uuid) -> tuple[int, int]:
+        """Absolute index of the oldest message still in the history list and the total message count"""
+        db = await self.get_or_create_client()
+        async with db.pipeline(transaction=False) as read:
+            read.get(f"chat:{chat_uuid}:offset")
+            read.llen(f"chat:{chat_uuid}:messages")
+            offset, length = await read.execute()
+        offset = int(offset or 0)
+        return offset, offset + length
+    
+    async def getChatMessagesRange(self, chat_uuid, start: int, end: int) -> list[Message]:
+        """Messages by absolute index `start` (inclusive) to `end` (exclusive), archived ones are skipped"""
+        offset, _ = await self.getChatHistoryBounds(chat_uuid)
+        start = max(start, offset)
+        if end <= start:
+            return []
+        db = await self.get_or_create_client()
+        raw = await db.lrange(f"chat:{chat_uuid}:messages", start - offset, end - offset - 1) or []
+        return [Message.from_dict(json.loads(msg)) for msg in raw]
+    
+    async def getChatSummary(self, chat_uuid) -> Optional[dict]:
+        db = await self.get_or_create_client()
+        summary = await db.get(f"chat:{chat_uuid}:summary")
+        return json.loads(summary) if summary else None
+    
+    async def setChatSummary(self, chat_uuid, text: str, until: int, segments: int):
+        db = await self.get_or_create_client()
+        await db.set(f"chat:{chat_uuid}:summary", json.dumps({"text": text, "until": until, "segments": segments}))
+
     async def getOrFetchChatMessages(
             self, 
             chat_uuid, 
             incoming_message: Message,
-            min_context: int = 5
+            min_context: int = 5,
+            max_history: Optional[int] = None
         ) -> list[Message]:
-        db = await self.get_or_create_client()
-        range = await db.lrange(f"chat:{chat_uuid}:messages", 0, -1)
-        
-
-        range = range or []
-        prev_messages = [Message.from_dict(json.loads(msg)) for msg in range]
-        prev_msg_ids = [msg.uuid for msg in prev_messages]
-        
-        # for all indexes with 'tmp-' we generate a hash of the text and check if it matches the incoming message
-        import hashlib
-        tmp_msg_shas = {hashlib.sha256(msg.text.encode('utf-8')).hexdigest(): (msg.uuid, i) for i, msg in enumerate(prev_messages) if msg.uuid.startswith('tmp-')}
-        all_tmp_msg_shas = list(tmp_msg_shas.keys())
-
-        messages = await messages_list.asyncio(
-            chat_uuid=chat_uuid,
-            client=self.client,
-            page_size=min_context
-        )
-        fetched_msgs = list(reversed(messages.results))
-        for msg in fetched_msgs:
-            msg_sha = hashlib.sha256(msg.text.encode('utf-8')).hexdigest()
-            if msg_sha in all_tmp_msg_shas:
-                tmp_msg_uuid, tmp_msg_index = tmp_msg_shas[msg_sha]
-                prev_messages[tmp_msg_index] = msg
-                prev_msg_ids[tmp_msg_index] = msg.uuid
-                del tmp_msg_shas[msg_sha]
-                await db.lset(f"chat:{chat_uuid}:messages", tmp_msg_index, json.dumps(msg.to_dict()))
-                continue
-            prev_id_pos = prev_msg_ids.index(msg.uuid) if msg.uuid in prev_msg_ids else -1
-            if prev_id_pos != -1:
-                await db.lset(f"chat:{chat_uuid}:messages", prev_id_pos, json.dumps(msg.to_dict()))
-                prev_messages[prev_id_pos] = msg
-            else:
-                await db.rpush(f"chat:{chat_uuid}:messages", json.dumps(msg.to_dict()))
-                prev_messages.append(msg)
-                prev_msg_ids.append(msg.uuid)
-        
-        # check if the incoming message is already in the list
-        incoming_message_index = prev_msg_ids.index(incoming_message.uuid) if (incoming_message.uuid in prev_msg_ids) else -1
-        if incoming_message_index != -1:
-            await db.lset(f"chat:{chat_uuid}:messages", incoming_message_index, json.dumps(incoming_message.to_dict()))
-            prev_messages[incoming_message_index] = incoming_message
-        else:
-            await db.rpush(f"chat:{chat_uuid}:messages", json.dumps(incoming_message.to_dict()))
-            prev_messages.append(incoming_message)
+        min_context = int(min_context)
+        fetched_msgs = await self.flights.do(f"messages:{chat_uuid}", lambda: self.fetchNewChatMessages(chat_uuid, page_size=min_context))
 
-        messages = prev_messages
+        db = await self.get_or_create_client()
+        # upserts of one chat must not interleave their read & write pipelines
+        async with self.chatLock(chat_uuid):
+            async with db.pipeline(transaction=True) as pipe:
+                length = await self.upsertChatMessages(chat_uuid, fetched_msgs + [incoming_message], pipe=pipe)
+                if fetched_msgs:
+                    await self.setChatSyncState(chat_uuid, fetched_msgs[-1], pipe=pipe)
+                # only the tail the context window needs is read & parsed
+                pipe.lrange(f"chat:{chat_uuid}:messages", -min_context, -1)
+                results = await pipe.execute()
+        # takes the chat lock itself
+        await self.trimChatMessages(chat_uuid, max(int(max_history or bc.HISTORY_MAX_LENGTH), min_context), length=length)
+        messages = [Message.from_dict(json.loads(msg)) for msg in results[-1] or []]
 
-        pretty_updated_messages = await self.fmt.wrap_code(json.dumps([
+        await self.mng.debugSend("## Retrieving message from db\n - in chat {chat_uuid}\n{messages}", None, verbose=3, chat_uuid=chat_uuid, messages=lambda: self.fmt.pretty_json([
             msg.to_dict() for msg in messages
-        ], indent=4))
-        await self.mng.debugSend(f"## Retrieving message from db\n - in chat {chat_uuid}\n{pretty_updated_messages}", None, verbose=3)
+        ]))
         return messages
     
     async def getChat(self, chat_uuid) -> Optional[ChatResult]:
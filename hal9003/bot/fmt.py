@@ -3,6 +3,12 @@ from typing import Optional, Union
 import json
 import dataclasses
 from datetime import datetime
+import attrs
+from bot import config as bc
+from bot.tokens import TokenCounter, COUNTER, TOKENS_PER_MESSAGE, TOKENS_PER_REPLY
+
+# appended to messages that were cut to fit the token budget
+TRUNCATED_SUFFIX = " [...]"
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -34,8 +40,17 @@ class JSONDecoder(json.JSONDecoder):
         return ret
 
 class Formatter:
+
+    tokens: TokenCounter = COUNTER
     
-    async def openai_user_messages(self, messages: list[Message], bot_uuid="none", context: Optional[Union[int, str]] = 5):
+    async def openai_user_messages(
+            self,
+            messages: list[Message],
+            bot_uuid="none",
+            context: Optional[Union[int, str]] = 5,
+            token_budget: Optional[int] = None,
+            model: Optional[str] = None
+        ):
         if isinstance(context, str):
             context = int(context)
         out_messages = []
@@ -43,14 +58,60 @@ class Formatter:
         print("Context", context)
         if context:
             window_messages = messages[-context:]
+        if token_budget is not None:
+            window_messages = self.pack_messages(window_messages, token_budget, model=model)
             
         for msg in window_messages:
-            out_messages.append({
-                "role": "user" if msg.sender != bot_uuid else "assistant",
-                "content": msg.text
-            })
+            out_messages.append(self.render_message(msg, bot_uuid))
         return out_messages
     
+    def render_message(self, msg: Message, bot_uuid="none") -> dict:
+        return {
+            "role": "user" if msg.sender != bot_uuid else "assistant",
+            "content": msg.text
+        }
+
+    def pack_counts(self, counts: list[int], token_budget: int, model: Optional[str] = None) -> tuple[int, Optional[int]]:
+        """
+        Fills `token_budget` from the newest to the oldest message token count, the newest message is always kept.
+        A message that doesn't fit anymore is truncated (`CONTEXT_TRUNCATE_MESSAGES`) if at least
+        `CONTEXT_MIN_TRUNCATE_TOKENS` of its text fit, a newest message that can't be truncated is kept whole.
+        Returns the index of the oldest kept message and the tokens it may use if it has to be truncated.
+        """
+        budget = token_budget - TOKENS_PER_REPLY
+        start = len(counts)
+        for i in range(len(counts) - 1, -1, -1):
+            if counts[i] <= budget:
+                budget -= counts[i]
+                start = i
+                continue
+            # the truncated text plus its suffix have to fit
+            left = budget - TOKENS_PER_MESSAGE - self.tokens.count(TRUNCATED_SUFFIX, model)
+            if bc.CONTEXT_TRUNCATE_MESSAGES and left >= bc.CONTEXT_MIN_TRUNCATE_TOKENS:
+                return i, left
+            if start == len(counts):
+                # e.g.: the system prompt used up the budget, cutting the question down to nothing doesn't help
+                return i, None
+            break
+        return start, None
+
+    def pack_messages(self, messages: list[Message], token_budget: int, model: Optional[str] = None) -> list[Message]:
+        start, truncate = self.pack_counts([self.tokens.countMessage(msg, model) for msg in messages], token_budget, model)
+        packed = messages[start:]
+        if truncate is not None:
+            text = self.tokens.truncate(packed[0].text, truncate, model)
+            packed[0] = attrs.evolve(packed[0], text=text + TRUNCATED_SUFFIX)
+        return packed
+
+    def pack_rendered(self, rendered: list[dict], token_budget: int, model: Optional[str] = None) -> list[dict]:
+        """Same as `pack_messages` for pre-rendered `{"message": ..., "tokens": ...}` entries"""
+        start, truncate = self.pack_counts([entry["tokens"] for entry in rendered], token_budget, model)
+        packed = [entry["message"] for entry in rendered[start:]]
+        if truncate is not None:
+            text = self.tokens.truncate(packed[0]["content"], truncate, model)
+            packed[0] = {**packed[0], "content": text + TRUNCATED_SUFFIX}
+        return packed
+
     async def remove_code(self, text):
         return text.replace("`", "")
     
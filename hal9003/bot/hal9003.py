@@ -10,16 +10,25 @@ from dataclasses import dataclass
 import asyncio
 import json
 import uuid
-from bot.manager import Manager, MessageContext
+import re
+from typing import Optional
+from bot.manager import Manager, MessageContext, PartialEncoding, DebugEntry
 from bot.db import DB
 from bot.cmd import CommandProcessor
 from bot import config as bc
 from bot.fmt import Formatter
-from agent import models
+from bot.stream import StreamCoalescer
+from bot.sink import DebugSink
+from bot.scheduler import ChatScheduler
+from bot import tokens
+from bot.summary import ChatSummarizer
+from bot.response_cache import ResponseCache
+from agent import models, clients, limits
 from datetime import datetime
 
 GLOBAL_REDIS_URL = bc.REDIS_URL
 GLOBAL_API_CLIENT = None
+GLOBAL_BOT_USER = None
 COMMAND_PREFIXES = ['/', '!']
 
 from multiprocessing import Process
@@ -34,13 +43,17 @@ class Hal9003(WebSocketClientProtocol):
 
     def __init__(self):
         super().__init__()
-        self.db = DB(self, redis_url=GLOBAL_REDIS_URL, client=GLOBAL_API_CLIENT)
+        self.db = DB(self, redis_url=GLOBAL_REDIS_URL, client=GLOBAL_API_CLIENT, bot_user=GLOBAL_BOT_USER)
 
         self.mng = Manager(self, db=self.db)
         self.cmd = CommandProcessor(self, db=self.db)
-        model_backend = models.BACKENDS[bc.MODEL_BACKEND]
-        self.ai_client = AsyncOpenAI(api_key=model_backend.api_key, base_url=model_backend.base_url)
-        self.queue = asyncio.Queue()
+        self.model_backend = models.BACKENDS[bc.MODEL_BACKEND]
+        self.ai_client = clients.get_async_client(self.model_backend)
+        self.debug_sink = DebugSink(self.mng)
+        self.partial_encoding = bc.PARTIAL_MESSAGE_ENCODING
+        self.scheduler = ChatScheduler()
+        self.summarizer = ChatSummarizer(self.db, self.ai_client, backend=self.model_backend)
+        self.response_cache = ResponseCache(self.db)
 
     async def processCommandMessage(self, context: MessageContext):
         text = context.message.text
@@ -54,13 +67,10 @@ class Hal9003(WebSocketClientProtocol):
         db_chat = await self.db.getChat(context.chat.uuid)
         if db_chat is None:
             await self.db.setChat(context.chat.uuid, context.chat)
-            # check if the chat is loaded in 'db'
-            db_chat = await self.db.getChat(context.chat.uuid)
-            pretty_chat_json = await self.fmt.wrap_code(json.dumps(db_chat.to_dict(), indent=4))
-            await self.mng.debugSend(f"Chat not found in db, created new chat\n - {context.chat.uuid}\n{pretty_chat_json}", context, verbose=2)
+            db_chat = context.chat
+            await self.mng.debugSend("Chat not found in db, created new chat\n - {chat_uuid}\n{chat}", context, verbose=2, chat_uuid=context.chat.uuid, chat=lambda: self.fmt.pretty_json(db_chat.to_dict()))
         else:
-            pretty_chat_json = await self.fmt.wrap_code(json.dumps(db_chat.to_dict(), indent=4))
-            await self.mng.debugSend(f"Chat found in db\n - {context.chat.uuid}\n{pretty_chat_json}", context, verbose=3)
+            await self.mng.debugSend("Chat found in db\n - {chat_uuid}\n{chat}", context, verbose=3, chat_uuid=context.chat.uuid, chat=lambda: self.fmt.pretty_json(db_chat.to_dict()))
             
         await self.aiChatResponse(context)
         
@@ -69,72 +79,153 @@ class Hal9003(WebSocketClientProtocol):
         _, config = await self.db.getOrCreateChatSettings(context.chat.uuid, mc=context)
 
         # 1 - get the chat messages
-        message_history = await self.db.getOrFetchChatMessages(context.chat.uuid, incoming_message=context.message, min_context=config.context)
-        pretty_message_history_json = await self.fmt.wrap_code(json.dumps([msg.to_dict() for msg in message_history], indent=4))
-        await self.mng.debugSend(f"## Chat history\n - in chat `{context.chat.uuid}`\n - by sender `{context.senderId}`\n> {context.message.text}\n{pretty_message_history_json}", context, verbose=2)
+        # at most the chat's message `context`, the token budget trims inside that window
+        window = min(int(config.context), bc.CONTEXT_MAX_MESSAGES)
+        message_history = await self.db.getOrFetchChatMessages(context.chat.uuid, incoming_message=context.message, min_context=window, max_history=config.maxHistory)
+        await self.mng.debugSend("## Chat history\n - in chat `{chat_uuid}`\n - by sender `{sender}`\n> {message_text}\n{history}", context, verbose=2,
+            chat_uuid=context.chat.uuid, sender=context.senderId, message_text=context.message.text,
+            history=lambda: self.fmt.pretty_json([msg.to_dict() for msg in message_history]))
         bot_user = await self.db.getOrFetchBotUser()
-        user_messages = await self.fmt.openai_user_messages(message_history, bot_uuid=bot_user.uuid, context=config.context)
-        messages = [
+        system_messages = [
             {
                 "role": "system",
                 "content": config.systemPrompt
-            },
+            }
+        ]
+        summary = await self.db.getChatSummary(context.chat.uuid) if bc.SUMMARY_ENABLED else None
+        if summary:
+            # the summarized messages are not sent a second time
+            last_covered = await self.db.getChatMessagesRange(context.chat.uuid, summary["until"] - 1, summary["until"])
+            covered_uuids = [msg.uuid for msg in message_history]
+            if last_covered and last_covered[0].uuid in covered_uuids:
+                message_history = message_history[covered_uuids.index(last_covered[0].uuid) + 1:]
+            system_messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{summary['text']}"
+            })
+        await self.fmt.tokens.loadEncoding(config.model)
+        # the system prompt & summary are always sent, the history gets what is left of the budget
+        token_budget = tokens.tokenBudget(config.model, config.tokenBudget) - sum(
+            self.fmt.tokens.count(msg["content"], config.model) + tokens.TOKENS_PER_MESSAGE for msg in system_messages)
+        rendered = await self.db.renderChatMessages(context.chat.uuid, message_history, bot_user.uuid, model=config.model)
+        user_messages = self.fmt.pack_rendered(rendered, token_budget, model=config.model)
+        messages = [
+            *system_messages,
             *user_messages
         ]
         
-        pretty_messages_json = await self.fmt.wrap_code(json.dumps(messages, indent=4))
-        await self.mng.debugSend(f"## AI Response triggered\n> {context.message.text}\n - in chat `{context.chat.uuid}`\n - by sender `{context.senderId}`\n- with model `{config.model}`\n{pretty_messages_json}", context, verbose=2)
+        await self.mng.debugSend("## AI Response triggered\n> {message_text}\n - in chat `{chat_uuid}`\n - by sender `{sender}`\n- with model `{model}`\n{messages}", context, verbose=2,
+            message_text=context.message.text, chat_uuid=context.chat.uuid, sender=context.senderId, model=config.model,
+            messages=lambda: self.fmt.pretty_json(messages))
+
+        temperature = config.temperature
+        cacheable = self.response_cache.cacheable(temperature)
+        if cacheable:
+            cached = await self.response_cache.get(config.model, messages, temperature)
+            if cached is not None:
+                await self.replayResponse(context, cached, bot_user)
+                return
 
-        response = await self.ai_client.chat.completions.create(
-            model=config.model,
-            stream=True,
-            messages=messages        
+        completion_params = {}
+        if temperature is not None:
+            completion_params["temperature"] = temperature
+        # the limits cover starting the stream, the scheduler's workers bound the streams themselves
+        response = await limits.LIMITER.call_async(
+            self.model_backend,
+            lambda: self.ai_client.chat.completions.create(
+                model=config.model,
+                stream=True,
+                messages=messages,
+                **completion_params
+            ),
+            tokens=limits.estimate_tokens(messages)
         )
         
-        full_response = ""
-        
+        stream = StreamCoalescer(self.mng, context)
+        try:
+            full_response = await self.streamResponse(context, response, stream, bot_user)
+        except asyncio.CancelledError:
+            # superseded by a newer message, closing the stream stops the generation
+            await response.close()
+            partial_response = stream.interrupt()
+            # cancelled after `finish`, the reply is already stored as `tmp-` message or fetched from the server
+            if partial_response and not stream.finished:
+                interrupted = Message(
+                    uuid=f"interrupted-{uuid.uuid4()}",
+                    sender=bot_user.uuid,
+                    created=datetime.now(),
+                    text=partial_response,
+                    read=False
+                )
+                interrupted.additional_properties['interrupted'] = True
+                await self.db.addChatMessage(context.chat.uuid, interrupted)
+            await self.mng.debugSend("## AI Response interrupted\n - in chat `{chat_uuid}`\n> {partial_response}\n - stream: {stream}", context, verbose=2,
+                chat_uuid=context.chat.uuid, partial_response=partial_response, stream=lambda: stream.stats.to_dict())
+            raise
+        if cacheable and full_response:
+            await self.response_cache.set(config.model, messages, temperature, full_response)
+        # off the reply path, the next turn picks up the updated summary
+        self.summarizer.schedule(context.chat.uuid, config.model)
+
+    async def streamResponse(self, context: MessageContext, response, stream: StreamCoalescer, bot_user) -> Optional[str]:
         async for chunk in response:
             # await self.mng.debugSend(f"## AI Response chunk\n - in chat `{context.chat.uuid}`\n - by sender `{context.senderId}`\n> {chunk}", context)
             delta = chunk.choices[0].delta.content
             finished = chunk.choices[0].finish_reason
             if finished:
-                await self.mng.sendChatMessage(context, full_response)
-                # generate a random tmp uuid
-                tmp_uuid = str(uuid.uuid4())
-                usage = getattr(chunk, 'usage', None)
-                if usage:
-                    await self.mng.debugSend(f"## AI Response steam completed\n - in chat `{context.chat.uuid}`\n - by sender `{context.senderId}`\n> {full_response}\n - usage: {usage}", context)
-                await self.db.addChatMessage(context.chat.uuid, Message(
-                    uuid=f"tmp-{tmp_uuid}",
-                    sender=bot_user.uuid,
-                    created=datetime.now(),
-                    text=full_response,
-                    read=False
-                ))
-                await self.mng.debugSend(f"## AI Response steam completed\n - in chat `{context.chat.uuid}`\n - by sender `{context.senderId}`\n> {full_response}", context)
+                return await self.finishResponse(context, stream, bot_user, usage=getattr(chunk, 'usage', None))
             elif delta:
-                full_response += delta
-                await self.mng.sendPartialMessage(context, full_response)
+                await stream.push(delta)
+        return None
+
+    async def replayResponse(self, context: MessageContext, text: str, bot_user):
+        """Sends a cached reply through the same partial message stream as a live one"""
+        stream = StreamCoalescer(self.mng, context)
+        for delta in re.findall(r"\s*\S+", text):
+            await stream.push(delta)
+        await self.mng.debugSend("## AI Response replayed from cache\n - in chat `{chat_uuid}`", context, verbose=2, chat_uuid=context.chat.uuid)
+        return await self.finishResponse(context, stream, bot_user)
+
+    async def finishResponse(self, context: MessageContext, stream: StreamCoalescer, bot_user, usage=None) -> str:
+        full_response = await stream.finish()
+        # generate a random tmp uuid
+        tmp_uuid = str(uuid.uuid4())
+        await self.db.addChatMessage(context.chat.uuid, Message(
+            uuid=f"tmp-{tmp_uuid}",
+            sender=bot_user.uuid,
+            created=datetime.now(),
+            text=full_response,
+            read=False
+        ))
+        await self.mng.debugSend("## AI Response stream completed\n - in chat `{chat_uuid}`\n - by sender `{sender}`\n> {full_response}\n - stream: {stream}\n - usage: {usage}", context,
+            chat_uuid=context.chat.uuid, sender=context.senderId, full_response=full_response, stream=lambda: stream.stats.to_dict(), usage=usage)
+        return full_response
     
     async def _newMessage(self, context: MessageContext):
-        pretty_message_json = await self.fmt.wrap_code(json.dumps(context.message.to_dict(), indent=4))
-        debug_message = f"## Message\n> {context.message.text}\n- from `{context.senderId}`\n- in chat `{context.chat.uuid}`\n" + pretty_message_json
-        
         # If it's debug chat - complain
         chat_settings, config = await self.db.getOrCreateChatSettings(context.chat.uuid)
         if chat_settings.title == bc.GLOBAL_DEBUG_CHAT_TITLE:
-            if context.message.text == "DEBUG":
+            if context.message.text.startswith("VERBOSE"):
+                # e.g. 'VERBOSE 1' to only receive errors
+                try:
+                    self.debug_sink.verbosity = int(context.message.text.split()[-1])
+                    await self.mng.debugSend(f"Debug verbosity set to {self.debug_sink.verbosity}", context, verbose=1)
+                except ValueError:
+                    await self.mng.debugSend(f"Invalid verbosity: `{context.message.text}`", context, verbose=1)
+            elif context.message.text == "DEBUG":
                 current_debug = await self.db.shouldDebug()
                 if current_debug:
-                    await self.mng.debugSend(f"Debug mode toggled to {not current_debug}", context)
+                    await self.mng.debugSend(f"Debug mode toggled to {not current_debug}", context, verbose=1)
                 await self.db.setDebug(not current_debug)
                 if not current_debug:
-                    await self.mng.debugSend(f"Debug mode toggled to {not current_debug}", context)
+                    await self.mng.debugSend(f"Debug mode toggled to {not current_debug}", context, verbose=1)
             else:
-                await self.mng.debugSend("DON'T TALK TO ME IN DEBUG CHAT", context)
+                await self.mng.debugSend("DON'T TALK TO ME IN DEBUG CHAT", context, verbose=1)
             return
 
-        await self.mng.debugSend(debug_message, context)
+        await self.mng.debugSend("## Message\n> {message_text}\n- from `{sender}`\n- in chat `{chat_uuid}`\n{message}", context,
+            message_text=context.message.text, sender=context.senderId, chat_uuid=context.chat.uuid,
+            message=lambda: self.fmt.pretty_json(context.message.to_dict()))
         # check if the message is a 'command'
         if context.message.text.startswith(tuple(COMMAND_PREFIXES)):
             # command detected
@@ -155,10 +246,16 @@ class Hal9003(WebSocketClientProtocol):
                 del chat['settings'] # remove None settings
             mc = MessageContext(Message.from_dict(message), senderId, ChatResult.from_dict(chat))
             try:
-                await asyncio.create_task(self._newMessage(mc))
+                await self._newMessage(mc)
             except Exception as ex:
-                trace = await self.fmt.wrap_code(traceback.format_exc())
-                await self.mng.debugSend(f"## Error \n> {ex}\n - while processing message\n" + trace, mc)
+                trace = traceback.format_exc()
+                await self.mng.debugSend("## Error \n> {ex}\n - while processing message\n{trace}", mc, verbose=1,
+                    ex=ex, trace=lambda: self.fmt.wrap_code(trace))
+        elif action == 'partial_encoding':
+            # the server announces which `partial_message` encoding it can decode
+            encoding = payload.get('encoding')
+            if encoding in (PartialEncoding.FULL, PartialEncoding.DELTA):
+                self.partial_encoding = encoding
 
     def onConnect(self, response):
         print("Server connected: {0}".format(response.peer))
@@ -184,18 +281,11 @@ class Hal9003(WebSocketClientProtocol):
                     message = None
                 if message:
                     print("Received: '%s'" % message)
-                    self.queue.put_nowait(("Received PIPE: '%s'" % message, None))                     
+                    self.debug_sink.put(DebugEntry("Received PIPE: '%s'" % message))
                 if message == "EXIT":
                     print("Exiting")
                     break
 
-    async def process_queue(self):
-        import time
-        while True:
-            message, context = await self.queue.get()
-            await self.mng.debugSend(message, context)
-            self.queue.task_done()
-
     async def start_http_server(self):
         self.app = web.Application()
         self.app.add_routes([
@@ -228,9 +318,7 @@ class Hal9003(WebSocketClientProtocol):
     async def http_langsmith_internal(self, request):
         data = await request.json()
         
-        pretty = await self.fmt.wrap_code(json.dumps(data, indent=4))
-        
-        await self.mng.debugSend(pretty, None)
+        await self.mng.debugSend(lambda: self.fmt.pretty_json(data), None)
         return web.json_response({'status': 'message received'})
         
     async def http_message_send(self, request):
@@ -258,35 +346,67 @@ class Hal9003(WebSocketClientProtocol):
         # curl -d '{"message":"Hello world!"}' -H "Content-Type: application/json" -X POST http://localhost:8080/debugSend
         return web.json_response({'status': 'message received'})
 
+    async def onStartup(self):
+        # the bot user must only be shared after the flush
+        await self.db.flush()
+        await self.db.refreshBotUser(self.db.bot_user)
+        await self.fmt.tokens.loadEncoding()
+        await self.mng.debugSend("Connected to server\n - Flushed db", None)
+
     def onOpen(self):
         print("WebSocket connection open.")
         # fulsh the db on connection open
         print("Flushing db (per default on startup)")
-        asyncio.ensure_future(self.db.flush())
-        asyncio.ensure_future(self.db.getOrFetchBotUser())
-        asyncio.ensure_future(self.mng.debugSend("Connected to server\n - Flushed db", None))
+        self.debug_sink.start()
+        self.scheduler.start()
+        self.db.startSettingsInvalidationListener()
+        asyncio.ensure_future(self.onStartup())
         asyncio.create_task(self.start_http_server())
 
         
-    async def process_message(self, payload):
+    def scheduleMessage(self, payload):
         data = json.loads(payload.decode('utf8'))
         data_type = data.get('type')
         data = data.get('data')
         if data_type == 'custom':
             action = data.get('action')
             payload = data.get('payload')
-            await self.onProcessCustomMessage(action, payload)
+            # messages of one chat are processed in order, other actions are queued by their name
+            key = payload['chat']['uuid'] if action == 'newMessage' else action
+            supersedable = bc.SUPERSEDE_COMPLETIONS and action == 'newMessage' and \
+                not payload['message']['text'].startswith(tuple(COMMAND_PREFIXES))
+            if supersedable and self.scheduler.supersede(key):
+                print("Superseded pending replies in chat", key)
+            if not self.scheduler.submit(key, lambda: self.onProcessCustomMessage(action, payload), supersedable=supersedable):
+                asyncio.ensure_future(self.rejectMessage(action, payload))
         else:
             print("Unknown message type", data_type)
 
+    async def rejectMessage(self, action, payload):
+        print("Chat queue full, rejected:", action)
+        if action != 'newMessage':
+            return
+        chat = payload.get('chat')
+        if 'settings' in chat and chat['settings'] is None:
+            del chat['settings']
+        mc = MessageContext(Message.from_dict(payload.get('message')), payload.get('senderId'), ChatResult.from_dict(chat))
+        await self.mng.sendChatMessage(mc, f"Too many pending messages in this chat ({self.scheduler.depth(mc.chat.uuid)}), please wait for the current replies.")
+        await self.mng.debugSend("## Message rejected, chat queue full\n - in chat `{chat_uuid}`\n{stats}", mc, verbose=1,
+            chat_uuid=mc.chat.uuid, stats=lambda: self.fmt.pretty_json(self.scheduler.to_dict(mc.chat.uuid)))
+
     def onMessage(self, payload, isBinary):
         if isBinary:
             raise Exception("NOT IMPLEMENTED! Binary message received: {0} bytes".format(len(payload)))
-        asyncio.ensure_future(self.process_message(payload))
+        self.scheduler.start()
+        self.scheduleMessage(payload)
 
 
     def onClose(self, wasClean, code, reason):
         print("WebSocket connection closed: {0}".format(reason))
+        self.debug_sink.stop()
+        self.scheduler.stop()
+        self.summarizer.stop()
+        self.db.stopSettingsInvalidationListener()
         try:
             asyncio.ensure_future(self.site.stop())
             asyncio.ensure_future(self.app.cleanup())
@@ -1,8 +1,15 @@
-from typing import Optional
+from typing import Any, Optional
 import json
-from dataclasses import dataclass
+import inspect
+from dataclasses import dataclass, field
 from open_chat_api_client.models import Message, ChatResult
-from bot.config import GLOBAL_DEBUG_CHAT_TITLE
+from bot.config import GLOBAL_DEBUG_CHAT_TITLE, DEBUG_VERBOSITY, HISTORY_MAX_LENGTH
+
+class PartialEncoding:
+    # every `partial_message` carries the full accumulated text
+    FULL = "full"
+    # only the appended suffix with its `offset` and a `seq` number, regular full `resync` frames
+    DELTA = "delta"
 
 @dataclass
 class MessageContext:
@@ -10,17 +17,36 @@ class MessageContext:
     senderId: str
     chat: ChatResult
 
+@dataclass
+class DebugEntry:
+    text: Any
+    context: Optional[MessageContext] = None
+    verbose: int = 3
+    template_args: dict = field(default_factory=dict)
+
 @dataclass
 class ChatConfig:
     model: str
     context: int = 5
     systemPrompt: str = "You are a helpful assistant."
+    maxHistory: int = HISTORY_MAX_LENGTH
+    # input tokens per turn, 0 derives it from the model's context window
+    tokenBudget: int = 0
+    # None keeps the model's default, only 0 makes replies cacheable
+    temperature: Optional[float] = None
+
+    def __post_init__(self):
+        # settings set through `/chat --set` arrive as strings, a bad value fails like any invalid config
+        self.temperature = None if self.temperature in (None, "") else float(self.temperature)
     
     def to_dict(self):
         return {
             "model": self.model,
             "context": self.context,
-            "systemPrompt": self.systemPrompt
+            "systemPrompt": self.systemPrompt,
+            "maxHistory": self.maxHistory,
+            "tokenBudget": self.tokenBudget,
+            "temperature": self.temperature
         }
 
 
@@ -30,38 +56,90 @@ class Manager:
         self.bot = bot
         self.db = db
         
-    def syncSendCustomMessage(self, action, payload):
+    def syncSendCustomMessage(self, action, payload, encoding=None):
+        data = {
+            'action': action,
+            'payload': payload
+        }
+        if encoding:
+            data['encoding'] = encoding
         return self.bot.sendMessage(json.dumps({
             'type': 'custom',
-            'data': {
-                'action': action,
-                'payload': payload
-            }
+            'data': data
         }).encode('utf-8'), isBinary=False)
     
-    async def sendCustomMessage(self, action, payload):
+    async def sendCustomMessage(self, action, payload, encoding=None):
         # check if the chat is loaded in 'db'
-        return self.syncSendCustomMessage(action, payload)
+        return self.syncSendCustomMessage(action, payload, encoding=encoding)
         
-    async def debugSend(self, text, messageContext: Optional[MessageContext] = None, verbose=3):
-        # TODO: Implement verbose levels
+    async def renderDebug(self, text, **template_args):
+        """
+        Debug texts and template arguments can be plain values, callables or coroutine functions,
+        they are only evaluated here so nothing is rendered when debug is off
+        """
+        async def _resolve(value):
+            if callable(value):
+                value = value()
+            if inspect.isawaitable(value):
+                value = await value
+            return value
+
+        text = await _resolve(text)
+        if template_args:
+            text = text.format(**{key: await _resolve(value) for key, value in template_args.items()})
+        return text
+        
+    def debugSink(self):
+        return getattr(self.bot, 'debug_sink', None)
+
+    def scheduler(self):
+        return getattr(self.bot, 'scheduler', None)
+    
+    async def renderDebugEntry(self, entry: DebugEntry):
         debug_label = "DEBUG: "
-        if messageContext:
-            debug_label = f"DEBUG: Chat: {messageContext.chat.uuid}, Sender: {messageContext.senderId}\n"
+        if entry.context:
+            debug_label = f"DEBUG: Chat: {entry.context.chat.uuid}, Sender: {entry.context.senderId}\n"
         debug_label = await self.bot.fmt.wrap_code(debug_label)
+        text = await self.renderDebug(entry.text, **entry.template_args)
+        return debug_label + "\n" + text
+    
+    def sendDebugText(self, text):
+        return self.syncSendCustomMessage('send_message_chat_title', {
+            'chat_title': GLOBAL_DEBUG_CHAT_TITLE,
+            'text': text
+        })
+        
+    async def debugSend(self, text, messageContext: Optional[MessageContext] = None, verbose=3, **template_args):
+        # verbose 1 = errors & important events ... 3 = everything
+        sink = self.debugSink()
+        if not (sink.accepts(verbose) if sink else verbose <= DEBUG_VERBOSITY):
+            return
         debug = await self.db.shouldDebug()
-        if debug:
-            self.syncSendCustomMessage('send_message_chat_title', {
-                'chat_title': GLOBAL_DEBUG_CHAT_TITLE,
-                'text': debug_label + "\n" + text
-            })
+        if not debug:
+            return
+        entry = DebugEntry(text, messageContext, verbose, template_args)
+        if sink and sink.running:
+            # rendered and sent by the sink worker, off the reply path
+            sink.put(entry)
+        else:
+            self.sendDebugText(await self.renderDebugEntry(entry))
         
-    async def sendPartialMessage(self, context: MessageContext, text):
-        return await self.sendCustomMessage('partial_message', {
+    def partialEncoding(self):
+        return getattr(self.bot, 'partial_encoding', PartialEncoding.FULL)
+        
+    async def sendPartialMessage(self, context: MessageContext, text, encoding=None, offset=0, seq=0, resync=False):
+        payload = {
             'chat_id': context.chat.uuid,
             'recipient_id': context.senderId,
             'text': text
-        })
+        }
+        if encoding == PartialEncoding.DELTA:
+            payload.update({
+                'offset': offset,
+                'seq': seq,
+                'resync': resync
+            })
+        return await self.sendCustomMessage('partial_message', payload, encoding=encoding)
         
     async def sendChatMessage(self, context: MessageContext, text):
         return await self.sendCustomMessage('send_message', {
@@ -0,0 +1,130 @@
+import re
+import json
+import math
+import hashlib
+import threading
+from typing import Optional
+from bot.cache import LRUCache
+from bot import config as bc
+
+def normalizeText(text: str) -> str:
+    return " ".join((text or "").split())
+
+def cacheKey(model: str, messages: list[dict], temperature: Optional[float] = None) -> str:
+    """Hash of the completion request, whitespace differences don't change the key"""
+    data = {
+        "model": model,
+        "temperature": temperature,
+        "messages": [{"role": msg["role"], "content": normalizeText(msg["content"])} for msg in messages]
+    }
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+def embed(text: str, dims: int = 256) -> list[float]:
+    """
+    Local hashed bag of words & bigrams embedding, normalized so the dot product is the cosine similarity.
+    Good enough to match rephrasings of short questions, no model or network call needed.
+    """
+    words = re.findall(r"\w+", text.lower())
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    vector = [0.0] * dims
+    for feature in features:
+        digest = hashlib.md5(feature.encode('utf-8')).digest()
+        index = int.from_bytes(digest[:4], 'little') % dims
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    return [value / norm for value in vector] if norm else vector
+
+def similarity(a: list[float], b: list[float]) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+class ResponseCache:
+    """
+    Completion responses by request hash, in-process LRU in front of redis (if a db is given).
+    The optional semantic tier matches the last user message by embedding similarity
+    among cached requests that share everything before it.
+    The in-process tiers are shared with the agent's worker threads, `lock` guards them and the counters.
+    """
+
+    def __init__(self, db=None, maxsize: int = None, ttl: float = None, semantic: bool = None, threshold: float = None):
+        self.db = db
+        self.ttl = bc.RESPONSE_CACHE_TTL if ttl is None else ttl
+        self.local = LRUCache(maxsize=maxsize or bc.RESPONSE_CACHE_SIZE, ttl=self.ttl)
+        self.semantic = bc.RESPONSE_CACHE_SEMANTIC if semantic is None else semantic
+        self.threshold = threshold or bc.RESPONSE_CACHE_THRESHOLD
+        # request prefix hash -> [(embedding, response)]
+        self.vectors = LRUCache(maxsize=maxsize or bc.RESPONSE_CACHE_SIZE, ttl=self.ttl)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def cacheable(self, temperature: Optional[float]) -> bool:
+        # sampled answers are only reused if explicitly allowed
+        return bc.RESPONSE_CACHE_ENABLED and (temperature == 0 or bc.RESPONSE_CACHE_ANY_TEMPERATURE)
+
+    def getLocal(self, model: str, messages: list[dict], temperature: Optional[float] = None) -> Optional[str]:
+        with self.lock:
+            response = self.local.get(cacheKey(model, messages, temperature))
+        if response is None:
+            response = self.getSimilar(model, messages, temperature)
+        return response
+
+    def getSimilar(self, model: str, messages: list[dict], temperature: Optional[float] = None) -> Optional[str]:
+        if not self.semantic or not messages:
+            return None
+        with self.lock:
+            candidates = self.vectors.get(cacheKey(model, messages[:-1], temperature))
+        if not candidates:
+            return None
+        vector = embed(messages[-1]["content"])
+        score, response = max(((similarity(vector, other), response) for other, response in candidates), key=lambda match: match[0])
+        if score < self.threshold:
+            return None
+        with self.lock:
+            self.semantic_hits += 1
+        return response
+
+    def setLocal(self, model: str, messages: list[dict], temperature: Optional[float], response: str):
+        vector = embed(messages[-1]["content"]) if self.semantic and messages else None
+        with self.lock:
+            self.local.set(cacheKey(model, messages, temperature), response)
+            if vector is not None:
+                prefix = cacheKey(model, messages[:-1], temperature)
+                candidates = self.vectors.get(prefix) or []
+                candidates = (candidates + [(vector, response)])[-bc.RESPONSE_CACHE_SEMANTIC_CANDIDATES:]
+                self.vectors.set(prefix, candidates)
+            self.stores += 1
+
+    async def get(self, model: str, messages: list[dict], temperature: Optional[float] = None) -> Optional[str]:
+        response = self.getLocal(model, messages, temperature)
+        if response is None and self.db is not None:
+            client = await self.db.get_or_create_client()
+            response = await client.get(f"response:{cacheKey(model, messages, temperature)}")
+            if response is not None:
+                with self.lock:
+                    self.local.set(cacheKey(model, messages, temperature), response)
+        with self.lock:
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return response
+
+    async def set(self, model: str, messages: list[dict], temperature: Optional[float], response: str):
+        self.setLocal(model, messages, temperature, response)
+        if self.db is not None:
+            client = await self.db.get_or_create_client()
+            await client.set(f"response:{cacheKey(model, messages, temperature)}", response, ex=int(self.ttl) or None)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "enabled": bc.RESPONSE_CACHE_ENABLED,
+                "semantic": self.semantic,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "local": self.local.to_dict()
+            }
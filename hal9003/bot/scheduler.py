@@ -0,0 +1,153 @@
+import time
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable, Optional
+from bot.cache import LRUCache
+from bot import config as bc
+
+@dataclass
+class ScheduledJob:
+    key: Hashable
+    fn: Callable[[], Awaitable[Any]]
+    # only supersedable jobs are dropped or cancelled by a newer message of the chat
+    supersedable: bool = False
+    superseded: bool = False
+    enqueued: float = field(default_factory=time.monotonic)
+    task: Optional[asyncio.Future] = None
+
+@dataclass
+class ChatQueueStats:
+    processed: int = 0
+    rejected: int = 0
+    superseded: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+    def add_wait(self, wait: float):
+        self.processed += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def to_dict(self):
+        return {
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "superseded": self.superseded,
+            "wait_avg": round(self.wait_total / self.processed, 3) if self.processed else None,
+            "wait_max": round(self.wait_max, 3)
+        }
+
+class ChatScheduler:
+    """
+    Per-chat FIFO queues worked off by a fixed number of workers.
+    Jobs of one chat never run concurrently, chats with pending jobs take turns round-robin.
+    """
+
+    def __init__(self, workers: int = None, max_queue: int = None):
+        self.workers = workers or bc.MAX_CONCURRENT_COMPLETIONS
+        self.max_queue = max_queue or bc.CHAT_QUEUE_SIZE
+        self.queues: dict[Hashable, deque] = {}
+        # a chat is `waiting` in `ready` while it has pending jobs and none of them is running
+        self.ready: asyncio.Queue = asyncio.Queue()
+        self.waiting: set = set()
+        self.running: dict[Hashable, ScheduledJob] = {}
+        # stats outlive the queues, bounded to the most recently active chats
+        self.stats = LRUCache(maxsize=1024, ttl=0)
+        self.tasks: list[asyncio.Task] = []
+
+    def depth(self, key: Hashable) -> int:
+        return len(self.queues.get(key, ()))
+
+    def submit(self, key: Hashable, fn: Callable[[], Awaitable[Any]], supersedable: bool = False) -> bool:
+        """Queues `fn` behind the other jobs of the chat, returns False if the chat queue is full"""
+        queue = self.queues.setdefault(key, deque())
+        if len(queue) >= self.max_queue:
+            self.chatStats(key).rejected += 1
+            return False
+        queue.append(ScheduledJob(key, fn, supersedable=supersedable))
+        self.markReady(key)
+        return True
+
+    def markReady(self, key: Hashable):
+        if key not in self.running and key not in self.waiting:
+            self.waiting.add(key)
+            self.ready.put_nowait(key)
+
+    def supersede(self, key: Hashable) -> int:
+        """Drops the pending and cancels the running supersedable jobs of the chat, returns how many"""
+        queue = self.queues.get(key)
+        superseded = 0
+        if queue:
+            kept = [job for job in queue if not job.supersedable]
+            superseded += len(queue) - len(kept)
+            queue.clear()
+            queue.extend(kept)
+        job = self.running.get(key)
+        if job and job.supersedable and not job.superseded and job.task:
+            job.superseded = True
+            job.task.cancel()
+            superseded += 1
+        self.chatStats(key).superseded += superseded
+        return superseded
+
+    def chatStats(self, key: Hashable) -> ChatQueueStats:
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = ChatQueueStats()
+            self.stats.set(key, stats)
+        return stats
+
+    @property
+    def started(self):
+        return any(not task.done() for task in self.tasks)
+
+    def start(self):
+        if not self.started:
+            self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def work(self):
+        while True:
+            key = await self.ready.get()
+            self.waiting.discard(key)
+            queue = self.queues.get(key)
+            if not queue:
+                # all pending jobs got superseded
+                self.queues.pop(key, None)
+                continue
+            job: ScheduledJob = queue.popleft()
+            self.running[key] = job
+            self.chatStats(key).add_wait(time.monotonic() - job.enqueued)
+            job.task = asyncio.ensure_future(job.fn())
+            try:
+                await job.task
+            except asyncio.CancelledError:
+                # a superseded job is done, the worker itself being stopped is not
+                if not job.superseded:
+                    job.task.cancel()
+                    raise
+            except Exception as ex:
+                print("Error in scheduled job", key, ex)
+            finally:
+                self.running.pop(key, None)
+                if queue:
+                    # back of the line, the other ready chats go first
+                    self.markReady(key)
+                elif self.queues.get(key) is queue:
+                    del self.queues[key]
+
+    def to_dict(self, key: Optional[Hashable] = None):
+        if key is not None:
+            return {"depth": self.depth(key), "running": key in self.running, **self.chatStats(key).to_dict()}
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "running": len(self.running),
+            "queued": sum(len(queue) for queue in self.queues.values()),
+            "chats": {str(chat): self.to_dict(chat) for chat in self.queues}
+        }
@@ -0,0 +1,123 @@
+import asyncio
+from bot.manager import DebugEntry
+from bot import config as bc
+
+class DebugSink:
+    """
+    Bounded queue for debug messages, a background worker renders the entries
+    and sends several of them as one message to the debug chat.
+    If the queue is full the oldest entry is dropped, so debug traffic never waits on the websocket.
+    """
+
+    def __init__(
+            self,
+            mng,
+            verbosity: int = None,
+            maxsize: int = None,
+            batch_size: int = None,
+            batch_bytes: int = None,
+            interval: float = None
+        ):
+        self.mng = mng
+        self.verbosity = bc.DEBUG_VERBOSITY if verbosity is None else verbosity
+        self.batch_size = batch_size or bc.DEBUG_SINK_BATCH_SIZE
+        self.batch_bytes = batch_bytes or bc.DEBUG_SINK_BATCH_BYTES
+        self.interval = bc.DEBUG_SINK_INTERVAL if interval is None else interval
+        self.queue = asyncio.Queue(maxsize=maxsize or bc.DEBUG_SINK_QUEUE_SIZE)
+        self.task = None
+        self.dropped = 0
+        self.batched = 0
+        self.messages_sent = 0
+        self.entries_sent = 0
+
+    def accepts(self, verbose: int) -> bool:
+        return verbose <= self.verbosity
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def put(self, entry: DebugEntry):
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            except asyncio.QueueEmpty:
+                pass
+        self.queue.put_nowait(entry)
+
+    def start(self):
+        if not self.running:
+            self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        if self.running:
+            self.task.cancel()
+        self.task = None
+
+    async def next_batch(self) -> list[DebugEntry]:
+        entries = [await self.queue.get()]
+        # wait a moment so the entries of one turn end up in the same message
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.interval
+        while len(entries) < self.batch_size:
+            try:
+                entries.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                entries.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return entries
+
+    async def run(self):
+        while True:
+            entries = await self.next_batch()
+            try:
+                texts = []
+                for entry in entries:
+                    try:
+                        texts.append(await self.mng.renderDebugEntry(entry))
+                    except Exception as ex:
+                        texts.append(f"Failed to render debug entry\n> {ex}")
+                await self.send(texts)
+            except Exception as ex:
+                print("Error sending debug batch", ex)
+            finally:
+                for _ in entries:
+                    self.queue.task_done()
+
+    async def send(self, texts: list[str]):
+        batch, size = [], 0
+        for text in texts:
+            if batch and size + len(text) > self.batch_bytes:
+                self.mng.sendDebugText("\n\n".join(batch))
+                self._count(len(batch))
+                batch, size = [], 0
+            batch.append(text)
+            size += len(text)
+        if batch:
+            self.mng.sendDebugText("\n\n".join(batch))
+            self._count(len(batch))
+
+    def _count(self, entries: int):
+        self.messages_sent += 1
+        self.entries_sent += entries
+        if entries > 1:
+            self.batched += entries
+
+    def to_dict(self):
+        return {
+            "verbosity": self.verbosity,
+            "queued": self.queue.qsize(),
+            "dropped": self.dropped,
+            "batched": self.batched,
+            "messages_sent": self.messages_sent,
+            "entries_sent": self.entries_sent
+        }
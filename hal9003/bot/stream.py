@@ -0,0 +1,216 @@
+import time
+import asyncio
+from dataclasses import dataclass
+from typing import Optional
+from bot.manager import Manager, MessageContext, PartialEncoding
+from bot import config as bc
+
+@dataclass
+class StreamStats:
+    frames_sent: int = 0
+    frames_coalesced: int = 0
+    bytes_sent: int = 0
+    bytes_saved: int = 0
+    interrupted: int = 0
+
+    def add(self, other: "StreamStats"):
+        self.frames_sent += other.frames_sent
+        self.frames_coalesced += other.frames_coalesced
+        self.bytes_sent += other.bytes_sent
+        self.bytes_saved += other.bytes_saved
+        self.interrupted += other.interrupted
+
+    def to_dict(self):
+        return {
+            "frames_sent": self.frames_sent,
+            "frames_coalesced": self.frames_coalesced,
+            "bytes_sent": self.bytes_sent,
+            "bytes_saved": self.bytes_saved,
+            "interrupted": self.interrupted
+        }
+
+
+class StreamCoalescer:
+    """
+    Buffers the streamed deltas of a single reply and only sends a `partial_message`
+    once the time budget (`interval` seconds) or the byte budget (`max_bytes`) is used up.
+    Buffered deltas are flushed at the deadline even if the upstream stalls.
+    `finish` always sends the complete text as the final chat message.
+
+    With the `delta` encoding a frame only carries the text appended since the last frame,
+    every `resync_frames` frames and at finish a full text `resync` frame is sent.
+    """
+
+    # accumulated over all streams of this process
+    totals: StreamStats = StreamStats()
+
+    def __init__(
+            self,
+            mng: Manager,
+            context: MessageContext,
+            interval: float = None,
+            max_bytes: int = None,
+            encoding: str = None,
+            resync_frames: int = None
+        ):
+        self.mng = mng
+        self.context = context
+        self.interval = bc.STREAM_FLUSH_INTERVAL if interval is None else interval
+        self.max_bytes = bc.STREAM_FLUSH_BYTES if max_bytes is None else max_bytes
+        self.encoding = encoding or mng.partialEncoding()
+        self.resync_frames = bc.PARTIAL_RESYNC_FRAMES if resync_frames is None else resync_frames
+        self.stats = StreamStats()
+        # set once the final message is on its way, a later cancel must not store the reply again
+        self.finished = False
+        self.chunks = []
+        self.text_bytes = 0
+        self.pending_bytes = 0
+        self.last_flush = 0.0
+        self.flush_lock = asyncio.Lock()
+        # `call_later` handle of the pending deadline & the flush it started
+        self.deadline = None
+        self.deadline_flush = None
+        # delta encoding state
+        self.seq = 0
+        self.sent_chunks = 0
+        self.sent_chars = 0
+
+    @property
+    def text(self):
+        return "".join(self.chunks)
+
+    async def push(self, delta: str):
+        if not delta:
+            return
+        self.chunks.append(delta)
+        size = len(delta.encode('utf-8'))
+        self.text_bytes += size
+        self.pending_bytes += size
+        # without coalescing every delta would have re-sent the full text
+        self.stats.bytes_saved += self.text_bytes
+
+        now = time.monotonic()
+        if self.pending_bytes >= self.max_bytes or (now - self.last_flush) >= self.interval:
+            await self.flush(now)
+        else:
+            self.stats.frames_coalesced += 1
+            self.scheduleFlush(now)
+
+    def scheduleFlush(self, now: float):
+        if self.deadline is None and self.interval > 0:
+            delay = max(self.last_flush + self.interval - now, 0)
+            self.deadline = asyncio.get_running_loop().call_later(delay, self._onDeadline)
+
+    def _onDeadline(self):
+        self.deadline = None
+        self.deadline_flush = asyncio.ensure_future(self.flush())
+
+    def cancelDeadline(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+
+    async def flush(self, now: float = None):
+        # a deadline flush and a push must not interleave their frames
+        async with self.flush_lock:
+            self.cancelDeadline()
+            if self.pending_bytes and not self.finished:
+                await self._flush(now)
+
+    async def _flush(self, now: float = None):
+        if self.encoding == PartialEncoding.DELTA:
+            resync = self.resync_frames > 0 and self.seq > 0 and self.seq % self.resync_frames == 0
+            sent_bytes = self.text_bytes if resync else self.pending_bytes
+            await self._sendDelta(resync)
+        else:
+            sent_bytes = self.text_bytes
+            await self.mng.sendPartialMessage(self.context, self.text)
+        self.stats.frames_sent += 1
+        self.stats.bytes_sent += sent_bytes
+        self.stats.bytes_saved -= sent_bytes
+        self.pending_bytes = 0
+        self.last_flush = time.monotonic() if now is None else now
+
+    async def _sendDelta(self, resync: bool):
+        if resync:
+            text, offset = self.text, 0
+        else:
+            text, offset = "".join(self.chunks[self.sent_chunks:]), self.sent_chars
+        await self.mng.sendPartialMessage(
+            self.context,
+            text,
+            encoding=PartialEncoding.DELTA,
+            offset=offset,
+            seq=self.seq,
+            resync=resync
+        )
+        self.seq += 1
+        self.sent_chars = offset + len(text)
+        self.sent_chunks = len(self.chunks)
+
+    async def finish(self) -> str:
+        async with self.flush_lock:
+            self.cancelDeadline()
+            return await self._finish()
+
+    async def _finish(self) -> str:
+        if self.encoding == PartialEncoding.DELTA and self.seq > 0:
+            # final resync so the client ends up with the exact text even if a frame got lost
+            self.pending_bytes = 0
+            await self._sendDelta(resync=True)
+            self.stats.frames_sent += 1
+            self.stats.bytes_sent += self.text_bytes
+            self.stats.bytes_saved -= self.text_bytes
+        elif self.pending_bytes:
+            # buffered deltas are dropped, the final message carries the full text
+            self.stats.frames_coalesced += 1
+        self.pending_bytes = 0
+        text = self.text
+        self.finished = True
+        StreamCoalescer.totals.add(self.stats)
+        await self.mng.sendChatMessage(self.context, text)
+        return text
+
+    def interrupt(self) -> str:
+        """The reply got superseded, buffered deltas are dropped and no final message is sent"""
+        if self.finished:
+            # the final message was already sent & counted
+            return self.text
+        self.cancelDeadline()
+        if self.deadline_flush is not None:
+            self.deadline_flush.cancel()
+        if self.pending_bytes:
+            self.stats.frames_coalesced += 1
+        self.pending_bytes = 0
+        self.stats.interrupted += 1
+        StreamCoalescer.totals.add(self.stats)
+        return self.text
+
+
+class PartialMessageDecoder:
+    """
+    Rebuilds the streamed text on the receiving side from `partial_message` payloads of both encodings.
+    Frames that don't line up with the current text are ignored until the next `resync` frame.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.seq = -1
+        self.stale = False
+
+    def feed(self, payload: dict, encoding: Optional[str] = None) -> str:
+        if encoding != PartialEncoding.DELTA:
+            self.text = payload['text']
+            return self.text
+
+        seq = payload.get('seq', 0)
+        if payload.get('resync') or payload.get('offset', 0) == 0:
+            self.text = payload['text']
+            self.seq = seq
+            self.stale = False
+        elif (not self.stale) and seq == self.seq + 1 and payload['offset'] == len(self.text):
+            self.text += payload['text']
+            self.seq = seq
+        else:
+            self.stale = True
+        return self.text
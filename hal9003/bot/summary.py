@@ -0,0 +1,115 @@
+import asyncio
+from typing import Optional
+from bot.cache import SingleFlight
+from bot import config as bc
+from agent import models, clients, limits
+
+SUMMARY_PROMPT = """You maintain a running summary of a chat between a user and an assistant.
+Merge the previous summary and the new messages into one concise summary.
+Keep names, facts, decisions, open questions and the user's preferences, drop small talk.
+Respond with the summary only."""
+
+class ChatSummarizer:
+    """
+    Compresses the older part of a chat history into a running summary stored per chat.
+    Runs in the background after a reply, a segment is only summarized once
+    because the stored summary records up to which message it covers.
+    """
+
+    def __init__(self, db, ai_client, concurrency: int = None, backend=None):
+        self.db = db
+        self.ai_client = ai_client
+        self.backend = backend
+        self.semaphore = asyncio.Semaphore(concurrency or bc.SUMMARY_CONCURRENCY)
+        # one summarization per chat at a time
+        self.flights = SingleFlight()
+        self.tasks: set = set()
+        self.segments = 0
+        self.failed = 0
+
+    def schedule(self, chat_uuid, model: str):
+        if not bc.SUMMARY_ENABLED:
+            return
+        task = asyncio.ensure_future(self.flights.do(chat_uuid, lambda: self.summarize(chat_uuid, model)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def stop(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def nextSegment(self, chat_uuid) -> Optional[tuple[int, int]]:
+        """The absolute range of messages to summarize next, None if too few piled up"""
+        summary = await self.db.getChatSummary(chat_uuid)
+        offset, length = await self.db.getChatHistoryBounds(chat_uuid)
+        start = max(summary["until"] if summary else 0, offset)
+        # the most recent messages are sent as they are, no need to summarize them
+        end = length - bc.SUMMARY_KEEP_RECENT
+        if end - start < bc.SUMMARY_SEGMENT:
+            return None
+        return start, min(end, start + bc.SUMMARY_SEGMENT * 4)
+
+    async def summarize(self, chat_uuid, model: str):
+        # more messages may pile up while summarizing
+        while (segment := await self.nextSegment(chat_uuid)) is not None:
+            if not await self.summarizeSegment(chat_uuid, model, *segment):
+                return
+
+    async def summarizeSegment(self, chat_uuid, model: str, start: int, end: int) -> bool:
+        async with self.semaphore:
+            summary = await self.db.getChatSummary(chat_uuid)
+            if summary and summary["until"] > start:
+                # covered in the meantime, e.g.: by another bot process
+                return False
+            messages = await self.db.getChatMessagesRange(chat_uuid, start, end)
+            bot_user = await self.db.getOrFetchBotUser()
+            transcript = "\n".join(
+                f"{'assistant' if msg.sender == bot_user.uuid else 'user'}: {msg.text}" for msg in messages
+            )
+            previous = summary["text"] if summary else "(none)"
+            try:
+                messages = [
+                    {"role": "system", "content": SUMMARY_PROMPT},
+                    {"role": "user", "content": f"Previous summary:\n{previous}\n\nNew messages:\n{transcript}"}
+                ]
+                ai_client, backend, model_name = self.resolve(bc.SUMMARY_MODEL or model)
+                response = await self.complete(
+                    backend,
+                    lambda: ai_client.chat.completions.create(
+                        model=model_name,
+                        max_tokens=bc.SUMMARY_MAX_TOKENS,
+                        messages=messages
+                    ),
+                    limits.estimate_tokens(messages, bc.SUMMARY_MAX_TOKENS)
+                )
+            except Exception as ex:
+                self.failed += 1
+                await self.db.mng.debugSend("## Summarizing failed\n - in chat `{chat_uuid}`\n> {ex}", None, verbose=1, chat_uuid=chat_uuid, ex=ex)
+                return False
+            text = response.choices[0].message.content
+            segments = (summary["segments"] if summary else 0) + 1
+            await self.db.setChatSummary(chat_uuid, text, until=end, segments=segments)
+            self.segments += 1
+        await self.db.mng.debugSend("## Chat summarized\n - in chat `{chat_uuid}`\n - messages {start} to {end}\n> {summary}", None, verbose=3,
+            chat_uuid=chat_uuid, start=start, end=end, summary=text)
+        return True
+
+    def resolve(self, model_name: str):
+        """The client, limiter backend & model name for `model_name`, models unknown to the registry use the bot's client"""
+        model = models.REGISTRY.find(model_name)
+        if model is None:
+            return self.ai_client, self.backend, model_name
+        return clients.get_async_client(model.client_config), model.client_config, model.model
+
+    async def complete(self, backend, fn, tokens: int):
+        if backend is None:
+            return await fn()
+        return await limits.LIMITER.call_async(backend, fn, tokens)
+
+    def to_dict(self):
+        return {
+            "enabled": bc.SUMMARY_ENABLED,
+            "running": len(self.tasks),
+            "segments": self.segments,
+            "failed": self.failed
+        }
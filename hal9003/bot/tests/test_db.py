@@ -0,0 +1,281 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from bot import db as bot_db
+from bot.db import DB, RedisEmulatedClient
+from bot.manager import ChatConfig
+from open_chat_api_client.models import Message, ChatSettings, UserSelf
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def make_message(i, text=None, sender="user"):
+    return Message(
+        uuid=f"msg-{i}",
+        sender=sender,
+        created=START + timedelta(seconds=i),
+        text=text or f"message {i}",
+        read=False
+    )
+
+
+class FakeServer:
+    # paginated `messages_list` endpoint, newest message first
+    def __init__(self):
+        self.messages = []
+        self.requested_pages = []
+
+    async def asyncio(self, chat_uuid, client, page=1, page_size=5):
+        self.requested_pages.append(page)
+        newest_first = list(reversed(self.messages))
+        results = newest_first[(page - 1) * page_size:page * page_size]
+        has_next = page * page_size < len(newest_first)
+        return SimpleNamespace(results=results, next_page=page + 1 if has_next else None)
+
+
+def make_db(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(bot_db, "messages_list", server)
+    monkeypatch.setattr(bot_db.bc, "DEBUG", False)
+    db = DB()
+    db.db_client = RedisEmulatedClient()
+    return db, server
+
+def test_history_sync_only_fetches_new_messages(monkeypatch):
+    db, server = make_db(monkeypatch)
+
+    async def _run():
+        for i in range(12):
+            server.messages.append(make_message(i))
+            await db.getOrFetchChatMessages("chat", incoming_message=server.messages[-1], min_context=5)
+        return await db.getChatMessagesTail("chat", 100)
+
+    history = asyncio.run(_run())
+    assert [msg.uuid for msg in history] == [f"msg-{i}" for i in range(12)]
+    # every turn stops at the high-water mark on the first page
+    assert set(server.requested_pages) == {1}
+
+def test_history_sync_catches_up_over_pages(monkeypatch):
+    db, server = make_db(monkeypatch)
+
+    async def _run():
+        server.messages.append(make_message(0))
+        await db.getOrFetchChatMessages("chat", incoming_message=server.messages[-1], min_context=3)
+        server.messages.extend(make_message(i) for i in range(1, 10))
+        tail = await db.getOrFetchChatMessages("chat", incoming_message=server.messages[-1], min_context=3)
+        return tail, await db.getChatMessagesTail("chat", 100)
+
+    tail, history = asyncio.run(_run())
+    assert [msg.uuid for msg in tail] == ["msg-7", "msg-8", "msg-9"]
+    assert [msg.uuid for msg in history] == [f"msg-{i}" for i in range(10)]
+
+def test_tmp_message_replaced_by_server_message(monkeypatch):
+    db, server = make_db(monkeypatch)
+
+    async def _run():
+        server.messages.append(make_message(0))
+        await db.getOrFetchChatMessages("chat", incoming_message=server.messages[-1])
+        await db.addChatMessage("chat", Message(uuid="tmp-1", sender="bot", created=datetime.now(), text="bot reply", read=False))
+        server.messages.append(make_message(1, text="bot reply", sender="bot"))
+        server.messages.append(make_message(2))
+        await db.getOrFetchChatMessages("chat", incoming_message=server.messages[-1])
+        return await db.getChatMessagesTail("chat", 100)
+
+    history = asyncio.run(_run())
+    assert [msg.uuid for msg in history] == ["msg-0", "msg-1", "msg-2"]
+
+def test_tmp_message_tracked_explicitly(monkeypatch):
+    db, server = make_db(monkeypatch)
+
+    async def _run():
+        server.messages.append(make_message(0))
+        await db.getOrFetchChatMessages("chat", incoming_message=server.messages[-1])
+        # a reply mentioning `"tmp-` is not a `tmp-` message
+        await db.addChatMessage("chat", Message(uuid="msg-x", sender="bot", created=datetime.now(), text='"tmp-1"', read=False))
+        await db.addChatMessage("chat", Message(uuid="tmp-1", sender="bot", created=datetime.now(), text="bot reply", read=False))
+        tmp_entries = await db.db_client.hgetall("chat:chat:tmp")
+        # redis clients without `decode_responses` reply with bytes
+        db.db_client.data["chat:chat:tmp"] = {sha: entry.encode() for sha, entry in tmp_entries.items()}
+        server.messages.append(make_message(1, text="bot reply", sender="bot"))
+        await db.upsertChatMessages("chat", [server.messages[-1]])
+        async with db.pipeline() as pipe:
+            with pytest.raises(ValueError):
+                await db.addChatMessage("chat", Message(uuid="tmp-2", sender="bot", created=datetime.now(), text="queued", read=False), pipe=pipe)
+        return tmp_entries, await db.db_client.hgetall("chat:chat:tmp"), await db.getChatMessagesTail("chat", 100)
+
+    tmp_entries, remaining, history = asyncio.run(_run())
+    assert list(tmp_entries.values()) == ["2:tmp-1"]
+    assert remaining == {}
+    assert [msg.uuid for msg in history] == ["msg-0", "msg-x", "msg-1"]
+
+def test_emulated_pipeline_applies_commands_in_order():
+    client = RedisEmulatedClient()
+
+    async def _run():
+        async with client.pipeline() as pipe:
+            pipe.rpush("list", "a").rpush("list", "b")
+            pipe.lset("list", 0, "c")
+            pipe.hset("hash", "field", 1)
+            pipe.lrange("list", 0, -1)
+            results = await pipe.execute()
+        # executed commands are not run twice
+        assert await pipe.execute() == []
+        async with client.pipeline() as pipe:
+            pipe.rpush("list", "d")
+        # leaving the block without `execute` drops the queued commands
+        return results, await client.lrange("list", 0, -1)
+
+    results, values = asyncio.run(_run())
+    assert results == [1, 2, None, 1, ["c", "b"]]
+    assert values == ["c", "b"]
+
+def test_history_trimmed_and_archived(monkeypatch):
+    db, server = make_db(monkeypatch)
+    monkeypatch.setattr(bot_db.bc, "HISTORY_TRIM_SEGMENT", 5)
+
+    async def _run():
+        for i in range(30):
+            server.messages.append(make_message(i))
+            await db.getOrFetchChatMessages("chat", incoming_message=server.messages[-1], max_history=10)
+            await db.addChatMessage("chat", Message(uuid=f"tmp-{i}", sender="bot", created=datetime.now(), text=f"reply {i}", read=False))
+            server.messages.append(make_message(i, text=f"reply {i}", sender="bot"))
+            server.messages[-1].uuid = f"reply-{i}"
+        return await db.getChatMessagesTail("chat", 100), await db.getArchivedChatMessages("chat")
+
+    history, archived = asyncio.run(_run())
+    assert len(history) <= 10 + 5 + 1
+    uuids = [msg.uuid for msg in archived + history]
+    # nothing lost, nothing duplicated and all replies replaced by their server version
+    assert uuids[:-1] == [uuid for i in range(29) for uuid in (f"msg-{i}", f"reply-{i}")] + ["msg-29"]
+    assert uuids[-1] == "tmp-29"
+
+def test_archived_message_not_appended_again(monkeypatch):
+    db, server = make_db(monkeypatch)
+    monkeypatch.setattr(bot_db.bc, "HISTORY_TRIM_SEGMENT", 5)
+    monkeypatch.setattr(bot_db.bc, "HISTORY_ARCHIVE_MAX_SEGMENTS", 2)
+
+    async def _run():
+        messages = [make_message(i) for i in range(40)]
+        for i in range(0, 40, 8):
+            length = await db.upsertChatMessages("chat", messages[i:i + 8])
+            await db.setChatSyncState("chat", messages[i + 7])
+            await db.trimChatMessages("chat", 10, length)
+        # e.g. a paginated sync fetches an archived page again
+        length = await db.upsertChatMessages("chat", messages[:3])
+        return length, await db.getChatMessagesTail("chat", 100), await db.db_client.llen("chat:chat:archive"), await db.db_client.hgetall("chat:chat:index")
+
+    length, history, segments, index = asyncio.run(_run())
+    assert length == len(history) == 10
+    assert [msg.uuid for msg in history] == [f"msg-{i}" for i in range(30, 40)]
+    assert segments == 2
+    # trimmed messages leave the index
+    assert sorted(index) == sorted(msg.uuid for msg in history)
+
+class FakeSettingsServer:
+    def __init__(self):
+        self.settings = {}
+        self.requests = 0
+
+    def retrieve(self):
+        async def asyncio_detailed(chat_uuid, client):
+            self.requests += 1
+            return SimpleNamespace(parsed=self.settings.get(chat_uuid))
+        return SimpleNamespace(asyncio_detailed=asyncio_detailed)
+
+    def create(self):
+        async def _asyncio(chat_uuid, body, client):
+            self.requests += 1
+            self.settings[chat_uuid] = ChatSettings.from_dict(body.to_dict())
+            return self.settings[chat_uuid]
+        return SimpleNamespace(asyncio=_asyncio)
+
+def test_chat_settings_cached_and_written_through(monkeypatch):
+    db, _ = make_db(monkeypatch)
+    server = FakeSettingsServer()
+    monkeypatch.setattr(bot_db, "chats_settings_retrieve", server.retrieve())
+    monkeypatch.setattr(bot_db, "chats_settings_create", server.create())
+
+    async def _run():
+        _, first = await db.getOrCreateChatSettings("chat")
+        _, second = await db.getOrCreateChatSettings("chat")
+        await db.updateChatSettingsConfigKey("chat", "model", "gpt-4o")
+        _, updated = await db.getOrCreateChatSettings("chat")
+        return first, second, updated
+
+    first, second, updated = asyncio.run(_run())
+    assert first is second
+    assert updated.model == "gpt-4o"
+    # retrieve + create on the first call, one create for the update
+    assert server.requests == 3
+    assert db.settings_cache.hits == 3
+
+def test_invalid_temperature_resets_config(monkeypatch):
+    db, _ = make_db(monkeypatch)
+    server = FakeSettingsServer()
+    monkeypatch.setattr(bot_db, "chats_settings_retrieve", server.retrieve())
+    monkeypatch.setattr(bot_db, "chats_settings_create", server.create())
+
+    async def _run():
+        _, valid = await db.updateChatSettingsConfigKey("chat", "temperature", "0")
+        _, invalid = await db.updateChatSettingsConfigKey("chat", "temperature", "warm")
+        return valid, invalid
+
+    valid, invalid = asyncio.run(_run())
+    assert valid.temperature == 0.0
+    assert invalid == ChatConfig(model=bot_db.bc.DEFAULT_MODEL)
+
+def test_concurrent_settings_lookups_share_one_fetch(monkeypatch):
+    db, _ = make_db(monkeypatch)
+    server = FakeSettingsServer()
+    monkeypatch.setattr(bot_db, "chats_settings_retrieve", server.retrieve())
+    monkeypatch.setattr(bot_db, "chats_settings_create", server.create())
+
+    async def _run():
+        return await asyncio.gather(*[db.getOrCreateChatSettings("chat") for _ in range(5)])
+
+    results = asyncio.run(_run())
+    assert len({id(config) for _, config in results}) == 1
+    # one retrieve & one create, not five of each
+    assert server.requests == 2
+
+def test_bot_user_resolved_once(monkeypatch):
+    db, _ = make_db(monkeypatch)
+    requests = []
+
+    async def retrieve(client):
+        requests.append(client)
+        return UserSelf(id=1, uuid="bot", username="bot")
+    monkeypatch.setattr(bot_db.user_self_retrieve, "asyncio", retrieve)
+
+    async def _run():
+        users = [await db.getOrFetchBotUser() for _ in range(3)]
+        await db.db_client.flushdb()
+        return users + [await db.getOrFetchBotUser()]
+
+    users = asyncio.run(_run())
+    assert all(user is users[0] for user in users)
+    assert len(requests) == 1
+
+def test_render_cache_reused_and_invalidated_on_replace(monkeypatch):
+    db, server = make_db(monkeypatch)
+
+    async def _run():
+        server.messages.append(make_message(0))
+        history = await db.getOrFetchChatMessages("chat", incoming_message=server.messages[-1])
+        await db.renderChatMessages("chat", history, bot_uuid="bot")
+        await db.addChatMessage("chat", Message(uuid="tmp-1", sender="bot", created=datetime.now(), text="bot reply", read=False))
+        history = await db.getChatMessagesTail("chat", 10)
+        first = await db.renderChatMessages("chat", history, bot_uuid="bot")
+        misses = db.render_misses
+        await db.renderChatMessages("chat", history, bot_uuid="bot")
+        assert db.render_misses == misses
+        # the server version replaces the `tmp-` message with `lset`
+        server.messages.append(make_message(1, text="bot reply", sender="bot"))
+        server.messages.append(make_message(2))
+        await db.getOrFetchChatMessages("chat", incoming_message=server.messages[-1])
+        return first, await db.db_client.hget("chat:chat:render", "tmp-1")
+
+    first, tmp_entry = asyncio.run(_run())
+    assert [entry["message"]["role"] for entry in first] == ["user", "assistant"]
+    assert tmp_entry is None
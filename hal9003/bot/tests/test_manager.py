@@ -0,0 +1,42 @@
+import json
+import asyncio
+from bot.manager import Manager
+from bot.fmt import Formatter
+
+TEMPLATE = "## Message\n> {message_text}\n- from `{sender}`\n{message}"
+
+
+class FakeBot:
+    fmt = Formatter()
+
+    def __init__(self):
+        self.sent = []
+
+    def sendMessage(self, payload, isBinary=False):
+        self.sent.append(json.loads(payload.decode('utf-8'))['data']['payload']['text'])
+
+class FakeDB:
+    def __init__(self, debug):
+        self.debug = debug
+
+    async def shouldDebug(self):
+        return self.debug
+
+def debug_send(debug):
+    bot = FakeBot()
+    mng = Manager(bot, db=FakeDB(debug))
+    rendered = []
+
+    def _message():
+        rendered.append(True)
+        return "{...}"
+
+    asyncio.run(mng.debugSend(TEMPLATE, None, verbose=1, message_text="hi", sender="u", message=_message))
+    return bot.sent, rendered
+
+def test_debug_templates_render_only_when_debug_is_on():
+    sent, rendered = debug_send(True)
+    assert len(sent) == 1 and sent[0].endswith("## Message\n> hi\n- from `u`\n{...}")
+    assert rendered == [True]
+
+    assert debug_send(False) == ([], [])
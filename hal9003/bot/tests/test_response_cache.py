@@ -0,0 +1,46 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from bot.db import DB, RedisEmulatedClient
+from bot.response_cache import ResponseCache
+
+SYSTEM = {"role": "system", "content": "You are a helpful assistant."}
+
+
+def ask(text):
+    return [SYSTEM, {"role": "user", "content": text}]
+
+def test_exact_hits_ignore_whitespace_and_survive_in_redis():
+    db = DB()
+    db.db_client = RedisEmulatedClient()
+    cache = ResponseCache(db, semantic=False)
+
+    async def _run():
+        await cache.set("gpt-4o", ask("What is the capital of France?"), 0, "Paris")
+        hit = await cache.get("gpt-4o", ask("What is the  capital of France? "), 0)
+        other_model = await cache.get("gpt-3.5-turbo", ask("What is the capital of France?"), 0)
+        # a second process only shares redis
+        shared = await ResponseCache(db, semantic=False).get("gpt-4o", ask("What is the capital of France?"), 0)
+        return hit, other_model, shared
+
+    assert asyncio.run(_run()) == ("Paris", None, "Paris")
+
+def test_semantic_tier_matches_rephrasing_with_same_prefix():
+    cache = ResponseCache(semantic=True, threshold=0.6)
+    cache.setLocal("gpt-4o", ask("what is the capital of france"), 0, "Paris")
+
+    assert cache.getLocal("gpt-4o", ask("what's the capital of france?"), 0) == "Paris"
+    assert cache.getLocal("gpt-4o", ask("tell me a joke about cats"), 0) is None
+    assert cache.getLocal("gpt-4o", [{"role": "system", "content": "Be rude."}, *ask("what is the capital of france")[1:]], 0) is None
+
+def test_local_tiers_shared_between_threads():
+    cache = ResponseCache(maxsize=8, semantic=True)
+
+    def _worker(worker):
+        for i in range(200):
+            cache.setLocal("gpt-4o", ask(f"question {worker} {i}"), 0, "answer")
+            cache.getLocal("gpt-4o", ask(f"question {worker} {i - 1}"), 0)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(_worker, range(8)))
+    assert cache.stores == 8 * 200
+    assert len(cache.local) == 8
@@ -0,0 +1,86 @@
+import asyncio
+from bot.scheduler import ChatScheduler
+
+
+def test_chats_take_turns_and_keep_their_order():
+    scheduler = ChatScheduler(workers=1, max_queue=10)
+    order = []
+
+    def job(chat, i):
+        async def _run():
+            order.append((chat, i))
+            await asyncio.sleep(0)
+        return _run
+
+    async def _run():
+        # a flood in chat `a` must not starve chat `b`
+        for i in range(4):
+            scheduler.submit("a", job("a", i))
+        for i in range(2):
+            scheduler.submit("b", job("b", i))
+        scheduler.start()
+        while scheduler.queues or scheduler.running:
+            await asyncio.sleep(0.01)
+        scheduler.stop()
+
+    asyncio.run(_run())
+    assert order == [("a", 0), ("b", 0), ("a", 1), ("b", 1), ("a", 2), ("a", 3)]
+    assert scheduler.to_dict("a")["processed"] == 4
+
+def test_jobs_of_one_chat_never_overlap_and_full_queue_rejects():
+    scheduler = ChatScheduler(workers=4, max_queue=3)
+    active, overlaps = set(), []
+
+    async def job():
+        if "a" in active:
+            overlaps.append(True)
+        active.add("a")
+        await asyncio.sleep(0.01)
+        active.discard("a")
+
+    async def _run():
+        accepted = [scheduler.submit("a", job) for _ in range(4)]
+        scheduler.start()
+        while scheduler.queues or scheduler.running:
+            await asyncio.sleep(0.01)
+        scheduler.stop()
+        return accepted
+
+    accepted = asyncio.run(_run())
+    assert accepted == [True, True, True, False]
+    assert not overlaps
+    assert scheduler.to_dict("a")["rejected"] == 1
+
+def test_newer_message_supersedes_running_and_pending_replies():
+    scheduler = ChatScheduler(workers=2, max_queue=10)
+    done, cancelled = [], []
+
+    def reply(i):
+        async def _run():
+            try:
+                await asyncio.sleep(0.05)
+                done.append(i)
+            except asyncio.CancelledError:
+                cancelled.append(i)
+                raise
+        return _run
+
+    async def command():
+        done.append("command")
+
+    async def _run():
+        scheduler.start()
+        scheduler.submit("a", reply(0), supersedable=True)
+        await asyncio.sleep(0.01)
+        scheduler.submit("a", command)
+        scheduler.submit("a", reply(1), supersedable=True)
+        assert scheduler.supersede("a") == 2
+        scheduler.submit("a", reply(2), supersedable=True)
+        while scheduler.queues or scheduler.running:
+            await asyncio.sleep(0.01)
+        scheduler.stop()
+
+    asyncio.run(_run())
+    assert cancelled == [0]
+    assert done == ["command", 2]
+    assert scheduler.to_dict("a")["superseded"] == 2
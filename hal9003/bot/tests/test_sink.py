@@ -0,0 +1,54 @@
+import asyncio
+from bot.manager import DebugEntry
+from bot.sink import DebugSink
+
+
+class FakeManager:
+    # renders entries as their text and collects the debug chat messages
+    def __init__(self):
+        self.sent = []
+
+    async def renderDebugEntry(self, entry: DebugEntry):
+        return entry.text
+
+    def sendDebugText(self, text):
+        self.sent.append(text)
+
+
+def test_full_queue_drops_oldest_entry():
+    async def _run():
+        sink = DebugSink(FakeManager(), maxsize=3)
+        for i in range(5):
+            sink.put(DebugEntry(text=f"entry {i}"))
+        return sink, [sink.queue.get_nowait().text for _ in range(sink.queue.qsize())]
+
+    sink, queued = asyncio.run(_run())
+    assert queued == ["entry 2", "entry 3", "entry 4"]
+    assert sink.dropped == 2
+
+def test_entries_batched_by_count():
+    mng = FakeManager()
+
+    async def _run():
+        sink = DebugSink(mng, maxsize=20, batch_size=3, interval=0)
+        for i in range(7):
+            sink.put(DebugEntry(text=f"entry {i}"))
+        sink.start()
+        await asyncio.wait_for(sink.queue.join(), 1)
+        sink.stop()
+        return sink
+
+    sink = asyncio.run(_run())
+    assert mng.sent == ["entry 0\n\nentry 1\n\nentry 2", "entry 3\n\nentry 4\n\nentry 5", "entry 6"]
+    stats = sink.to_dict()
+    # single entry messages don't count as batched
+    assert (stats["queued"], stats["dropped"], stats["batched"]) == (0, 0, 6)
+    assert (stats["messages_sent"], stats["entries_sent"]) == (3, 7)
+
+def test_batch_split_by_bytes():
+    mng = FakeManager()
+    sink = DebugSink(mng, batch_bytes=25)
+
+    asyncio.run(sink.send(["a" * 10, "b" * 10, "c" * 10]))
+    assert mng.sent == ["a" * 10 + "\n\n" + "b" * 10, "c" * 10]
+    assert (sink.messages_sent, sink.entries_sent, sink.batched) == (2, 3, 2)
@@ -0,0 +1,105 @@
+import asyncio
+import json
+from bot.manager import Manager, MessageContext, PartialEncoding
+from bot.stream import StreamCoalescer, StreamStats, PartialMessageDecoder
+from open_chat_api_client.models import Message, ChatResult
+
+
+class FakeWebsocket:
+    # receives the frames the bot would send to the open-chat server
+    def __init__(self):
+        self.decoder = PartialMessageDecoder()
+        self.partials = []
+        self.final = None
+
+    def sendMessage(self, payload, isBinary=False):
+        data = json.loads(payload.decode('utf-8'))['data']
+        if data['action'] == 'partial_message':
+            self.partials.append(self.decoder.feed(data['payload'], data.get('encoding')))
+        elif data['action'] == 'send_message':
+            self.final = data['payload']['text']
+
+
+MESSAGE = {"uuid": "m", "sender": "u", "text": "hi", "created": "2024-01-01T00:00:00", "read": False}
+CHAT = {
+    "uuid": "c",
+    "created": "2024-01-01T00:00:00",
+    "newest_message": MESSAGE,
+    "unread_count": 0,
+    "partner": {
+        "uuid": "u",
+        "first_name": "User",
+        "second_name": "",
+        "last_updated": "2024-01-01T00:00:00",
+        "is_online": True,
+        "reqires_contact_password": False
+    }
+}
+
+def stream_reply(encoding, deltas, max_bytes=16, resync_frames=3):
+    ws = FakeWebsocket()
+    mng = Manager(ws)
+    context = MessageContext(Message.from_dict(MESSAGE), "u", ChatResult.from_dict(CHAT))
+    stream = StreamCoalescer(mng, context, interval=60, max_bytes=max_bytes, encoding=encoding, resync_frames=resync_frames)
+
+    async def _run():
+        for delta in deltas:
+            await stream.push(delta)
+        return await stream.finish()
+
+    return ws, stream, asyncio.run(_run())
+
+def test_delta_stream_rebuilds_final_text():
+    deltas = [f"token-{i} " for i in range(100)]
+    ws, stream, text = stream_reply(PartialEncoding.DELTA, deltas)
+
+    assert text == "".join(deltas)
+    assert ws.final == text
+    assert ws.partials[-1] == text
+    assert stream.stats.frames_sent == len(ws.partials)
+
+def test_delta_stream_sends_less_than_full_stream():
+    deltas = [f"token-{i} " for i in range(100)]
+    _, full, _ = stream_reply(PartialEncoding.FULL, deltas)
+    _, delta, _ = stream_reply(PartialEncoding.DELTA, deltas)
+
+    assert delta.stats.bytes_sent < full.stats.bytes_sent
+
+def test_decoder_waits_for_resync_after_gap():
+    decoder = PartialMessageDecoder()
+    decoder.feed({"text": "Hello", "offset": 0, "seq": 0}, PartialEncoding.DELTA)
+    # seq 1 got lost
+    decoder.feed({"text": "!", "offset": 11, "seq": 2}, PartialEncoding.DELTA)
+    assert decoder.text == "Hello"
+    decoder.feed({"text": " world", "offset": 5, "seq": 3}, PartialEncoding.DELTA)
+    assert decoder.text == "Hello"
+    decoder.feed({"text": "Hello world!?", "offset": 0, "seq": 4, "resync": True}, PartialEncoding.DELTA)
+    assert decoder.text == "Hello world!?"
+
+def test_interrupt_after_finish_counted_once(monkeypatch):
+    monkeypatch.setattr(StreamCoalescer, "totals", StreamStats())
+    _, stream, text = stream_reply(PartialEncoding.DELTA, ["Hello", " world"], max_bytes=4)
+    frames_sent = StreamCoalescer.totals.frames_sent
+
+    assert stream.finished
+    assert stream.interrupt() == text
+    assert StreamCoalescer.totals.frames_sent == frames_sent
+    assert StreamCoalescer.totals.interrupted == 0
+
+def test_buffered_deltas_flushed_when_upstream_stalls():
+    ws = FakeWebsocket()
+    context = MessageContext(Message.from_dict(MESSAGE), "u", ChatResult.from_dict(CHAT))
+    stream = StreamCoalescer(Manager(ws), context, interval=0.05, max_bytes=1024, encoding=PartialEncoding.DELTA)
+
+    async def _run():
+        await stream.push("Hello")
+        await stream.push(" world")
+        # no further delta arrives before the deadline
+        await asyncio.sleep(0.15)
+        partials = list(ws.partials)
+        return partials, await stream.finish()
+
+    partials, text = asyncio.run(_run())
+    assert partials == ["Hello", "Hello world"]
+    assert ws.partials[-1] == ws.final == text
+    assert stream.deadline is None
@@ -0,0 +1,56 @@
+import asyncio
+from types import SimpleNamespace
+from bot import summary as bot_summary
+from bot.summary import ChatSummarizer
+from bot.tests.test_db import make_db, make_message
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.requests = []
+
+    async def create(self, model, messages, max_tokens=None):
+        self.requests.append(messages)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=f"summary {len(self.requests)}"))])
+
+
+def test_summary_covers_each_segment_once(monkeypatch):
+    db, _ = make_db(monkeypatch)
+    db.bot_user = SimpleNamespace(uuid="bot")
+    monkeypatch.setattr(bot_summary.bc, "SUMMARY_ENABLED", True)
+    monkeypatch.setattr(bot_summary.bc, "SUMMARY_SEGMENT", 5)
+    monkeypatch.setattr(bot_summary.bc, "SUMMARY_KEEP_RECENT", 5)
+    completions = FakeCompletions()
+    summarizer = ChatSummarizer(db, SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+
+    async def _run():
+        for i in range(12):
+            await db.addChatMessage("chat", make_message(i))
+        # concurrent triggers for the same chat share one run
+        summarizer.schedule("chat", "model")
+        summarizer.schedule("chat", "model")
+        await asyncio.gather(*summarizer.tasks)
+        first = await db.getChatSummary("chat")
+        summarizer.schedule("chat", "model")
+        await asyncio.gather(*summarizer.tasks)
+        return first, await db.getChatSummary("chat")
+
+    first, second = asyncio.run(_run())
+    assert first == {"text": "summary 1", "until": 7, "segments": 1}
+    # too few new messages, nothing summarized again
+    assert second == first
+    assert len(completions.requests) == 1
+
+def test_summary_model_uses_its_own_backend(monkeypatch):
+    db, _ = make_db(monkeypatch)
+    monkeypatch.setattr(bot_summary.bc, "SUMMARY_MODEL", "llama3-8b")
+    summary_client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+    backends = []
+    monkeypatch.setattr(bot_summary.clients, "get_async_client", lambda backend: backends.append(backend) or summary_client)
+    summarizer = ChatSummarizer(db, SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions())))
+
+    ai_client, backend, model_name = summarizer.resolve(bot_summary.bc.SUMMARY_MODEL)
+    assert ai_client is summary_client and backends == [backend]
+    assert (backend.name, model_name) == ("deepinfra", "meta-llama/Meta-Llama-3-8B-Instruct")
+    # models the registry doesn't know keep the bot's client
+    assert summarizer.resolve("local-model") == (summarizer.ai_client, None, "local-model")
@@ -0,0 +1,47 @@
+import asyncio
+from datetime import datetime
+from bot.fmt import Formatter
+from bot.tokens import TokenCounter
+from open_chat_api_client.models import Message
+
+
+def make_message(i, text):
+    return Message(uuid=f"msg-{i}", sender="user", created=datetime(2024, 1, 1), text=text, read=False)
+
+def test_pack_fills_budget_newest_first():
+    fmt = Formatter()
+    messages = [make_message(i, "word " * 20) for i in range(10)]
+    tokens = fmt.tokens.countMessage(messages[0])
+
+    packed = fmt.pack_messages(messages, token_budget=3 * tokens + 3)
+    assert [msg.uuid for msg in packed] == ["msg-7", "msg-8", "msg-9"]
+    out = asyncio.run(fmt.openai_user_messages(messages, context=10, token_budget=3 * tokens + 3))
+    assert len(out) == 3
+
+def test_oversized_message_is_truncated_not_dropped():
+    fmt = Formatter()
+    fmt.tokens = TokenCounter()
+    messages = [make_message(0, "short"), make_message(1, "long paste " * 2000)]
+
+    packed = fmt.pack_messages(messages, token_budget=200)
+    assert [msg.uuid for msg in packed] == ["msg-1"]
+    assert fmt.tokens.count(packed[0].text) <= 200
+    assert packed[0].text.endswith("[...]")
+
+def test_newest_message_kept_whole_without_budget():
+    fmt = Formatter()
+    messages = [make_message(0, "older"), make_message(1, "the question " * 50)]
+
+    # e.g.: the system prompt used up the budget
+    packed = fmt.pack_messages(messages, token_budget=10)
+    assert [msg.text for msg in packed] == [messages[1].text]
+
+def test_message_count_cached_by_content():
+    counter = TokenCounter()
+    asyncio.run(counter.loadEncoding())
+    counter.countMessage(make_message(0, "a b c d e f"))
+    counter.countMessage(make_message(1, "a b c d e f"))
+    # same uuid & length, e.g.: a `tmp-` reply replaced by its server version
+    counter.countMessage(make_message(0, "abcdefghijk"))
+
+    assert (counter.counts.hits, counter.counts.misses) == (1, 2)
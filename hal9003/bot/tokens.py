@@ -0,0 +1,93 @@
+import math
+import asyncio
+import hashlib
+from typing import Optional
+from open_chat_api_client.models import Message
+from bot.cache import LRUCache
+from bot import config as bc
+from agent import models
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# chat format overhead per message and for priming the reply, see the openai cookbook
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+# rough fallback if no tokenizer is available
+CHARS_PER_TOKEN = 4
+
+class TokenCounter:
+    """
+    Counts tokens with a local tiktoken encoding, falls back to a character estimate if tiktoken
+    or its encoding files are not available. Message counts are cached by content hash.
+    Loading an encoding may download it, `loadEncoding` does that off the event loop.
+    """
+
+    def __init__(self, encoding_name: str = None, cache_size: int = None):
+        self.encoding_name = encoding_name or bc.TOKENIZER_ENCODING
+        self.encodings: dict = {}
+        self.counts = LRUCache(maxsize=cache_size or bc.TOKEN_CACHE_SIZE, ttl=0)
+
+    def encoding(self, model: Optional[str] = None):
+        key = model or self.encoding_name
+        if key not in self.encodings:
+            encoding = None
+            if tiktoken is not None:
+                try:
+                    encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(self.encoding_name)
+                except KeyError:
+                    # not an openai model, the default encoding is close enough
+                    encoding = self.encoding(None)
+                except Exception as ex:
+                    # e.g.: the encoding file can't be downloaded, don't retry for every message
+                    print("Tokenizer unavailable, estimating token counts", ex)
+            self.encodings[key] = encoding
+        return self.encodings[key]
+
+    async def loadEncoding(self, model: Optional[str] = None):
+        if (model or self.encoding_name) not in self.encodings:
+            await asyncio.to_thread(self.encoding, model)
+
+    def count(self, text: str, model: Optional[str] = None) -> int:
+        if not text:
+            return 0
+        encoding = self.encoding(model)
+        if encoding is None:
+            return math.ceil(len(text) / CHARS_PER_TOKEN)
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def countMessage(self, message: Message, model: Optional[str] = None) -> int:
+        key = (hashlib.sha256(message.text.encode('utf-8')).hexdigest(), model)
+        tokens = self.counts.get(key)
+        if tokens is None:
+            tokens = self.count(message.text, model) + TOKENS_PER_MESSAGE
+            self.counts.set(key, tokens)
+        return tokens
+
+    def truncate(self, text: str, max_tokens: int, model: Optional[str] = None) -> str:
+        """Keeps the start of `text` that fits into `max_tokens`"""
+        if max_tokens <= 0:
+            return ""
+        encoding = self.encoding(model)
+        if encoding is None:
+            return text[:max_tokens * CHARS_PER_TOKEN]
+        tokens = encoding.encode(text, disallowed_special=())
+        return encoding.decode(tokens[:max_tokens])
+
+    def to_dict(self):
+        return {
+            "tokenizer": self.encoding_name if tiktoken is not None else None,
+            "cache": self.counts.to_dict()
+        }
+
+COUNTER = TokenCounter()
+
+def tokenBudget(model_name: str, budget: Optional[int] = None) -> int:
+    """Input tokens of a chat turn, the chat's own `tokenBudget` or derived from the model's context window"""
+    if budget:
+        return int(budget)
+    model = models.REGISTRY.find(model_name)
+    window = model.context_window if model else bc.CONTEXT_TOKEN_BUDGET
+    return min(window - bc.CONTEXT_RESERVED_TOKENS, bc.CONTEXT_TOKEN_BUDGET)